@@ -47,6 +47,12 @@ export interface SpatialCoverage {
   }>;
   geohashes4?: Array<{hash: string; number: number}>;
   number?: number;
+  admin_areas?: Array<{
+    id: number;
+    name: string;
+    level: number;
+    number: number;
+  }>;
 }
 
 export interface Metadata {
@@ -60,6 +66,7 @@ export interface Metadata {
   date: string;
   materialize: {date: string};
   nb_profiled_rows: number;
+  nb_rows_estimated?: boolean;
   sample: string;
   source: string;
   source_url?: string;
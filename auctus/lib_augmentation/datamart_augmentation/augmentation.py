@@ -8,7 +8,7 @@ import time
 from datamart_materialize import types
 from datamart_profiler.spatial import median_smallest_distance
 from datamart_profiler.temporal import get_temporal_resolution, \
-    temporal_aggregation_keys
+    temporal_aggregation_keys, truncate_datetime64
 
 
 logger = logging.getLogger(__name__)
@@ -78,6 +78,20 @@ def _transform_index(level, func):
     return inner
 
 
+def _truncate_index(level, resolution):
+    if resolution not in temporal_aggregation_keys:
+        raise ValueError("Unknown temporal resolution %r" % (resolution,))
+
+    def truncate(index):
+        index = pd.DatetimeIndex(index)
+        # Use the local time, like strftime() does
+        if index.tz is not None:
+            index = index.tz_localize(None)
+        return pd.DatetimeIndex(truncate_datetime64(index.values, resolution))
+
+    return _transform_index(level, truncate)
+
+
 def _transform_data_index(data, level, func):
     if isinstance(data.index, pd.MultiIndex):
         old_index = data.index.to_frame()
@@ -193,12 +207,8 @@ def match_column_temporal_resolutions(index_1, index_2, level,
 
     # Use the provided resolution
     if temporal_resolution is not None:
-        key = temporal_aggregation_keys[temporal_resolution]
         logger.info("Temporal alignment: requested '%s'", temporal_resolution)
-        if isinstance(key, str):
-            return _transform_index(level, lambda idx: idx.strftime(key))
-        else:
-            return _transform_index(level, lambda idx: idx.map(key))
+        return _truncate_index(level, temporal_resolution)
     else:
         # Pick the more coarse of the two resolutions
         resolution_1 = get_temporal_resolution(index_1[~index_1.isna()])
@@ -212,11 +222,7 @@ def match_column_temporal_resolutions(index_1, index_2, level,
                 resolution_1,
                 col,
             )
-            key = temporal_aggregation_keys[resolution_1]
-            if isinstance(key, str):
-                return _transform_index(level, lambda idx: idx.strftime(key))
-            else:
-                return _transform_index(level, lambda idx: idx.map(key))
+            return _truncate_index(level, resolution_1)
         else:
             # Change resolution of first index to the second's
             logger.info(
@@ -224,11 +230,7 @@ def match_column_temporal_resolutions(index_1, index_2, level,
                 resolution_2,
                 col,
             )
-            key = temporal_aggregation_keys[resolution_2]
-            if isinstance(key, str):
-                return _transform_index(level, lambda idx: idx.strftime(key))
-            else:
-                return _transform_index(level, lambda idx: idx.map(key))
+            return _truncate_index(level, resolution_2)
 
 
 def _first(series):
@@ -257,19 +259,15 @@ AGGREGATION_FUNCTIONS = {
 }
 
 
-def perform_aggregations(
-    data, original_columns,
+def _get_aggregations(
+    dtypes, original_columns,
     agg_functions=None, augment_columns_name=None,
 ):
-    """Performs group by on dataset after join, to keep the shape of the
-    new, augmented dataset the same as the original, input data.
-    """
+    """Choose the aggregation functions for each column of the joined data.
 
-    col_indices = {
-        col: idx for idx, col in enumerate(data.columns)
-    }
-
-    start = time.perf_counter()
+    :param dtypes: The types of the columns of the joined data
+    :return: A dict mapping column names to lists of function names
+    """
     original_columns_set = set(original_columns)
 
     provided_agg_functions = agg_functions
@@ -283,7 +281,7 @@ def perform_aggregations(
         }
 
     agg_functions = dict()
-    for column in data.columns:
+    for column in dtypes.index:
         if column == UNIQUE_INDEX_KEY or column in original_columns_set:
             # Just pick the first value
             # (they are all the same, from a single row in the original data)
@@ -299,24 +297,24 @@ def perform_aggregations(
                     else funcs
                 )
         else:
-            if ('int' in str(data.dtypes[column]) or
-                    'float' in str(data.dtypes[column])):
+            if ('int' in str(dtypes[column]) or
+                    'float' in str(dtypes[column])):
                 agg_functions[column] = ['mean', 'sum', 'max', 'min']
             else:
                 # Just pick the first value
                 agg_functions[column] = ['first']
+    return agg_functions
 
-    # Resolve names into functions using AGGREGATION_FUNCTIONS map
-    agg_functions = {
-        col: [AGGREGATION_FUNCTIONS[name] for name in names]
-        for col, names in agg_functions.items()
-    }
 
-    # Perform group-by
-    data = data.groupby(by=[UNIQUE_INDEX_KEY]).agg(agg_functions)
+def _rename_aggregations(data, columns, agg_functions):
+    """Reorder and rename the columns after the group-by.
 
-    # Drop group-by column
-    data.reset_index(drop=True, inplace=True)
+    :param columns: The columns of the joined data, in order
+    :param agg_functions: The aggregation functions from `_get_aggregations`
+    """
+    col_indices = {
+        col: idx for idx, col in enumerate(columns)
+    }
 
     # Reorder columns
     # sorted() is a stable sort, so we'll keep the order of agg_functions above
@@ -331,14 +329,282 @@ def perform_aggregations(
         else ' '.join(col[::-1]).strip()
         for col in data.columns
     ]
+    return data
+
+
+def perform_aggregations(
+    data, original_columns,
+    agg_functions=None, augment_columns_name=None,
+):
+    """Performs group by on dataset after join, to keep the shape of the
+    new, augmented dataset the same as the original, input data.
+    """
+    start = time.perf_counter()
+
+    agg_functions = _get_aggregations(
+        data.dtypes, original_columns,
+        agg_functions, augment_columns_name,
+    )
+
+    # Perform group-by
+    # Resolve names into functions using AGGREGATION_FUNCTIONS map
+    columns = list(data.columns)
+    data = data.groupby(by=[UNIQUE_INDEX_KEY]).agg({
+        col: [AGGREGATION_FUNCTIONS[name] for name in names]
+        for col, names in agg_functions.items()
+    })
+
+    # Drop group-by column
+    data.reset_index(drop=True, inplace=True)
+
+    data = _rename_aggregations(data, columns, agg_functions)
 
     logger.info("Aggregations completed in %.4fs", time.perf_counter() - start)
     return data
 
 
+def _add_dtype_samples(samples, data):
+    """Keep a few rows of each column, to get the types after concatenating.
+
+    When concatenating, pandas looks at the types but also at whether a
+    column is empty or all missing. One sample is kept for each of those, a
+    row with a value, a missing row, or no row.
+    """
+    for i, column in enumerate(data.columns):
+        values = data.iloc[:, i]
+        valid = values.notna().values
+        if valid.any():
+            state = 'values'
+            pos = valid.argmax()
+            sample = values.iloc[pos:pos + 1]
+        elif len(values):
+            state = 'missing'
+            sample = values.iloc[:1]
+        else:
+            state = 'empty'
+            sample = values
+        samples.setdefault(column, {}).setdefault(
+            (values.dtype, state),
+            sample.reset_index(drop=True).to_frame(),
+        )
+
+
+def _get_dtypes(samples, columns):
+    """Get the types the columns would have after concatenating.
+    """
+    return pd.Series(
+        {
+            column: pd.concat(
+                list(samples[column].values()),
+                ignore_index=True,
+            ).dtypes.iloc[0]
+            for column in columns
+        },
+        index=columns,
+        dtype=object,
+    )
+
+
+class StreamingAggregation(object):
+    """Aggregates the result of a join, one chunk at a time.
+
+    This gives the same result as concatenating the chunks and calling
+    `perform_aggregations`, but only keeps running aggregates, one value per
+    row of the original data, instead of the whole joined data. The sum and
+    count are kept to update the mean.
+
+    Sums of each chunk are added to the running sums, so float sums and
+    means are added up in a different order than with `perform_aggregations`
+    and can differ in the last digits.
+    """
+    def __init__(
+        self, original_data,
+        agg_functions=None, augment_columns_name=None,
+    ):
+        self.original_data = original_data
+        self.original_columns = list(original_data.columns)
+        self._original_columns_set = set(self.original_columns)
+        self.agg_functions = agg_functions
+        self.augment_columns_name = augment_columns_name
+        self._provided = None
+        if agg_functions:
+            self._provided = {
+                augment_columns_name[col]:
+                    [funcs] if isinstance(funcs, str) else funcs
+                for col, funcs in agg_functions.items()
+            }
+        self.columns = None
+        self._dtype_samples = {}
+        self._seen = np.zeros(len(original_data), dtype=bool)
+        self._firsts = {}
+        self._numeric = {}
+
+    def add(self, chunk):
+        """Aggregate a chunk of the joined data.
+        """
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+        _add_dtype_samples(self._dtype_samples, chunk)
+
+        # Rows from the other side only are dropped by the group-by
+        keys = chunk[UNIQUE_INDEX_KEY]
+        if keys.isna().any():
+            chunk = chunk[keys.notna().values]
+        if not len(chunk):
+            return
+        keys = chunk[UNIQUE_INDEX_KEY].values.astype(np.int64)
+
+        augment_columns = [
+            col for col in chunk.columns
+            if col != UNIQUE_INDEX_KEY
+            and col not in self._original_columns_set
+        ]
+
+        # Keep the values from the first row for the rows seen for the first
+        # time (the others were in a previous chunk)
+        first_rows = ~pd.Series(keys).duplicated().values
+        first_keys = keys[first_rows]
+        new = ~self._seen[first_keys]
+        self._seen[first_keys] = True
+        new_keys = first_keys[new]
+        for col in augment_columns:
+            if (
+                self._provided is not None
+                and 'first' not in self._provided.get(col, ())
+            ):
+                continue
+            try:
+                firsts = self._firsts[col]
+            except KeyError:
+                firsts = self._firsts[col] = np.empty(
+                    len(self._seen), dtype=object,
+                )
+            firsts[new_keys] = chunk[col].values[first_rows][new]
+
+        # Update the other aggregates from the values that are not missing,
+        # that is usually from the rows that matched. The mean is computed
+        # at the end from the sum and count
+        for col in augment_columns:
+            values = chunk[col].values
+            if self._provided is not None:
+                names = set(self._provided.get(col, ()))
+                if not names - {'first'}:
+                    continue
+            else:
+                kind = values.dtype.kind
+                if kind == 'b':
+                    # Booleans get converted if other chunks are numbers
+                    values = values.astype(np.float64)
+                elif kind not in 'iuf':
+                    continue
+                names = {'sum', 'max', 'min'}
+            valid = pd.notna(values)
+            if not valid.any():
+                continue
+            grouped = pd.Series(values[valid]).groupby(keys[valid])
+            count = grouped.size()
+            group_keys = count.index.values
+            count = count.values
+
+            state = self._numeric.setdefault(col, {})
+            if 'count' not in state:
+                state['count'] = np.zeros(len(self._seen), dtype=np.int64)
+            old_valid = state['count'][group_keys] > 0
+            state['count'][group_keys] += count
+            for name in ('sum', 'max', 'min'):
+                if name == 'sum' and not names & {'sum', 'mean'}:
+                    continue
+                elif name != 'sum' and name not in names:
+                    continue
+                new_values = getattr(grouped, name)().values
+                old_values = state.get(name)
+                if old_values is None:
+                    old_values = state[name] = np.zeros(
+                        len(self._seen), dtype=new_values.dtype,
+                    )
+                dtype = np.result_type(old_values.dtype, new_values.dtype)
+                if dtype != old_values.dtype:
+                    old_values = state[name] = old_values.astype(dtype)
+                old = old_values[group_keys]
+                if name == 'sum':
+                    combined = old + new_values
+                elif name == 'max':
+                    combined = np.maximum(old, new_values)
+                else:
+                    combined = np.minimum(old, new_values)
+                old_values[group_keys] = np.where(
+                    old_valid, combined, new_values,
+                )
+
+    def _get_values(self, col, name, dtype, rows):
+        if col == UNIQUE_INDEX_KEY:
+            values = pd.Series(rows)
+        elif col in self._original_columns_set:
+            values = pd.Series(self.original_data[col].values[rows])
+        elif name == 'first':
+            firsts = self._firsts.get(col)
+            if firsts is None:
+                # No row in any chunk
+                firsts = np.full(len(self._seen), np.nan, dtype=object)
+            values = pd.Series(firsts[rows], dtype=object)
+        else:
+            state = self._numeric.get(col)
+            if state is None:
+                # No value in any chunk
+                count = np.zeros(len(rows), dtype=np.int64)
+            else:
+                count = state['count'][rows]
+            if name == 'count':
+                return pd.Series(count)
+            if state is None:
+                values = np.full(len(rows), np.nan)
+            elif name == 'mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    values = state['sum'][rows] / count
+                dtype = np.dtype(np.float64)
+            else:
+                values = state[name][rows]
+            invalid = count == 0
+            if invalid.any():
+                if values.dtype.kind in 'iub':
+                    values = values.astype(np.float64)
+                values[invalid] = np.nan
+            values = pd.Series(values)
+        if dtype.kind in 'iufbmM' and values.dtype != dtype:
+            values = values.astype(dtype)
+        return values
+
+    def result(self):
+        """Get the aggregated data.
+        """
+        start = time.perf_counter()
+
+        dtypes = _get_dtypes(self._dtype_samples, self.columns)
+        agg_functions = _get_aggregations(
+            dtypes, self.original_columns,
+            self.agg_functions, self.augment_columns_name,
+        )
+        rows = np.flatnonzero(self._seen)
+        data = pd.DataFrame({
+            (col, name): self._get_values(col, name, dtypes[col], rows)
+            for col, names in agg_functions.items()
+            for name in names
+        })
+
+        data = _rename_aggregations(data, self.columns, agg_functions)
+
+        logger.info(
+            "Aggregations completed in %.4fs", time.perf_counter() - start,
+        )
+        return data
+
+
 CHUNK_SIZE_ROWS = 10000
 
 
+TEXT_STRUCTURAL_TYPES = {types.TEXT, types.GEO_POINT, types.GEO_POLYGON}
+
+
 def _tree_nearest(tree, max_dist):
     def transform(df):
         # Convert to numeric numpy array
@@ -373,6 +639,27 @@ def _tree_nearest(tree, max_dist):
 KEEP_COLUMN_FIELDS = {'name', 'structural_type', 'semantic_types'}
 
 
+def _read_dtypes(columns_metadata, column_indices, join_columns_idx):
+    """Get the types to read the columns of the companion dataset with.
+
+    The join columns are read as text since `set_data_index()` converts them
+    anyway. Text columns are read as text so pandas doesn't try to parse them
+    as numbers. Numerical columns are still parsed by pandas, since they can
+    have missing or invalid values.
+    """
+    join_columns_idx = set(join_columns_idx)
+    dtypes = {}
+    for idx in column_indices:
+        column = columns_metadata[idx]
+        if idx in join_columns_idx or (
+            column['structural_type'] in TEXT_STRUCTURAL_TYPES
+            # pandas recognizes booleans, keep them
+            and types.BOOLEAN not in column['semantic_types']
+        ):
+            dtypes[column['name']] = str
+    return dtypes
+
+
 def join(
     original_data, augment_data_path, original_metadata, augment_metadata,
     writer,
@@ -464,10 +751,29 @@ def join(
 
     logger.info("Performing join...")
 
+    # Only read the requested columns and the join columns
+    if columns:
+        usecols = sorted(set(columns) | set(augment_join_columns_idx))
+
+        # Transforms get the position in the columns that are read
+        positions = {idx: pos for pos, idx in enumerate(usecols)}
+        augment_columns_transform = [
+            ([positions[idx] for idx in cols], transform)
+            for cols, transform in augment_columns_transform
+        ]
+    else:
+        usecols = None
+
     # Stream the data in
     augment_data_chunks = pd.read_csv(
         augment_data_path,
         error_bad_lines=False,
+        usecols=usecols,
+        dtype=_read_dtypes(
+            augment_metadata['columns'],
+            range(len(augment_data_columns)) if usecols is None else usecols,
+            augment_join_columns_idx,
+        ),
         chunksize=CHUNK_SIZE_ROWS,
     )
     try:
@@ -475,29 +781,14 @@ def join(
     except StopIteration:
         raise AugmentationError("Empty augmentation data")
 
-    # Columns to drop
-    drop_columns = None
-    if columns:
-        drop_columns = list(
-            # Drop all the columns in augment_data
-            set(augment_data_columns[c] for c in columns)
-            # except
-            - (
-                # the requested columns
-                set(columns)
-                # and the join columns
-                | {col[0] for col in right_columns}
-            )
-        )
-
     # Defer temporal alignment until reading the first block from companion
     # (and converting it to the right data types!)
     update_idx = None
     original_data_res = None
+    aggregation = None
 
-    # Streaming join
+    # Streaming join, aggregating as we go
     start = time.perf_counter()
-    join_ = []
     # Iterate over chunks of augment data
     for augment_data in itertools.chain(
             [first_augment_data], augment_data_chunks
@@ -525,13 +816,23 @@ def join(
                 update_idx(original_data.index)
             )
 
+            # Map column names for the augmentation data
+            intersection = set(original_data.columns).intersection(
+                set(first_augment_data.columns)
+            )
+            augment_columns_map = {
+                name: name + '_r' if name in intersection else name
+                for name in first_augment_data.columns
+            }
+            aggregation = StreamingAggregation(
+                original_data,
+                agg_functions,
+                augment_columns_map,
+            )
+
         # Match temporal resolutions
         augment_data.index = update_idx(augment_data.index)
 
-        # Filter columns
-        if drop_columns:
-            augment_data = augment_data.drop(drop_columns, axis=1)
-
         # Join
         joined_chunk = original_data_res.join(
             augment_data,
@@ -542,29 +843,15 @@ def join(
         # Drop the join columns we set as index
         joined_chunk.reset_index(drop=True, inplace=True)
 
-        join_.append(joined_chunk)
+        aggregation.add(joined_chunk)
 
-    join_ = pd.concat(join_)
     logger.info("Join completed in %.4fs", time.perf_counter() - start)
 
-    intersection = set(original_data.columns).intersection(set(first_augment_data.columns))
-
     # qualities
     qualities_list = []
 
-    # map column names for the augmentation data
-    augment_columns_map = {
-        name: name + '_r' if name in intersection else name
-        for name in first_augment_data.columns
-    }
-
     # aggregations
-    join_ = perform_aggregations(
-        join_,
-        list(original_data.columns),
-        agg_functions,
-        augment_columns_map,
-    )
+    join_ = aggregation.result()
 
     # drop unique index
     join_.drop([UNIQUE_INDEX_KEY], axis=1, inplace=True)
@@ -374,7 +374,7 @@ def add_dataset_to_sup_index(es, dataset_id, metadata):
     DISCARD_DATASET_FIELDS = [
         'columns', 'sample', 'materialize',
         'spatial_coverage', 'temporal_coverage',
-        'manual_annotations',
+        'manual_annotations', 'sketches',
     ]
     DISCARD_COLUMN_FIELDS = ['plot']
 
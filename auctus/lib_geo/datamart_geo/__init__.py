@@ -1,3 +1,4 @@
+import collections
 import enum
 import gzip
 import hashlib
@@ -9,6 +10,7 @@ import sqlite3
 import tempfile
 import threading
 import unicodedata
+import weakref
 
 
 __version__ = '0.3.1'
@@ -19,6 +21,30 @@ logger = logging.getLogger(__name__)
 
 SOURCE = 'https://vida-nyu.gitlab.io/auctus/datamart-geo/info.json'
 
+NAMES_CACHE_SIZE = 100000
+"""Number of names for which the resolved areas are kept in memory"""
+
+NAMES_BATCH_SIZE = 500
+"""Number of names looked up in each query"""
+
+FUZZY_CACHE_SIZE = 10000
+"""Number of names for which the fuzzy search results are kept in memory"""
+
+AREAS_CACHE_SIZE = 100000
+"""Number of areas kept in memory to look up parents"""
+
+SHAPES_CACHE_SIZE = 1000
+"""Number of area shapes kept in memory to resolve points"""
+
+POINTS_BATCH_SIZE = 500
+"""Number of areas loaded in each query when resolving points"""
+
+POINTS_CELL_SIZE = 1.0
+"""Size in degrees of the cells in which points are grouped to query the
+spatial index"""
+
+_missing = object()
+
 
 class Type(enum.Enum):
     ADMIN_0 = 0
@@ -88,6 +114,9 @@ def _download(url, destination, sha1):
 class GeoData(object):
     def __init__(self, data_path):
         """Load the data from a local directory.
+
+        If a name index was built with :meth:`build_index`, it is used to look
+        up names, instead of the database.
         """
         self._data_path = os.path.abspath(data_path)
         db_file = os.path.join(self._data_path, 'admins.gpkg')
@@ -98,6 +127,22 @@ class GeoData(object):
             )
         self._thread_local = threading.local()
         self._ngrams = None
+        self._index = None
+        self._index_loaded = False
+        self._names_cache = collections.OrderedDict()
+        self._fuzzy_cache = collections.OrderedDict()
+        self._areas = weakref.WeakValueDictionary()
+        self._areas_by_levels = collections.OrderedDict()
+        self._shapes_cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections can't be sent to another process, only send the path
+        # and open the data again on the other side
+        return {'data_path': self._data_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['data_path'])
 
     @property
     def _database(self):
@@ -113,6 +158,45 @@ class GeoData(object):
             self._thread_local.database = database
         return database
 
+    @property
+    def _name_index(self):
+        # Load the index on first use, if it exists and is up to date
+        if not self._index_loaded:
+            index_file = os.path.join(self._data_path, 'admins.index')
+            if os.path.exists(index_file):
+                from .index import NameIndex
+
+                index = NameIndex(index_file)
+                if index.matches_database(
+                    os.path.join(self._data_path, 'admins.gpkg'),
+                ):
+                    self._index = index
+                else:
+                    logger.warning(
+                        "Name index is outdated, rebuild it with "
+                        + "build_index()"
+                    )
+            self._index_loaded = True
+        return self._index
+
+    def build_index(self):
+        """Build the name index, to look up names without the database.
+
+        The index is a file in the data directory, that is memory-mapped and
+        shared between processes.
+        """
+        from .index import build_index
+
+        logger.info("Building name index...")
+        build_index(
+            self._database,
+            os.path.join(self._data_path, 'admins.gpkg'),
+            os.path.join(self._data_path, 'admins.index'),
+        )
+        self._index = None
+        self._index_loaded = False
+        logger.info("Built name index")
+
     @staticmethod
     def get_local_cache_path():
         """Get the path to the cache directory.
@@ -180,6 +264,9 @@ class GeoData(object):
                 os.remove(os.path.join(destination, 'state.json'))
 
         # Download data
+        if os.path.exists(os.path.join(destination, 'admins.index')):
+            # The index would be outdated, it needs to be built again
+            os.remove(os.path.join(destination, 'admins.index'))
         logger.info("Downloading data to %s...", destination)
         _download(
             info['data']['admins.gpkg']['url'],
@@ -210,6 +297,54 @@ class GeoData(object):
         return None
 
     def resolve_name_all(self, name):
+        yield from self.resolve_names_all([name])[0]
+
+    def _make_area_from_cursor(self, cur):
+        for row in cur:
+            return self._make_area_from_row(row)
+        return None
+
+    def _make_area_from_row(self, row):
+        # Only one Area object exists for a given id at a time
+        area = self._areas.get(row[0])
+        if area is not None:
+            return area
+
+        id, name, level, latitude, longitude = row[:5]
+        levels = row[5:11]
+        bounds = row[11:15]
+        if any(n is None for n in bounds):
+            bounds = None
+        type = Type(level)
+        area = Area(
+            self, id, name, type, levels,
+            latitude, longitude, bounds,
+        )
+        return self._areas.setdefault(id, area)
+
+    def _get_area_from_levels(self, levels):
+        """Get the area with the given levels (country, admin1, ...).
+
+        Results are kept in a cache of `AREAS_CACHE_SIZE` areas, so walking
+        up the hierarchy only queries the database once for each parent.
+        """
+        levels = tuple(levels)
+        cache = self._areas_by_levels
+        with self._cache_lock:
+            area = cache.get(levels, _missing)
+            if area is not _missing:
+                cache.move_to_end(levels)
+                return area
+
+        field_names = [
+            'country', 'admin1', 'admin2',
+            'admin3', 'admin4', 'admin5',
+        ]
+        # Build the where clause: match all levels
+        where = ' AND '.join(
+            '{field}=?'.format(field=field_names[i])
+            for i in range(len(levels))
+        )
         cur = self._database.execute(
             '''
             SELECT
@@ -219,52 +354,123 @@ class GeoData(object):
             FROM admins
             LEFT OUTER JOIN rtree_admins_shape
                 ON admins.id = rtree_admins_shape.id
-            WHERE admins.id IN (SELECT id FROM names WHERE name = ?);
-            ''',
-            (normalize(name),),
+            WHERE level={level} AND {where};
+            '''.format(level=len(levels) - 1, where=where),
+            levels,
         )
-        while True:
-            area = self._make_area_from_cursor(cur)
-            if area is None:
-                break
-            yield area
+        area = self._make_area_from_cursor(cur)
+
+        with self._cache_lock:
+            cache[levels] = area
+            while len(cache) > AREAS_CACHE_SIZE:
+                cache.popitem(last=False)
+        return area
+
+    def _query_names(self, names):
+        # Look up normalized names, returns a dict name -> list of areas
+        index = self._name_index
+        if index is not None:
+            return {
+                name: [
+                    self._make_area_from_row(row)
+                    for row in index.lookup(name)
+                ]
+                for name in names
+            }
 
-    def _make_area_from_cursor(self, cur):
-        for row in cur:
-            id, name, level, latitude, longitude = row[:5]
-            levels = row[5:11]
-            bounds = row[11:15]
-            if any(n is None for n in bounds):
-                bounds = None
-            type = Type(level)
-            return Area(
-                self, id, name, type, levels,
-                latitude, longitude, bounds,
+        results = {name: [] for name in names}
+        for start in range(0, len(names), NAMES_BATCH_SIZE):
+            batch = names[start:start + NAMES_BATCH_SIZE]
+            cur = self._database.execute(
+                '''
+                SELECT DISTINCT
+                    names.name,
+                    admins.id, admins.name, level, latitude, longitude,
+                    country, admin1, admin2, admin3, admin4, admin5,
+                    minx, maxx, miny, maxy
+                FROM names
+                INNER JOIN admins ON admins.id = names.id
+                LEFT OUTER JOIN rtree_admins_shape
+                    ON admins.id = rtree_admins_shape.id
+                WHERE names.name IN ({params})
+                ORDER BY admins.id;
+                '''.format(params=', '.join('?' * len(batch))),
+                batch,
             )
-        return None
+            for row in cur:
+                results[row[0]].append(self._make_area_from_row(row[1:]))
+        return results
 
     def resolve_names(self, names):
-        # Might be something faster in the future
-        return [self.resolve_name(name) for name in names]
+        return [
+            areas[0] if areas else None
+            for areas in self.resolve_names_all(names)
+        ]
 
     def resolve_names_all(self, names):
-        # Might be something faster in the future
-        return [list(self.resolve_name_all(name)) for name in names]
+        """Get all the areas matching each name.
 
-    def resolve_name_fuzzy(self, name, threshold=0.3):
-        # Open ngrams database
-        if self._ngrams is None:
-            import ngram_search
-            self._ngrams = ngram_search.Ngrams(
-                os.path.join(self._data_path, 'admins.names.trie')
+        Names are looked up in batches, and the results are kept in a cache of
+        `NAMES_CACHE_SIZE` names.
+        """
+        names = [normalize(name) for name in names]
+        cache = self._names_cache
+        results = {}
+        with self._cache_lock:
+            for name in names:
+                if name not in results and name in cache:
+                    cache.move_to_end(name)
+                    results[name] = cache[name]
+
+        missing = list(set(names).difference(results))
+        if missing:
+            found = self._query_names(missing)
+            results.update(found)
+            with self._cache_lock:
+                cache.update(found)
+                while len(cache) > NAMES_CACHE_SIZE:
+                    cache.popitem(last=False)
+
+        return [list(results[name]) for name in names]
+
+    def _get_shapes(self, ids):
+        # Get the parsed shapes of areas, returns a dict id -> rings (or
+        # None if the area has no shape)
+        from .shapes import parse_shape
+
+        cache = self._shapes_cache
+        results = {}
+        with self._cache_lock:
+            for id in ids:
+                if id in cache:
+                    cache.move_to_end(id)
+                    results[id] = cache[id]
+
+        missing = [id for id in ids if id not in results]
+        found = {}
+        for start in range(0, len(missing), POINTS_BATCH_SIZE):
+            batch = missing[start:start + POINTS_BATCH_SIZE]
+            cur = self._database.execute(
+                '''
+                SELECT id, shape FROM admins
+                WHERE id IN ({params});
+                '''.format(params=', '.join('?' * len(batch))),
+                batch,
             )
+            for id, shape in cur:
+                found[id] = parse_shape(shape) if shape else None
+        results.update(found)
+        with self._cache_lock:
+            cache.update(found)
+            while len(cache) > SHAPES_CACHE_SIZE:
+                cache.popitem(last=False)
+        return results
 
-        # Execute fuzzy search with ngrams
-        hits = self._ngrams.search(name, threshold)
-
-        # Build results
-        results = []
-        for name_id, score in hits:
+    def _get_areas(self, ids):
+        # Get areas by id, returns a dict id -> area
+        results = {}
+        for start in range(0, len(ids), POINTS_BATCH_SIZE):
+            batch = ids[start:start + POINTS_BATCH_SIZE]
             cur = self._database.execute(
                 '''
                 SELECT
@@ -274,16 +480,185 @@ class GeoData(object):
                 FROM admins
                 LEFT OUTER JOIN rtree_admins_shape
                     ON admins.id = rtree_admins_shape.id
-                WHERE admins.id = (SELECT id FROM names WHERE name_id = ?);
+                WHERE admins.id IN ({params});
+                '''.format(params=', '.join('?' * len(batch))),
+                batch,
+            )
+            for row in cur:
+                results[row[0]] = self._make_area_from_row(row)
+        return results
+
+    def resolve_points(self, points):
+        """Get the areas containing each point, at each level.
+
+        Points are grouped in cells of `POINTS_CELL_SIZE` degrees. The
+        bounding boxes intersecting each cell are read from the spatial index
+        of the database and tested against all the points of the cell at
+        once, then each candidate area's shape is tested against all its
+        candidate points at once. Areas without a shape are
+        matched on their bounding box only. This needs numpy.
+
+        :param points: An array of shape (N, 2) of latitudes and longitudes
+        :return: A list with, for each point, a list of 6 areas (country,
+            admin1, ..., admin5), with ``None`` for levels where no area
+            contains the point
+        """
+        import numpy
+        from .shapes import PIP_BLOCK_SIZE, points_in_rings
+
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        if not len(points):
+            return []
+        unique, inverse = numpy.unique(points, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        # Group the points by cell
+        positions = numpy.nonzero(~numpy.isnan(unique).any(axis=1))[0]
+        cells, cell_inverse = numpy.unique(
+            numpy.floor(unique[positions] / POINTS_CELL_SIZE),
+            axis=0, return_inverse=True,
+        )
+        cell_inverse = cell_inverse.reshape(-1)
+        order = numpy.argsort(cell_inverse, kind='stable')
+        splits = numpy.cumsum(numpy.bincount(cell_inverse))[:-1]
+        cell_positions = numpy.split(positions[order], splits)
+
+        # Find candidate areas from the bounding boxes
+        candidates = collections.defaultdict(list)
+        for (cell_lat, cell_long), cell_pos in zip(
+            (cells * POINTS_CELL_SIZE).tolist(), cell_positions,
+        ):
+            cur = self._database.execute(
+                '''
+                SELECT id, minx, maxx, miny, maxy FROM rtree_admins_shape
+                WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?;
                 ''',
-                (name_id,),
+                (
+                    cell_long + POINTS_CELL_SIZE, cell_long,
+                    cell_lat + POINTS_CELL_SIZE, cell_lat,
+                ),
+            )
+            boxes = cur.fetchall()
+            if not boxes:
+                continue
+            box_ids = [box[0] for box in boxes]
+            boxes = numpy.array(boxes, dtype=numpy.float64)
+            block = max(1, PIP_BLOCK_SIZE // len(boxes))
+            for start in range(0, len(cell_pos), block):
+                block_pos = cell_pos[start:start + block]
+                lat = unique[block_pos, 0, None]
+                long = unique[block_pos, 1, None]
+                point_idx, box_idx = numpy.nonzero(
+                    (boxes[:, 1] <= long) & (long <= boxes[:, 2])
+                    & (boxes[:, 3] <= lat) & (lat <= boxes[:, 4])
+                )
+                for p, b in zip(block_pos[point_idx].tolist(),
+                                box_idx.tolist()):
+                    candidates[box_ids[b]].append(p)
+
+        # Test the points against the shapes, by order of id so that the
+        # result is deterministic if areas overlap
+        ids = sorted(candidates)
+        areas = self._get_areas(ids)
+        shapes = self._get_shapes(ids)
+        unique_results = [[None] * 6 for _ in range(len(unique))]
+        for id in ids:
+            area = areas.get(id)
+            if area is None:
+                continue
+            positions = candidates[id]
+            rings = shapes.get(id)
+            if rings is not None:
+                # Shapes are in longitude, latitude order
+                inside = points_in_rings(rings, unique[positions, ::-1])
+                positions = [
+                    pos for pos, is_in in zip(positions, inside) if is_in
+                ]
+            level = area.type.value
+            for pos in positions:
+                if unique_results[pos][level] is None:
+                    unique_results[pos][level] = area
+
+        return [list(unique_results[i]) for i in inverse.tolist()]
+
+    def resolve_name_fuzzy(self, name, threshold=0.3):
+        return self.resolve_names_fuzzy([name], threshold)[0]
+
+    def _query_name_ids(self, name_ids):
+        # Look up areas from the ids of their names, returns a dict
+        # name_id -> area
+        results = {}
+        for start in range(0, len(name_ids), NAMES_BATCH_SIZE):
+            batch = name_ids[start:start + NAMES_BATCH_SIZE]
+            cur = self._database.execute(
+                '''
+                SELECT
+                    names.name_id,
+                    admins.id, admins.name, level, latitude, longitude,
+                    country, admin1, admin2, admin3, admin4, admin5,
+                    minx, maxx, miny, maxy
+                FROM names
+                INNER JOIN admins ON admins.id = names.id
+                LEFT OUTER JOIN rtree_admins_shape
+                    ON admins.id = rtree_admins_shape.id
+                WHERE names.name_id IN ({params});
+                '''.format(params=', '.join('?' * len(batch))),
+                batch,
             )
-            results.append((score, self._make_area_from_cursor(cur)))
+            for row in cur:
+                results[row[0]] = self._make_area_from_row(row[1:])
         return results
 
-    def resolve_names_fuzzy(self, names):
-        # Might be something faster in the future
-        return [self.resolve_name_fuzzy(name) for name in names]
+    def resolve_names_fuzzy(self, names, threshold=0.3):
+        """Get the areas with names similar to each name, with their score.
+
+        The n-gram search is run for each name, then the areas of all the hits
+        are looked up together. The results are kept in a cache of
+        `FUZZY_CACHE_SIZE` names.
+        """
+        # Open ngrams database
+        if self._ngrams is None:
+            import ngram_search
+            self._ngrams = ngram_search.Ngrams(
+                os.path.join(self._data_path, 'admins.names.trie')
+            )
+
+        keys = [(name, threshold) for name in names]
+        cache = self._fuzzy_cache
+        results = {}
+        with self._cache_lock:
+            for key in keys:
+                if key not in results and key in cache:
+                    cache.move_to_end(key)
+                    results[key] = cache[key]
+
+        # Execute fuzzy search with ngrams
+        hits = {}
+        for key in keys:
+            if key not in results and key not in hits:
+                hits[key] = self._ngrams.search(*key)
+
+        if hits:
+            # Build results
+            areas = self._query_name_ids(list({
+                name_id
+                for key_hits in hits.values()
+                for name_id, _ in key_hits
+            }))
+            found = {
+                key: [
+                    (score, areas.get(name_id))
+                    for name_id, score in key_hits
+                ]
+                for key, key_hits in hits.items()
+            }
+            results.update(found)
+            with self._cache_lock:
+                cache.update(found)
+                while len(cache) > FUZZY_CACHE_SIZE:
+                    cache.popitem(last=False)
+
+        return [list(results[key]) for key in keys]
 
 
 class Area(object):
@@ -338,29 +713,7 @@ class Area(object):
         return hash(self.id)
 
     def _get_area_from_levels(self, levels):
-        field_names = [
-            'country', 'admin1', 'admin2',
-            'admin3', 'admin4', 'admin5',
-        ]
-        # Build the where clause: match all levels
-        where = ' AND '.join(
-            '{field}=?'.format(field=field_names[i])
-            for i in range(len(levels))
-        )
-        cur = self._geodata._database.execute(
-            '''
-            SELECT
-                admins.id, name, level, latitude, longitude,
-                country, admin1, admin2, admin3, admin4, admin5,
-                minx, maxx, miny, maxy
-            FROM admins
-            LEFT OUTER JOIN rtree_admins_shape
-                ON admins.id = rtree_admins_shape.id
-            WHERE level={level} AND {where};
-            '''.format(level=len(levels) - 1, where=where),
-            levels,
-        )
-        return self._geodata._make_area_from_cursor(cur)
+        return self._geodata._get_area_from_levels(levels)
 
     def get_parent_area(self, level=None):
         if level is None:
@@ -0,0 +1,261 @@
+"""Compact index of the area names, that can be memory-mapped.
+
+The index is a single file holding arrays: the hashes of the normalized names
+(sorted), the area each of them points to, and for the areas, their name,
+type, levels, location and bounds. Looking up names is a binary search, with
+no SQL, and processes opening the same file share the memory.
+"""
+
+import array
+import bisect
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+
+MAGIC = b'DMGEOIDX'
+VERSION = 1
+
+_ALIGN = 8
+
+STRINGS_CACHE_SIZE = 100000
+"""Number of decoded area names and level codes kept in memory"""
+
+# Type codes of the arrays in the file
+_ARRAYS = [
+    ('name_hashes', 'Q'),
+    ('name_areas', 'i'),
+    ('name_offsets', 'q'),
+    ('name_data', 'B'),
+    ('ids', 'q'),
+    ('area_names', 'i'),
+    ('types', 'b'),
+    ('coords', 'd'),  # latitude, longitude
+    ('levels', 'i'),  # country, admin1, ..., admin5
+    ('bounds', 'd'),  # minx, maxx, miny, maxy
+    ('string_offsets', 'q'),
+    ('string_data', 'B'),
+]
+
+
+def hash_name(name):
+    """Hash a normalized name to a 64-bit integer, the same in every process.
+    """
+    return int.from_bytes(
+        hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(),
+        'little',
+    )
+
+
+def _encode_strings(strings):
+    # Concatenate UTF-8 strings, returns (offsets, data)
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = array.array('q', [0])
+    total = 0
+    for b in encoded:
+        total += len(b)
+        offsets.append(total)
+    return offsets, array.array('B', b''.join(encoded))
+
+
+def _database_stamp(database_path):
+    # The size and the SQLite header, which has a change counter, identify
+    # the version of the database even if it is copied elsewhere
+    with open(database_path, 'rb') as fp:
+        header = fp.read(100)
+    return [os.path.getsize(database_path), header.hex()]
+
+
+def build_index(database, database_path, path):
+    """Build the index from the admins database.
+
+    :param database: An open SQLite connection to ``admins.gpkg``
+    :param database_path: The path to the database, recorded so an outdated
+        index is not used
+    :param path: Where to write the index
+    """
+    arrays = {key: array.array(typecode) for key, typecode in _ARRAYS}
+    strings = {}
+
+    def string_idx(s):
+        if s is None:
+            return -1
+        return strings.setdefault(s, len(strings))
+
+    # Load the areas, ordered by id
+    cur = database.execute(
+        '''
+        SELECT
+            admins.id, name, level, latitude, longitude,
+            country, admin1, admin2, admin3, admin4, admin5,
+            minx, maxx, miny, maxy
+        FROM admins
+        LEFT OUTER JOIN rtree_admins_shape
+            ON admins.id = rtree_admins_shape.id
+        ORDER BY admins.id;
+        '''
+    )
+    positions = {}
+    for row in cur:
+        positions[row[0]] = len(arrays['ids'])
+        arrays['ids'].append(row[0])
+        arrays['area_names'].append(string_idx(row[1]))
+        arrays['types'].append(row[2])
+        arrays['coords'].extend(
+            math.nan if c is None else c for c in row[3:5]
+        )
+        arrays['levels'].extend(string_idx(s) for s in row[5:11])
+        if any(c is None for c in row[11:15]):
+            arrays['bounds'].extend([math.nan] * 4)
+        else:
+            arrays['bounds'].extend(row[11:15])
+
+    # Load the names, pointing to the position of the area in the arrays,
+    # sorted by hash then by area (same order as the ids)
+    cur = database.execute(
+        '''
+        SELECT DISTINCT name, id FROM names;
+        '''
+    )
+    names = sorted(
+        (hash_name(name), positions[id], name)
+        for name, id in cur
+        # Drop names of areas that don't exist, like the join would
+        if id in positions
+    )
+    for name_hash, position, _ in names:
+        arrays['name_hashes'].append(name_hash)
+        arrays['name_areas'].append(position)
+    arrays['name_offsets'], arrays['name_data'] = _encode_strings(
+        name for _, _, name in names
+    )
+    arrays['string_offsets'], arrays['string_data'] = _encode_strings(
+        strings
+    )
+
+    # Write the header and the arrays
+    header = {
+        'database': _database_stamp(database_path),
+        'byteorder': sys.byteorder,
+        'arrays': {},
+    }
+    offset = 0
+    for key, _ in _ARRAYS:
+        nbytes = len(arrays[key]) * arrays[key].itemsize
+        header['arrays'][key] = {'offset': offset, 'nbytes': nbytes}
+        offset += -(-nbytes // _ALIGN) * _ALIGN
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % _ALIGN)
+
+    # Write to a temporary file and rename, so it is never read incomplete
+    tmp = tempfile.mktemp(dir=os.path.dirname(path))
+    try:
+        with open(tmp, 'wb') as fp:
+            fp.write(MAGIC)
+            fp.write(struct.pack('<II', VERSION, len(header)))
+            fp.write(header)
+            for key, _ in _ARRAYS:
+                data = arrays[key].tobytes()
+                fp.write(data)
+                fp.write(b'\0' * (-len(data) % _ALIGN))
+        os.rename(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class NameIndex(object):
+    """Index of the area names, memory-mapped from a file.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            magic = fp.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("Not a datamart-geo index")
+            version, header_len = struct.unpack('<II', fp.read(8))
+            if version != VERSION:
+                raise ValueError("Unsupported index version %d" % version)
+            header = json.loads(fp.read(header_len).decode('utf-8'))
+            if header['byteorder'] != sys.byteorder:
+                raise ValueError("Index was built on a different platform")
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.database_stamp = header['database']
+        self._strings = {}
+        start = len(MAGIC) + 8 + header_len
+        view = memoryview(self._mmap)
+        self._data_offsets = {}
+        for key, typecode in _ARRAYS:
+            info = header['arrays'][key]
+            offset = start + info['offset']
+            self._data_offsets[key] = offset
+            setattr(
+                self, key,
+                view[offset:offset + info['nbytes']].cast(typecode),
+            )
+
+    def matches_database(self, database_path):
+        """Check that the index was built from this version of the database.
+        """
+        return self.database_stamp == _database_stamp(database_path)
+
+    def _get_string(self, key, idx):
+        # Read a string from a table, by index
+        offsets = getattr(self, key + '_offsets')
+        base = self._data_offsets[key + '_data']
+        return self._mmap[base + offsets[idx]:base + offsets[idx + 1]]
+
+    def _get_row(self, i):
+        # Build a row like what the SQL queries return
+        strings = self._strings
+        string_offsets = self.string_offsets
+        base = self._data_offsets['string_data']
+        names = []
+        for idx in [self.area_names[i], *self.levels[i * 6:i * 6 + 6]]:
+            if idx < 0:
+                names.append(None)
+                continue
+            string = strings.get(idx)
+            if string is None:
+                string = self._mmap[
+                    base + string_offsets[idx]:base + string_offsets[idx + 1]
+                ].decode('utf-8')
+                if len(strings) < STRINGS_CACHE_SIZE:
+                    strings[idx] = string
+            names.append(string)
+        latitude, longitude = [
+            None if math.isnan(c) else c
+            for c in self.coords[i * 2:i * 2 + 2].tolist()
+        ]
+        bounds = self.bounds[i * 4:i * 4 + 4].tolist()
+        if math.isnan(bounds[0]):
+            bounds = [None] * 4
+        return (
+            self.ids[i], names[0], self.types[i], latitude, longitude,
+            *names[1:], *bounds,
+        )
+
+    def lookup(self, name):
+        """Look up a normalized name.
+
+        :return: A list of rows for the matching areas, in the same format as
+            the SQL queries, ordered by area id
+        """
+        name_hash = hash_name(name)
+        encoded = name.encode('utf-8')
+        j = bisect.bisect_left(self.name_hashes, name_hash)
+        rows = []
+        while (
+            j < len(self.name_hashes)
+            and self.name_hashes[j] == name_hash
+        ):
+            # Check the name itself, in case of hash collisions
+            if self._get_string('name', j) == encoded:
+                rows.append(self._get_row(self.name_areas[j]))
+            j += 1
+        return rows
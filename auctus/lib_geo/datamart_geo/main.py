@@ -25,5 +25,13 @@ def main():
         action='store_true',
         default=False,
     )
+    parser.add_argument(
+        '--build-index',
+        action='store_true',
+        default=False,
+        help="build the name index, to look up names without SQL",
+    )
     args = parser.parse_args()
-    GeoData.download(args.directory, update=args.update)
+    geo_data = GeoData.download(args.directory, update=args.update)
+    if args.build_index:
+        geo_data.build_index()
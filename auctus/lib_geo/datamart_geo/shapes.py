@@ -0,0 +1,119 @@
+"""Reading the shapes of the areas, and testing points against them.
+
+This needs numpy.
+"""
+
+import numpy
+import struct
+
+
+PIP_BLOCK_SIZE = 1 << 20
+"""Number of point-edge pairs tested at once, to bound memory use"""
+
+# Size of the envelope in the GeoPackage header, by indicator
+_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+def parse_shape(blob):
+    """Read a polygon or multipolygon, from GeoPackage binary or plain WKB.
+
+    :return: A list of rings, each an array of shape (N, 2) of longitudes
+        and latitudes. Holes are rings like the others, they are handled by
+        the even-odd rule.
+    """
+    blob = bytes(blob)
+    offset = 0
+    if blob[:2] == b'GP':
+        flags = blob[3]
+        if flags & 0x10:  # Empty geometry
+            return []
+        offset = 8 + _ENVELOPE_SIZES[(flags >> 1) & 0x07]
+    rings = []
+    _read_wkb(blob, offset, rings)
+    return rings
+
+
+def _read_wkb(blob, offset, rings):
+    # Read one geometry, add its rings to the list, returns the new offset
+    byteorder = '<' if blob[offset] == 1 else '>'
+    geom_type, = struct.unpack_from(byteorder + 'I', blob, offset + 1)
+    offset += 5
+
+    # Extended WKB flags
+    dims = 2
+    if geom_type & 0x80000000:  # Z
+        dims += 1
+    if geom_type & 0x40000000:  # M
+        dims += 1
+    if geom_type & 0x20000000:  # SRID
+        offset += 4
+    geom_type &= 0x0FFFFFFF
+    # ISO WKB: 1000 for Z, 2000 for M, 3000 for ZM
+    dims += (0, 1, 1, 2)[geom_type // 1000]
+    geom_type %= 1000
+
+    if geom_type == 3:  # Polygon
+        nb_rings, = struct.unpack_from(byteorder + 'I', blob, offset)
+        offset += 4
+        for _ in range(nb_rings):
+            nb_points, = struct.unpack_from(byteorder + 'I', blob, offset)
+            offset += 4
+            ring = numpy.frombuffer(
+                blob, dtype=byteorder + 'f8',
+                count=nb_points * dims, offset=offset,
+            )
+            rings.append(ring.reshape(nb_points, dims)[:, :2])
+            offset += nb_points * dims * 8
+    elif geom_type in (6, 7):  # MultiPolygon, GeometryCollection
+        nb_geoms, = struct.unpack_from(byteorder + 'I', blob, offset)
+        offset += 4
+        for _ in range(nb_geoms):
+            offset = _read_wkb(blob, offset, rings)
+    else:
+        raise ValueError("Unsupported geometry type %d" % geom_type)
+    return offset
+
+
+def points_in_rings(rings, points):
+    """Test which points are inside a shape, using the even-odd rule.
+
+    :param rings: The rings of the shape, as returned by `parse_shape`
+    :param points: An array of shape (N, 2) of longitudes and latitudes
+    :return: An array of N booleans
+    """
+    points = numpy.asarray(points, dtype=numpy.float64)
+    inside = numpy.zeros(len(points), dtype=bool)
+    if not len(points):
+        return inside
+    px = points[:, 0]
+    py = points[:, 1]
+    for ring in rings:
+        x1 = ring[:, 0]
+        y1 = ring[:, 1]
+        x2 = numpy.roll(x1, -1)
+        y2 = numpy.roll(y1, -1)
+
+        # Only keep the edges that a horizontal line through a point crosses
+        keep = (
+            (y1 != y2)
+            & (numpy.maximum(y1, y2) >= py.min())
+            & (numpy.minimum(y1, y2) <= py.max())
+        )
+        if not keep.any():
+            continue
+        x1, y1, x2, y2 = x1[keep], y1[keep], x2[keep], y2[keep]
+        slope = (x2 - x1) / (y2 - y1)
+
+        # Count the edges crossed by a ray going east from each point
+        block = max(1, PIP_BLOCK_SIZE // len(x1))
+        for start in range(0, len(points), block):
+            bx = px[start:start + block, None]
+            by = py[start:start + block, None]
+            crosses = (
+                ((y1 > by) != (y2 > by))
+                & (bx < x1 + (by - y1) * slope)
+            )
+            inside[start:start + block] ^= (
+                crosses.sum(axis=1) % 2 == 1
+            )
+    return inside
@@ -12,7 +12,7 @@ setup(name='datamart-geo',
       version='0.3.1',
       packages=['datamart_geo'],
       install_requires=['requests'],
-      extras_require={'fuzzy': ['ngram-search']},
+      extras_require={'fuzzy': ['ngram-search'], 'points': ['numpy']},
       description="Geographical location data",
       author="Remi Rampin",
       author_email='remi.rampin@nyu.edu',
@@ -1,3 +1,4 @@
+import os
 import unittest
 
 import datamart_geo
@@ -54,6 +55,14 @@ class TestGeoData(unittest.TestCase):
             (-178.3874, 172.3057, -50.2187, 51.3056),
         )
 
+        # Parents are only looked up once, and areas are shared
+        self.assertIs(a_cuers.get_parent_area(), a_toulon)
+        self.assertIs(
+            a_toulon.get_parent_area(datamart_geo.Type.COUNTRY),
+            a_france,
+        )
+        self.assertIs(self.geo_data.resolve_name('France'), a_france)
+
     def test_get_all(self):
         self.assertEqual(
             [
@@ -76,6 +85,76 @@ class TestGeoData(unittest.TestCase):
             ],
         )
 
+    def test_get_all_batch(self):
+        names = ['Var', 'Cuers', 'not a place', 'var', 'France']
+        expected = [
+            [repr(a) for a in self.geo_data.resolve_name_all(name)]
+            for name in names
+        ]
+        self.assertEqual(
+            [
+                [repr(a) for a in areas]
+                for areas in self.geo_data.resolve_names_all(names)
+            ],
+            expected,
+        )
+        self.assertEqual(len(expected[0]), 3)
+        self.assertEqual(expected[2], [])
+        self.assertEqual(expected[3], expected[0])
+
+        # Cached results are not shared
+        self.geo_data.resolve_names_all(names)[0].clear()
+        self.assertEqual(len(self.geo_data.resolve_names_all(['Var'])[0]), 3)
+
+    def test_index(self):
+        def describe(areas):
+            return [
+                (
+                    a.id, a.name, a.type, a.levels,
+                    a.latitude, a.longitude, a.bounds,
+                )
+                for a in areas
+            ]
+
+        names = ['Var', 'Cuers', 'not a place', 'France']
+        expected = [
+            describe(areas)
+            for areas in self.geo_data.resolve_names_all(names)
+        ]
+
+        self.geo_data.build_index()
+        try:
+            geo_data = datamart_geo.GeoData('data')
+            self.assertIsNotNone(geo_data._name_index)
+            self.assertEqual(
+                [
+                    describe(areas)
+                    for areas in geo_data.resolve_names_all(names)
+                ],
+                expected,
+            )
+        finally:
+            os.remove(os.path.join('data', 'admins.index'))
+
+    def test_points(self):
+        results = self.geo_data.resolve_points([
+            (43.2375, 6.07083),  # Cuers
+            (40.0, -40.0),  # Atlantic Ocean
+            (43.2375, 6.07083),
+        ])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(
+            [repr(a) for a in results[0][:3]],
+            [
+                '<datamart_geo.Area "Republic of France" (3017382) type=Type.ADMIN_0>',
+                '<datamart_geo.Area "Provence-Alpes-Côte d\'Azur" (2985244) type=Type.ADMIN_1>',
+                '<datamart_geo.Area "Var" (2970749) type=Type.ADMIN_2>',
+            ],
+        )
+        self.assertEqual(results[1], [None] * 6)
+        self.assertEqual(results[2], results[0])
+        self.assertIsNot(results[2], results[0])
+
     def test_fuzzy(self):
         # Fuzzy search for an area
         hits = self.geo_data.resolve_name_fuzzy('cuerss')
@@ -100,6 +179,36 @@ class TestGeoData(unittest.TestCase):
             ],
         )
 
+    def test_fuzzy_batch(self):
+        names = ['cuerss', 'not a place at all', 'Cuerss', 'cuerss']
+        results = self.geo_data.resolve_names_fuzzy(names)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(
+            results[0][0][1],
+            self.geo_data.resolve_name('Cuers'),
+        )
+        self.assertEqual(results[3], results[0])
+        self.assertEqual(
+            results,
+            [self.geo_data.resolve_name_fuzzy(name) for name in names],
+        )
+
+        # Names are searched as given, like one at a time
+        self.assertEqual(
+            [[score for score, _ in hits] for hits in results],
+            [
+                [score for _, score in self.geo_data._ngrams.search(name, 0.3)]
+                for name in names
+            ],
+        )
+
+        # Cached results are not shared
+        results[0].clear()
+        self.assertEqual(
+            len(self.geo_data.resolve_name_fuzzy('cuerss')),
+            12,
+        )
+
 
 if __name__ == '__main__':
     unittest.main()
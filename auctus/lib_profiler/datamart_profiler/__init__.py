@@ -1,8 +1,10 @@
 from .core import count_rows_to_skip, process_dataset
+from .incremental import merge_profiles, profile_increment
 from .temporal import parse_date
 
 
 __version__ = '0.11'
 
 
-__all__ = ['count_rows_to_skip', 'process_dataset', 'parse_date']
+__all__ = ['count_rows_to_skip', 'process_dataset', 'merge_profiles',
+           'profile_increment', 'parse_date']
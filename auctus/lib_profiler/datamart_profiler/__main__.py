@@ -74,6 +74,14 @@ def main():
     parser.add_argument('--load-max-size', action='store', nargs=1,
                         help="target size of the data to be analyzed. The "
                              "data will be randomly sampled if it is bigger")
+    parser.add_argument('--full-scan',
+                        action='store_true', default=False, dest='full_scan',
+                        help="read all the data to compute counts and ranges, "
+                             "in bounded memory, instead of only the sample")
+    parser.add_argument('-j', '--workers', action='store', type=int,
+                        default=None, dest='workers',
+                        help="number of processes to use to profile columns "
+                             "in parallel")
     parser.add_argument('file', nargs=1, help="file to profile")
     if detect_format_convert_to_csv is None:
         parser.add_argument(
@@ -174,6 +182,8 @@ def main():
                 coverage=args.coverage,
                 plots=args.plots,
                 load_max_size=load_max_size,
+                workers=args.workers,
+                full_scan=args.full_scan,
             )
         except (pandas.errors.ParserError, UnicodeError):
             if detect_format_convert_to_csv is None:
@@ -1,11 +1,14 @@
 import codecs
 import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import contextlib
 import csv
 from datetime import datetime
+import heapq
+import io
 import itertools
 import logging
-import math
+import multiprocessing
 import numpy
 import opentelemetry.trace
 import os
@@ -13,15 +16,19 @@ import pandas
 from pandas.errors import EmptyDataError
 import prometheus_client
 import string
+import sys
 import time
 import random
 import re
 import warnings
 
 from .numerical import mean_stddev, get_numerical_ranges
-from .profile_types import identify_types, determine_dataset_type
-from .spatial import LatLongColumn, Geohasher, nominatim_resolve_all, \
-    pair_latlong_columns, get_spatial_ranges, parse_wkt_column
+from .profile_types import ColumnView, identify_types, \
+    determine_dataset_type, native_values
+from .sketches import SKETCHES_VERSION, build_column_sketch
+from .spatial import LatLongColumn, Geohasher, NominatimCache, \
+    get_admin_coverage, nominatim_resolve_all, pair_latlong_columns, \
+    get_spatial_ranges, parse_wkt_column
 from .temporal import get_temporal_resolution
 from . import types
 
@@ -35,6 +42,12 @@ RANDOM_SEED = 89
 MAX_SIZE = 5000000  # 5 MB
 SAMPLE_ROWS = 20
 
+SAMPLE_CHUNKS = 100
+"""Number of places in a big file from which rows are read when sampling"""
+
+MAX_RESYNC_LINES = 100
+"""Lines to try before giving up on finding a row in a sampled chunk"""
+
 MAX_UNCLEAN_ADDRESSES = 0.20  # 20%
 
 
@@ -47,6 +60,15 @@ HEADER_CONSISTENT_ROWS = 4
 
 MAX_GEOHASHES = 100
 
+LAZO_WORKERS = 4
+"""Maximum number of concurrent requests to the Lazo server"""
+
+LAZO_RETRIES = 3
+"""Number of times a failed request to the Lazo server is retried"""
+
+LAZO_BACKOFF = 0.5
+"""Delay before retrying a request to Lazo, in seconds, doubled every time"""
+
 
 BUCKETS = [
     1.0, 2.0, 4.0, 7.0, 12.0, 20.0, 32.0, 52.0, 80.0, 120.0, 190.0,
@@ -125,13 +147,44 @@ def expand_attribute_name(name):
 
 def _lazo_retry(func):
     from lazo_index_service.errors import LazoError
-    try:
-        return func()
-    except LazoError:
-        pass
+    for attempt in range(LAZO_RETRIES):
+        try:
+            return func()
+        except LazoError:
+            delay = LAZO_BACKOFF * 2 ** attempt
+            logger.warning("Error from Lazo, retrying in %.1fs", delay)
+            time.sleep(delay)
     return func()
 
 
+def _lazo_map(func, data, columns_textual, column_textual_names):
+    """Call the Lazo server for every textual column, concurrently.
+
+    :param func: function called with the distinct values and the name of a
+        column
+    :return: The results, in the order of the columns
+    """
+    def call_column(idx, name):
+        # The sketch doesn't depend on duplicates, only send distinct values
+        values = pandas.unique(data.iloc[:, idx].values).tolist()
+        with PROM_LAZO.time():
+            return _lazo_retry(lambda: func(values, name))
+
+    if len(columns_textual) <= 1:
+        return [
+            call_column(idx, name)
+            for idx, name in zip(columns_textual, column_textual_names)
+        ]
+
+    with ThreadPoolExecutor(
+        min(LAZO_WORKERS, len(columns_textual)),
+    ) as executor:
+        return list(executor.map(
+            call_column,
+            columns_textual, column_textual_names,
+        ))
+
+
 def count_rows_to_skip(file):
     """Count non-data rows at the top, such as titles etc.
     """
@@ -152,7 +205,10 @@ def count_rows_to_skip(file):
     run_cols = None
     run_len = 0
     try:
-        for i, row in enumerate(itertools.islice(reader, MAX_SKIPPED_ROWS + HEADER_CONSISTENT_ROWS)):
+        for i, row in enumerate(itertools.islice(
+            reader,
+            MAX_SKIPPED_ROWS + HEADER_CONSISTENT_ROWS,
+        )):
             if i >= MAX_SKIPPED_ROWS + HEADER_CONSISTENT_ROWS:
                 raise ValueError("Can't find consistent CSV data in file")
             if len(row) == run_cols:
@@ -173,6 +229,233 @@ def count_rows_to_skip(file):
         file.seek(0, 0)
 
 
+def _read_record(file, quote):
+    """Read a CSV record, which spans multiple lines if quotes are unbalanced.
+    """
+    record = file.readline()
+    while record.count(quote) % 2 == 1:
+        line = file.readline()
+        if not line:
+            break
+        record += line
+    return record
+
+
+def _skip_records(file, nb_records):
+    """Position the file after its first records, e.g. non-data rows.
+
+    :return: The position of the next record
+    """
+    quote = b'"' if isinstance(file.read(0), bytes) else '"'
+    file.seek(0, 0)
+    for _ in range(nb_records):
+        _read_record(file, quote)
+    return file.tell()
+
+
+def _read_records(file, quote, nb_records):
+    """Read a few CSV records, decoded.
+    """
+    records = []
+    for _ in range(nb_records):
+        record = _read_record(file, quote)
+        if not record:
+            break
+        if isinstance(record, bytes):
+            record = record.decode('utf-8', 'replace')
+        records.append(record)
+    return records
+
+
+def _min_columns(file, nb_columns, quote):
+    """Find the smallest number of values in the first records of the file.
+
+    Like pandas, we accept rows that have fewer values than there are columns.
+    """
+    records = _read_records(file, quote, MAX_RESYNC_LINES)
+    return min(
+        [nb_columns]
+        + [
+            len(row)
+            for row in csv.reader(io.StringIO(''.join(records)))
+            if row
+        ]
+    )
+
+
+def _record_pattern(min_columns, nb_columns):
+    """Build a regular expression matching a well-formed CSV record.
+
+    Quotes can only appear around a value, or doubled inside a quoted value.
+    """
+    value = r'(?:"(?:[^"]|"")*"|[^",\r\n]*)'
+    return re.compile(
+        value
+        + '(?:,' + value + '){%d,%d}' % (min_columns - 1, nb_columns - 1)
+        + r'\r?\n?'
+    )
+
+
+def _at_record_start(file, min_columns, nb_columns, quote, pattern):
+    """Check whether the file is positioned at the start of a CSV record.
+
+    Since we might be in the middle of a quoted value, this reads a few
+    records and checks that they have a number of values that was seen at
+    the start of the file, and that they are well-formed if `pattern` is
+    given.
+    """
+    records = _read_records(file, quote, HEADER_CONSISTENT_ROWS)
+    if pattern is not None:
+        return all(pattern.fullmatch(record) for record in records)
+    rows = list(csv.reader(io.StringIO(''.join(records))))
+    return (
+        len(rows) == len(records)
+        and all(min_columns <= len(row) <= nb_columns for row in rows)
+    )
+
+
+def sample_records(file, size, load_max_size, nb_columns, skip_rows=0):
+    """Read a random sample of the records in a CSV file.
+
+    The data after the header is split in `SAMPLE_CHUNKS` equal parts, and
+    consecutive records are read from a random offset in each part, until
+    `load_max_size` bytes have been read in total. The rest of the file is
+    never read. The first `skip_rows` records, which are not data (see
+    :func:`count_rows_to_skip`), come before the header.
+
+    :return: A list of the raw records, starting with the header, and the
+        estimated total number of records (not counting the header), or
+        ``None`` if no record could be sampled.
+    """
+    quote = b'"' if isinstance(file.read(0), bytes) else '"'
+    rand = random.Random(RANDOM_SEED)
+
+    _skip_records(file, skip_rows)
+    records = [_read_record(file, quote)]
+    data_start = pos = file.tell()
+
+    # Rows can be shorter than the header, find how short from the first ones
+    min_columns = _min_columns(file, nb_columns, quote)
+    file.seek(data_start, 0)
+
+    # Only rely on the quoting if the file uses it correctly
+    pattern = _record_pattern(min_columns, nb_columns)
+    if not _at_record_start(file, min_columns, nb_columns, quote, pattern):
+        pattern = None
+    file.seek(data_start, 0)
+
+    part_size = (size - data_start) / SAMPLE_CHUNKS
+    chunk_size = max(load_max_size - data_start, 0) / SAMPLE_CHUNKS
+
+    sampled_size = 0
+    for i in range(SAMPLE_CHUNKS):
+        offset = data_start + int(
+            i * part_size
+            + rand.random() * max(part_size - chunk_size, 0)
+        )
+        if offset > pos:
+            # Skip to the beginning of the next line
+            file.seek(offset - 1, 0)
+            file.readline()
+            # Make sure it is the start of a record, and not a line inside of
+            # a quoted value
+            for _ in range(MAX_RESYNC_LINES):
+                pos = file.tell()
+                if _at_record_start(
+                    file, min_columns, nb_columns, quote, pattern,
+                ):
+                    break
+                file.seek(pos, 0)
+                file.readline()
+            else:
+                pos = file.tell()
+                continue
+            file.seek(pos, 0)
+
+        # Read records until the chunk is full
+        while pos < offset + chunk_size:
+            record = _read_record(file, quote)
+            if not record:
+                break
+            records.append(record)
+            sampled_size += len(record)
+            pos = file.tell()
+
+    nb_sampled = len(records) - 1
+    if nb_sampled == 0:
+        return None
+    return records, round((size - data_start) * nb_sampled / sampled_size)
+
+
+def reservoir_sample_records(file, load_max_size, skip_rows=0):
+    """Read a random sample of the records in a CSV file, going over all of it.
+
+    This is used when `sample_records` can't find records at random offsets.
+    Each record gets a random priority, and the records with the lowest
+    priorities that fit in `load_max_size` bytes are kept. The first
+    `skip_rows` records are skipped, like in :func:`sample_records`.
+
+    :return: A list of the raw records, starting with the header, in the
+        order of the file, and the total number of records (not counting the
+        header).
+    """
+    quote = b'"' if isinstance(file.read(0), bytes) else '"'
+    rand = random.Random(RANDOM_SEED)
+
+    _skip_records(file, skip_rows)
+    header = _read_record(file, quote)
+    max_size = max(load_max_size - len(header), 0)
+
+    kept = []  # Heap of (-priority, position, record)
+    kept_size = 0
+    threshold = 1.0  # Records above that priority have been dropped
+    nb_records = 0
+    while True:
+        record = _read_record(file, quote)
+        if not record:
+            break
+        priority = rand.random()
+        if priority < threshold:
+            heapq.heappush(kept, (-priority, nb_records, record))
+            kept_size += len(record)
+            while kept_size > max_size:
+                priority, _, dropped = heapq.heappop(kept)
+                kept_size -= len(dropped)
+                threshold = -priority
+        nb_records += 1
+
+    kept.sort(key=lambda e: e[1])
+    return [header] + [record for _, _, record in kept], nb_records
+
+
+def _to_strings(data):
+    # Change to object dtype first and do fillna() to work around bug
+    # https://github.com/pandas-dev/pandas/issues/25353 (nan as str 'nan')
+    return data.astype(object).fillna('').astype(str)
+
+
+def _keep_native_types(data):
+    """Convert the columns of a DataFrame to strings, except for numbers and
+    datetimes which can be profiled directly.
+    """
+    if data.shape[1] == 0:
+        return data
+    return pandas.concat(
+        [
+            column if native_values(column) is not None
+            else _to_strings(column)
+            for _, column in data.items()
+        ],
+        axis=1,
+    )
+
+
+def _is_arrow_table(data):
+    # If pyarrow hasn't been imported, this can't be a Table
+    pyarrow = sys.modules.get('pyarrow')
+    return pyarrow is not None and isinstance(data, pyarrow.Table)
+
+
 def load_data(data, load_max_size=None, indexes=True):
     metadata = {}
 
@@ -194,16 +477,23 @@ def load_data(data, load_max_size=None, indexes=True):
             data = data.reset_index()
 
         metadata['nb_rows'] = len(data)
-        # Change to object dtype first and do fillna() to work around bug
-        # https://github.com/pandas-dev/pandas/issues/25353 (nan as str 'nan')
-        data = data.astype(object).fillna('').astype(str)
+        data = _to_strings(data)
 
         column_names = data.columns
-    elif data[-8:] == ".parquet" :
-        with contextlib.ExitStack() as stack:
-            data = stack.enter_context(open(data, 'rb'))
+    elif (
+        _is_arrow_table(data)
+        or (isinstance(data, str) and data.endswith('.parquet'))
+    ):
+        # Typed formats: numerical and datetime columns are kept as-is
+        if _is_arrow_table(data):
+            data = data.to_pandas(date_as_object=False)
+        else:
+            if not os.path.exists(data):
+                raise ValueError("data file does not exist")
             data = pandas.read_parquet(data)
-            metadata['nb_rows'] = len(data)
+        metadata['nb_rows'] = len(data)
+        data = _keep_native_types(data)
+
         column_names = data.columns
     else:
         if not load_max_size:
@@ -226,12 +516,18 @@ def load_data(data, load_max_size=None, indexes=True):
                 metadata['size'] = data.tell()
                 data.seek(0, 0)
             else:
-                raise TypeError("data should be a filename, a file object, or "
-                                "a pandas.DataFrame")
+                raise TypeError("data should be a filename, a file object, "
+                                "a pandas.DataFrame, or a pyarrow.Table")
+
+            # Skip non-data rows at the top, such as titles
+            skip_rows = count_rows_to_skip(data)
+            if skip_rows:
+                logger.info("Skipping %d non-data rows", skip_rows)
+            data_start = _skip_records(data, skip_rows)
 
             # Read column names
             read_sample = data.read(4)
-            data.seek(0, 0)
+            data.seek(data_start, 0)
             if isinstance(read_sample, str):
                 reader = csv.reader(data)
                 try:
@@ -248,31 +544,52 @@ def load_data(data, load_max_size=None, indexes=True):
                     column_names = None
                 del reader
                 del codec_reader
-            data.seek(0, 0)
+            data.seek(data_start, 0)
 
             # Load the data
-            if metadata['size'] > load_max_size:
-                logger.info("Counting rows...")
-                metadata['nb_rows'] = sum(1 for _ in data)
+            sample = None
+            if metadata['size'] > load_max_size and column_names:
+                # Sub-sample
+                logger.info(
+                    "Sampling records, ratio=%r...",
+                    load_max_size / metadata['size'],
+                )
+                if isinstance(data, io.TextIOWrapper):
+                    # Text files can't seek to arbitrary offsets
+                    encoding = data.encoding
+                    file = data.buffer
+                else:
+                    encoding = 'utf-8'
+                    file = data
+                sample = sample_records(
+                    file, metadata['size'], load_max_size,
+                    len(column_names), skip_rows,
+                )
+                if sample is None:
+                    # Don't load the whole file, go over it instead
+                    logger.info("Sampling records failed, reading all of it")
+                    sample = reservoir_sample_records(
+                        file, load_max_size, skip_rows,
+                    )
+                data.seek(data_start, 0)
+
+            if sample is not None:
+                records, metadata['nb_rows'] = sample
+                metadata['nb_rows_estimated'] = True
                 if metadata['nb_rows'] > 0:
                     metadata['average_row_size'] = (
                         metadata['size'] / metadata['nb_rows']
                     )
-                data.seek(0, 0)
 
-                # Sub-sample
-                ratio = load_max_size / metadata['size']
-                logger.info("Loading dataframe, sample ratio=%r...", ratio)
-                rand = random.Random(RANDOM_SEED)
-                selected_rows = set(rand.sample(
-                    range(1, metadata['nb_rows']),
-                    math.ceil(ratio * (metadata['nb_rows'] - 1)),
-                ))
-                selected_rows.add(0)  # Always get the header
+                logger.info("Loading dataframe, %d records...", len(records))
+                if isinstance(records[0], bytes):
+                    records = io.BytesIO(b''.join(records))
+                else:
+                    records = io.StringIO(''.join(records))
                 data = pandas.read_csv(
-                    data,
+                    records,
                     dtype=str, na_filter=False,
-                    skiprows=lambda i: i not in selected_rows,
+                    encoding=encoding,
                 )
             else:
                 logger.info("Loading dataframe...")
@@ -299,11 +616,25 @@ def process_column(
     coverage=True,
     geo_data=None,
     nominatim=None,
+    nominatim_cache=None,
+    sketch=False,
 ):
+    # Manual annotations are reconciled with the values as strings
+    if manual and native_values(array) is not None:
+        array = _to_strings(array)
+
+    # Count distinct values, most of the work only needs to be done once for
+    # each of them, and the parsed values are shared by the following steps
+    with tracer.start_as_current_span('profile/distinct_values'):
+        view = ColumnView(array)
+
     # Identify types
     with tracer.start_as_current_span('profile/identify_types'):
         structural_type, semantic_types_dict, additional_meta = \
-            identify_types(array, column_meta['name'], geo_data, manual)
+            identify_types(
+                array, column_meta['name'], geo_data, manual,
+                view=view,
+            )
     logger.info(
         "Column type %s [%s]",
         structural_type,
@@ -331,15 +662,8 @@ def process_column(
     ):
         # Get numerical values needed for either ranges or plot
         with tracer.start_as_current_span('profile/parse_numerical_values'):
-            numerical_values = []
-            for e in array:
-                try:
-                    e = float(e)
-                except ValueError:
-                    pass
-                else:
-                    if -3.4e38 < e < 3.4e38:  # Overflows in ES
-                        numerical_values.append(e)
+            numerical_values = view.floats
+            numerical_values = numerical_values[~numpy.isnan(numerical_values)]
 
         # Compute ranges from numerical values
         if coverage:
@@ -374,13 +698,9 @@ def process_column(
 
     if types.DATE_TIME in semantic_types_dict:
         datetimes = semantic_types_dict[types.DATE_TIME]
-        resolved['datetimes'] = datetimes
-        timestamps = numpy.empty(
-            len(datetimes),
-            dtype='float32',
-        )
-        for j, dt in enumerate(datetimes):
-            timestamps[j] = dt.timestamp()
+        # Distinct datetimes are enough to get the resolution
+        resolved['datetimes'] = [dt for dt in datetimes if dt is not None]
+        timestamps = (view.timestamps(datetimes) / 1e6).astype('float32')
         resolved['timestamps'] = timestamps
 
         # Compute histogram from temporal values
@@ -408,10 +728,10 @@ def process_column(
     if plots and types.CATEGORICAL in semantic_types_dict:
         with tracer.start_as_current_span('profile/categorical_plot'):
             counter = collections.Counter()
-            for value in array:
+            for value, count in view.items():
                 if not value:
                     continue
-                counter[value] += 1
+                counter[value] += count
             counts = counter.most_common(5)
             counts = sorted(counts)
             column_meta['plot'] = {
@@ -432,11 +752,11 @@ def process_column(
     ):
         with tracer.start_as_current_span('profile/textual_plot'):
             counter = collections.Counter()
-            for value in array:
+            for value, count in view.items():
                 for word in _re_word_split.split(value):
                     word = word.lower()
                     if word:
-                        counter[word] += 1
+                        counter[word] += count
             counts = counter.most_common(5)
             column_meta['plot'] = {
                 "type": "histogram_text",
@@ -460,6 +780,7 @@ def process_column(
             locations, non_empty = nominatim_resolve_all(
                 nominatim,
                 array,
+                cache=nominatim_cache,
             )
         if non_empty > 0:
             unclean_ratio = 1.0 - len(locations) / non_empty
@@ -475,51 +796,126 @@ def process_column(
             column_meta['admin_area_level'] = level
         resolved['admin_areas'] = areas
 
+    # Build mergeable state, to update the profile with more data later
+    if sketch:
+        with tracer.start_as_current_span('profile/sketch'):
+            resolved['sketch'] = build_column_sketch(
+                view,
+                numerical=structural_type in (types.INTEGER, types.FLOAT),
+                datetimes=semantic_types_dict.get(types.DATE_TIME),
+            )
+
     return resolved
 
 
-@PROM_LAZO.time()
+# Process pool workers are started fresh, to not inherit the threads and open
+# database connections of the parent process
+_mp_context = multiprocessing.get_context('spawn')
+
+_worker_geo_data = None
+
+
+def _init_column_worker(geo_data):
+    global _worker_geo_data
+    _worker_geo_data = geo_data
+
+
+def _process_column_in_worker(array, column_meta, **kwargs):
+    resolved = process_column(
+        array, column_meta,
+        geo_data=_worker_geo_data,
+        **kwargs,
+    )
+    return column_meta, resolved
+
+
+def process_columns_parallel(
+    data, columns, manual_columns, workers,
+    *,
+    plots=True,
+    coverage=True,
+    geo_data=None,
+    nominatim=None,
+    nominatim_cache=None,
+    sketch=False,
+):
+    """Process the columns using a pool of processes.
+
+    The GeoData is sent once to each worker, which opens its own connection to
+    the database. The column metadata dicts are updated in place, in order.
+    """
+    resolved_columns = {}
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(columns)),
+        mp_context=_mp_context,
+        initializer=_init_column_worker,
+        initargs=(geo_data,),
+    ) as pool:
+        futures = []
+        for column_idx, column_meta in enumerate(columns):
+            logger.info(
+                "Submitting column %d %r...",
+                column_idx, column_meta['name'],
+            )
+            futures.append(pool.submit(
+                _process_column_in_worker,
+                data.iloc[:, column_idx], column_meta,
+                manual=manual_columns.get(column_meta['name']),
+                plots=plots,
+                coverage=coverage,
+                nominatim=nominatim,
+                nominatim_cache=nominatim_cache,
+                sketch=sketch,
+            ))
+
+        for column_idx, future in enumerate(futures):
+            column_meta, resolved = future.result()
+            columns[column_idx].update(column_meta)
+            resolved_columns[column_idx] = resolved
+
+    return resolved_columns
+
+
 def lazo_index_data(
     data,
     dataset_id,
     columns_textual, column_textual_names,
     lazo_client,
 ):
+    """Index all the textual columns of a dataset with Lazo.
+
+    Columns are sent concurrently, with up to `LAZO_WORKERS` requests in
+    flight. The time of each is recorded in the `PROM_LAZO` histogram.
+    """
     logger.info("Indexing textual data with Lazo...")
     start = time.perf_counter()
-    for idx, name in zip(columns_textual, column_textual_names):
-        def call_lazo():
-            lazo_client.index_data(
-                data.iloc[:, idx].values.tolist(),
-                dataset_id,
-                name,
-            )
-
-        _lazo_retry(call_lazo)
+    _lazo_map(
+        lambda values, name: lazo_client.index_data(values, dataset_id, name),
+        data, columns_textual, column_textual_names,
+    )
     logger.info(
         "Indexing with Lazo took %.2fs seconds",
         time.perf_counter() - start,
     )
 
 
-@PROM_LAZO.time()
 def get_lazo_data_sketch(
     data,
     columns_textual, column_textual_names,
     lazo_client,
 ):
+    """Get the Lazo sketches of all the textual columns of a dataset.
+
+    Columns are sent concurrently like in :func:`lazo_index_data`.
+    """
     logger.info("Sketching textual data with Lazo...")
     start = time.perf_counter()
-    lazo_sketches = []
-    for idx, name in zip(columns_textual, column_textual_names):
-        def call_lazo():
-            return lazo_client.get_lazo_sketch_from_data(
-                data.iloc[:, idx].values.tolist(),
-                "",
-                name,
-            )
-
-        lazo_sketches.append(_lazo_retry(call_lazo))
+    lazo_sketches = _lazo_map(
+        lambda values, name: lazo_client.get_lazo_sketch_from_data(
+            values, "", name,
+        ),
+        data, columns_textual, column_textual_names,
+    )
     logger.info(
         "Sketching with Lazo took %.2fs seconds",
         time.perf_counter() - start,
@@ -527,21 +923,55 @@ def get_lazo_data_sketch(
     return lazo_sketches
 
 
+def set_dataset_types(metadata):
+    """Set the overall types of the dataset from the types of its columns.
+
+    This sets ``'types'`` (numerical, categorical, spatial, or temporal) and
+    the number of columns of each type.
+    """
+    dataset_types = collections.Counter()
+    for column_meta in metadata['columns']:
+        dataset_type = determine_dataset_type(
+            column_meta['structural_type'],
+            column_meta['semantic_types'],
+        )
+        if dataset_type:
+            dataset_types[dataset_type] += 1
+    for key, d_type in [
+        ('nb_spatial_columns', types.DATASET_SPATIAL),
+        ('nb_temporal_columns', types.DATASET_TEMPORAL),
+        ('nb_categorical_columns', types.DATASET_CATEGORICAL),
+        ('nb_numerical_columns', types.DATASET_NUMERICAL),
+    ]:
+        if dataset_types[d_type]:
+            metadata[key] = dataset_types[d_type]
+        else:
+            metadata.pop(key, None)
+    metadata['types'] = sorted(set(dataset_types))
+
+
 @PROM_PROFILE.time()
 def process_dataset(data, dataset_id=None, metadata=None,
-                    lazo_client=None, nominatim=None, geo_data=None,
+                    lazo_client=None, nominatim=None, nominatim_cache=None,
+                    geo_data=None,
                     search=False, include_sample=False,
                     coverage=True, plots=False, indexes=True,
-                    load_max_size=None,
+                    load_max_size=None, workers=None, sketches=False,
+                    full_scan=False, admin_coverage=False,
                     **kwargs):
     """Compute all metafeatures from a dataset.
 
-    :param data: path to dataset, or file object, or DataFrame
+    :param data: path to dataset, or file object, or DataFrame, or Arrow
+        Table. Numerical and datetime columns of DataFrames are converted to
+        strings, the types of Arrow Tables and Parquet files are used as-is.
     :param dataset_id: id of the dataset
     :param metadata: The metadata provided by the discovery plugin (might be
         very limited).
     :param lazo_client: client for the Lazo Index Server
     :param nominatim: URL of the Nominatim server
+    :param nominatim_cache: ``True``, a path, or a
+        :class:`~datamart_profiler.spatial.NominatimCache` instance, to keep
+        the addresses resolved with Nominatim in a persistent cache
     :param geo_data: ``True`` or a datamart_geo.GeoData instance to use to
         resolve named administrative territorial entities
     :param search: True if this method is being called during the search
@@ -556,6 +986,19 @@ def process_dataset(data, dataset_id=None, metadata=None,
     :param load_max_size: Target size of the data to be analyzed. The data will
         be randomly sampled if it is bigger. Defaults to `MAX_SIZE`, currently
         5 MB. This is different from the sample data included in the result.
+    :param workers: Number of processes to use to profile columns in
+        parallel. Defaults to profiling them one by one in this process.
+    :param sketches: Set to True to include the mergeable state of each column
+        in the result, under ``'sketches'``. This allows updating the profile
+        with :func:`~datamart_profiler.merge_profiles` when data is appended.
+    :param full_scan: If the data is a CSV file bigger than `load_max_size`,
+        types are identified from a sample, but counts, distinct values,
+        ranges, plots, and geohashes are then computed by reading the whole
+        file in chunks, in bounded memory.
+    :param admin_coverage: If ``geo_data`` is set, also find the
+        administrative areas containing the points of latitude/longitude and
+        WKT point columns, and list them in the spatial coverage under
+        ``'admin_areas'``.
     :return: JSON structure (dict)
     """
     if 'sample_size' in kwargs:
@@ -575,10 +1018,16 @@ def process_dataset(data, dataset_id=None, metadata=None,
 
         geo_data = GeoData.from_local_cache()
 
+    if nominatim_cache is True:
+        nominatim_cache = NominatimCache()
+    elif isinstance(nominatim_cache, str):
+        nominatim_cache = NominatimCache(nominatim_cache)
+
     if metadata is None:
         metadata = {}
 
     # Load or prepare data for processing
+    source = data
     try:
         data, file_metadata, column_names = load_data(
             data,
@@ -634,24 +1083,52 @@ def process_dataset(data, dataset_id=None, metadata=None,
     logger.info("Identifying types, %d columns...", len(columns))
     with PROM_TYPES.time():
         with tracer.start_as_current_span('profile/columns'):
-            for column_idx, column_meta in enumerate(columns):
-                name = column_meta['name']
-                with tracer.start_as_current_span('profile/column', attributes={'idx': column_idx, 'name': name}):
-                    logger.info("Processing column %d %r...", column_idx, name)
-                    array = data.iloc[:, column_idx]
-                    if name in manual_columns:
-                        manual = manual_columns[name]
-                    else:
-                        manual = None
-                    # Process the column, updating the column_meta dict
-                    resolved_columns[column_idx] = process_column(
-                        array, column_meta,
-                        manual=manual,
-                        plots=plots,
-                        coverage=coverage,
-                        geo_data=geo_data,
-                        nominatim=nominatim,
-                    )
+            if workers is not None and workers > 1 and len(columns) > 1:
+                resolved_columns = process_columns_parallel(
+                    data, columns, manual_columns, workers,
+                    plots=plots,
+                    coverage=coverage,
+                    geo_data=geo_data,
+                    nominatim=nominatim,
+                    nominatim_cache=nominatim_cache,
+                    sketch=sketches,
+                )
+            else:
+                for column_idx, column_meta in enumerate(columns):
+                    name = column_meta['name']
+                    with tracer.start_as_current_span(
+                        'profile/column',
+                        attributes={'idx': column_idx, 'name': name},
+                    ):
+                        logger.info(
+                            "Processing column %d %r...",
+                            column_idx, name,
+                        )
+                        array = data.iloc[:, column_idx]
+                        if name in manual_columns:
+                            manual = manual_columns[name]
+                        else:
+                            manual = None
+                        # Process the column, updating the column_meta dict
+                        resolved_columns[column_idx] = process_column(
+                            array, column_meta,
+                            manual=manual,
+                            plots=plots,
+                            coverage=coverage,
+                            geo_data=geo_data,
+                            nominatim=nominatim,
+                            nominatim_cache=nominatim_cache,
+                            sketch=sketches,
+                        )
+
+    if sketches:
+        metadata['sketches'] = {
+            'version': SKETCHES_VERSION,
+            'columns': [
+                resolved_columns[column_idx].pop('sketch').to_json()
+                for column_idx in range(len(columns))
+            ],
+        }
 
     # Textual columns
     columns_textual = [
@@ -665,7 +1142,9 @@ def process_dataset(data, dataset_id=None, metadata=None,
     if lazo_client and columns_textual:
         with tracer.start_as_current_span('profile/categorical'):
             # Indexing with lazo
-            column_textual_names = [columns[idx]['name'] for idx in columns_textual]
+            column_textual_names = [
+                columns[idx]['name'] for idx in columns_textual
+            ]
             if not search:
                 try:
                     lazo_index_data(
@@ -675,7 +1154,10 @@ def process_dataset(data, dataset_id=None, metadata=None,
                         lazo_client,
                     )
                 except Exception:
-                    logger.warning("Error indexing textual attributes from %s", dataset_id)
+                    logger.warning(
+                        "Error indexing textual attributes from %s",
+                        dataset_id,
+                    )
                     raise
             else:
                 try:
@@ -732,24 +1214,9 @@ def process_dataset(data, dataset_id=None, metadata=None,
         if col['name'] in missed_long:
             col['semantic_types'].remove(types.LONGITUDE)
 
-    # Identify the overall dataset types (numerical, categorical, spatial, or temporal)
-    dataset_types = collections.Counter()
-    for column_meta in columns:
-        dataset_type = determine_dataset_type(
-            column_meta['structural_type'],
-            column_meta['semantic_types'],
-        )
-        if dataset_type:
-            dataset_types[dataset_type] += 1
-    for key, d_type in [
-        ('nb_spatial_columns', types.DATASET_SPATIAL),
-        ('nb_temporal_columns', types.DATASET_TEMPORAL),
-        ('nb_categorical_columns', types.DATASET_CATEGORICAL),
-        ('nb_numerical_columns', types.DATASET_NUMERICAL),
-    ]:
-        if dataset_types[d_type]:
-            metadata[key] = dataset_types[d_type]
-    metadata['types'] = sorted(set(dataset_types))
+    # Identify the overall dataset types (numerical, categorical, spatial,
+    # or temporal)
+    set_dataset_types(metadata)
 
     if coverage:
         logger.info("Computing spatial coverage...")
@@ -784,7 +1251,7 @@ def process_dataset(data, dataset_id=None, metadata=None,
                         builder.add_points(values)
                         hashes = builder.get_hashes_json()
 
-                        spatial_coverage.append({
+                        cov = {
                             'type': 'latlong',
                             'column_names': [col_lat.name, col_long.name],
                             'column_indexes': [
@@ -794,7 +1261,13 @@ def process_dataset(data, dataset_id=None, metadata=None,
                             'geohashes4': hashes,
                             'ranges': spatial_ranges,
                             'number': len(values),
-                        })
+                        }
+                        # Administrative areas
+                        if admin_coverage and geo_data is not None:
+                            admin_areas = get_admin_coverage(geo_data, values)
+                            if admin_areas:
+                                cov['admin_areas'] = admin_areas
+                        spatial_coverage.append(cov)
 
                 # Compute sketches from WKT points
                 for i, col in enumerate(columns):
@@ -826,14 +1299,20 @@ def process_dataset(data, dataset_id=None, metadata=None,
                         builder.add_points(values)
                         hashes = builder.get_hashes_json()
 
-                        spatial_coverage.append({
+                        cov = {
                             'type': 'point_latlong' if latlong else 'point',
                             'column_names': [name],
                             'column_indexes': [i],
                             'geohashes4': hashes,
                             'ranges': spatial_ranges,
                             'number': len(values),
-                        })
+                        }
+                        # Administrative areas
+                        if admin_coverage and geo_data is not None:
+                            admin_areas = get_admin_coverage(geo_data, values)
+                            if admin_areas:
+                                cov['admin_areas'] = admin_areas
+                        spatial_coverage.append(cov)
 
                 for idx, resolved in resolved_columns.items():
                     # Compute sketches from addresses
@@ -943,7 +1422,7 @@ def process_dataset(data, dataset_id=None, metadata=None,
                 timestamps = resolved_columns[idx]['timestamps']
                 logger.info(
                     "Computing temporal ranges datetime=%r (%d rows)",
-                    col['name'], len(datetimes),
+                    col['name'], len(timestamps),
                 )
 
                 # Get temporal ranges
@@ -987,10 +1466,19 @@ def process_dataset(data, dataset_id=None, metadata=None,
                 replace=False,
             )
             choose_rows.sort()  # Keep it in order
-            sample = data.iloc[choose_rows]
+            sample = _to_strings(data.iloc[choose_rows])
             sample = sample.applymap(truncate_string)  # Truncate long values
             metadata['sample'] = sample.to_csv(index=False, line_terminator='\r\n')
 
+    # Read all the data to update the profile, if only a sample was used
+    if full_scan and metadata.get('nb_rows_estimated', False):
+        from .incremental import scan_data
+
+        with tracer.start_as_current_span('profile/full_scan'):
+            scan_data(metadata, source, load_max_size=load_max_size)
+        if not sketches:
+            del metadata['sketches']
+
     # Return it -- it will be inserted into Elasticsearch, and published to the
     # feed and the waiting on-demand searches
     return metadata
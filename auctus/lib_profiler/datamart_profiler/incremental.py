@@ -0,0 +1,518 @@
+import collections
+import contextlib
+import copy
+from datetime import datetime
+import logging
+import numpy
+import opentelemetry.trace
+import pandas
+
+from .core import MAX_GEOHASHES, MAX_SIZE, _skip_records, \
+    count_rows_to_skip, process_dataset, set_dataset_types
+from .numerical import get_numerical_ranges
+from .profile_types import MAX_CATEGORICAL_RATIO, ColumnView, \
+    _parse_year, unclean_values_ratio
+from .sketches import SKETCHES_VERSION, ColumnSketch, build_column_sketch
+from .spatial import Geohasher, merge_admin_coverage, merge_geohashes, \
+    merge_spatial_ranges, parse_wkt_column
+from .temporal import parse_date_list, temporal_aggregation_keys
+from . import types
+
+
+logger = logging.getLogger(__name__)
+tracer = opentelemetry.trace.get_tracer(__name__)
+
+
+_resolutions = list(temporal_aggregation_keys)
+
+
+def _load_sketches(metadata):
+    sketches = metadata.get('sketches')
+    if not sketches:
+        raise ValueError(
+            "Profile has no sketches, it needs to be computed with "
+            "sketches=True"
+        )
+    if sketches['version'] != SKETCHES_VERSION:
+        raise ValueError(
+            "Profile sketches are from a different version (%r != %r)" % (
+                sketches['version'], SKETCHES_VERSION,
+            )
+        )
+    column_sketches = [ColumnSketch.from_json(c) for c in sketches['columns']]
+
+    # If the data was sampled, weight the rows so they stand for the whole
+    # data when merged
+    if metadata['nb_profiled_rows'] and (
+        metadata['nb_rows'] != metadata['nb_profiled_rows']
+    ):
+        factor = metadata['nb_rows'] / metadata['nb_profiled_rows']
+        for sketch in column_sketches:
+            sketch.scale(factor)
+
+    return column_sketches
+
+
+def _column_types(column):
+    return (
+        column['structural_type'],
+        set(column['semantic_types']) - {types.CATEGORICAL},
+    )
+
+
+def _merge_plots(plot, other):
+    # Categorical and textual plots only have the most common values, summing
+    # them is exact only for values that are common in both parts
+    counter = collections.Counter()
+    for bin in plot['data'] + other['data']:
+        counter[bin['bin']] += bin['count']
+    counts = counter.most_common(5)
+    if plot['type'] == 'histogram_categorical':
+        counts = sorted(counts)
+    return {
+        'type': plot['type'],
+        'data': [
+            {
+                'bin': value,
+                'count': count,
+            }
+            for value, count in counts
+        ]
+    }
+
+
+def _update_column(column, other, sketch):
+    """Update the metadata of a column from its merged sketch.
+    """
+    total = sketch.total
+    type_counts = sketch.type_counts
+
+    if column['structural_type'] == types.MISSING_DATA:
+        return
+
+    if type_counts['empty'] > 0:
+        column['missing_values_ratio'] = type_counts['empty'] / total
+    else:
+        column.pop('missing_values_ratio', None)
+
+    if 'unclean_values_ratio' in column:
+        if types.BOOLEAN in column['semantic_types']:
+            c_type = types.BOOLEAN
+        else:
+            c_type = column['structural_type']
+        column['unclean_values_ratio'] = unclean_values_ratio(
+            c_type, type_counts, total,
+        )
+
+    # Count distinct values, and decide again whether the column is
+    # categorical
+    if 'num_distinct_values' in column:
+        num_distinct = sketch.distinct.count()
+        column['num_distinct_values'] = num_distinct
+        if (
+            column['structural_type'] == types.TEXT
+            and types.TEXT not in column['semantic_types']
+            and types.ADMIN not in column['semantic_types']
+            and types.BOOLEAN not in column['semantic_types']
+        ):
+            max_categorical = MAX_CATEGORICAL_RATIO * (
+                total - type_counts['empty']
+            )
+            # Only change the decision if the estimate is clearly on one side
+            if sketch.distinct.exact:
+                margin = 0
+            else:
+                margin = 3 * sketch.distinct.hll.error * num_distinct
+            semantic_types = column['semantic_types']
+            if num_distinct + margin <= max_categorical:
+                if types.CATEGORICAL not in semantic_types:
+                    semantic_types.append(types.CATEGORICAL)
+            elif num_distinct - margin > max_categorical:
+                if types.CATEGORICAL in semantic_types:
+                    semantic_types.remove(types.CATEGORICAL)
+
+    summary = sketch.numerical
+    if summary is not None and summary.count:
+        if 'mean' in column:
+            column['mean'] = summary.mean
+            column['stddev'] = summary.stddev
+        if 'coverage' in column or 'coverage' in other:
+            ranges = get_numerical_ranges(
+                summary.values,
+                weights=summary.weights,
+            )
+            if ranges:
+                column['coverage'] = ranges
+            else:
+                column.pop('coverage', None)
+
+    if 'plot' in column:
+        plot = column['plot']
+        if plot['type'] == 'histogram_numerical' and summary is not None:
+            counts, edges = summary.histogram(bins=10)
+            column['plot'] = {
+                'type': 'histogram_numerical',
+                'data': [
+                    {
+                        'count': int(count),
+                        'bin_start': float(edges[i]),
+                        'bin_end': float(edges[i + 1]),
+                    }
+                    for i, count in enumerate(counts)
+                ]
+            }
+        elif (
+            plot['type'] == 'histogram_temporal'
+            and sketch.temporal is not None
+        ):
+            counts, edges = sketch.temporal.histogram(bins=10)
+            column['plot'] = {
+                'type': 'histogram_temporal',
+                'data': [
+                    {
+                        'count': int(count),
+                        'date_start': datetime.utcfromtimestamp(
+                            float(edges[i]),
+                        ).isoformat(),
+                        'date_end': datetime.utcfromtimestamp(
+                            float(edges[i + 1]),
+                        ).isoformat(),
+                    }
+                    for i, count in enumerate(counts)
+                ]
+            }
+        elif (
+            plot['type'] in ('histogram_categorical', 'histogram_text')
+            and other.get('plot', {}).get('type') == plot['type']
+        ):
+            column['plot'] = _merge_plots(plot, other['plot'])
+
+
+def _merge_spatial_coverage(coverage, other):
+    merged = dict(coverage)
+    merged['number'] = coverage.get('number', 0) + other.get('number', 0)
+
+    hashes = merge_geohashes(
+        coverage.get('geohashes4', []), other.get('geohashes4', []),
+        number=MAX_GEOHASHES,
+    )
+    if hashes:
+        merged['geohashes4'] = hashes
+
+    admin_areas = merge_admin_coverage(
+        coverage.get('admin_areas', []), other.get('admin_areas', []),
+    )
+    if admin_areas:
+        merged['admin_areas'] = admin_areas
+
+    ranges = coverage.get('ranges', []) + other.get('ranges', [])
+    if ranges:
+        if coverage['type'] == 'admin':
+            # Administrative areas are covered by a single box
+            boxes = [rg['range']['coordinates'] for rg in ranges]
+            merged['ranges'] = [
+                {
+                    'range': {
+                        'type': 'envelope',
+                        'coordinates': [
+                            [
+                                min(b[0][0] for b in boxes),
+                                max(b[0][1] for b in boxes),
+                            ],
+                            [
+                                max(b[1][0] for b in boxes),
+                                min(b[1][1] for b in boxes),
+                            ],
+                        ],
+                    },
+                },
+            ]
+        else:
+            merged['ranges'] = merge_spatial_ranges(ranges)
+    return merged
+
+
+def merge_profiles(metadata, other):
+    """Merge the profiles of two parts of a dataset, e.g. with appended data.
+
+    Both profiles need to have been computed with ``sketches=True``. Their
+    sketches are merged, and the metadata that can be derived from them is
+    computed again: counts, ratios, number of distinct values, mean and
+    standard deviation, ranges, and plots. Columns need to have the same types
+    in both parts, unless one of them is empty. The rest of the metadata (e.g.
+    sample, Lazo sketches) comes from `metadata`.
+
+    Sketches of sampled data are scaled to the size of the data before being
+    merged, so ``nb_profiled_rows`` of the result is ``nb_rows``.
+
+    :param metadata: The profile of the existing data, it is not modified
+    :param other: The profile of the new data
+    :return: The profile of the whole data, with its sketches
+    """
+    if not other.get('nb_profiled_rows'):
+        return copy.deepcopy(metadata)
+    elif not metadata.get('nb_profiled_rows'):
+        return copy.deepcopy(other)
+
+    columns = metadata['columns']
+    other_columns = other['columns']
+    if [c['name'] for c in columns] != [c['name'] for c in other_columns]:
+        raise ValueError("Column names don't match")
+
+    sketches = _load_sketches(metadata)
+    other_sketches = _load_sketches(other)
+
+    result = copy.deepcopy(metadata)
+
+    # Dataset size. The merged sketches are scaled to stand for all the rows,
+    # they must not be scaled again when merging with the next part
+    result['nb_rows'] = metadata['nb_rows'] + other['nb_rows']
+    result['nb_profiled_rows'] = result['nb_rows']
+    if metadata.get('nb_rows_estimated') or other.get('nb_rows_estimated'):
+        result['nb_rows_estimated'] = True
+    if 'size' in metadata and 'size' in other:
+        result['size'] = metadata['size'] + other['size']
+        result['average_row_size'] = result['size'] / result['nb_rows']
+    else:
+        result.pop('size', None)
+        result.pop('average_row_size', None)
+
+    # Columns
+    for column_idx, (column, other_column) in enumerate(
+        zip(result['columns'], other_columns),
+    ):
+        if (
+            column['structural_type'] == types.MISSING_DATA
+            and other_column['structural_type'] != types.MISSING_DATA
+        ):
+            # The types come from the part that has values
+            column.clear()
+            column.update(copy.deepcopy(other_column))
+        elif (
+            other_column['structural_type'] != types.MISSING_DATA
+            and _column_types(column) != _column_types(other_column)
+        ):
+            raise ValueError(
+                "Types of column %r don't match: %s %r != %s %r" % (
+                    column['name'],
+                    *_column_types(column), *_column_types(other_column),
+                )
+            )
+
+        sketch = sketches[column_idx]
+        sketch.merge(other_sketches[column_idx])
+        _update_column(column, other_column, sketch)
+
+    result['sketches'] = {
+        'version': SKETCHES_VERSION,
+        'columns': [sketch.to_json() for sketch in sketches],
+    }
+
+    set_dataset_types(result)
+
+    # Spatial coverage
+    spatial_coverage = {
+        (cov['type'], tuple(cov['column_indexes'])): cov
+        for cov in metadata.get('spatial_coverage', [])
+    }
+    for cov in other.get('spatial_coverage', []):
+        key = cov['type'], tuple(cov['column_indexes'])
+        if key in spatial_coverage:
+            spatial_coverage[key] = _merge_spatial_coverage(
+                spatial_coverage[key], cov,
+            )
+        else:
+            spatial_coverage[key] = copy.deepcopy(cov)
+    if spatial_coverage:
+        result['spatial_coverage'] = list(spatial_coverage.values())
+
+    # Temporal coverage
+    temporal_coverage = {
+        tuple(cov['column_indexes']): cov
+        for cov in result.get('temporal_coverage', [])
+    }
+    for cov in other.get('temporal_coverage', []):
+        key = tuple(cov['column_indexes'])
+        if key not in temporal_coverage:
+            temporal_coverage[key] = copy.deepcopy(cov)
+        else:
+            # Keep the finest resolution
+            resolution = temporal_coverage[key]['temporal_resolution']
+            if (
+                _resolutions.index(cov['temporal_resolution'])
+                > _resolutions.index(resolution)
+            ):
+                temporal_coverage[key]['temporal_resolution'] = \
+                    cov['temporal_resolution']
+    if temporal_coverage:
+        result['temporal_coverage'] = list(temporal_coverage.values())
+        _update_temporal_ranges(result, sketches)
+
+    return result
+
+
+def _update_temporal_ranges(metadata, sketches):
+    for cov in metadata.get('temporal_coverage', []):
+        summary = sketches[cov['column_indexes'][0]].temporal
+        if cov['type'] == 'datetime' and summary is not None:
+            cov['ranges'] = get_numerical_ranges(
+                summary.values,
+                weights=summary.weights,
+            )
+
+
+def profile_increment(metadata, data, **kwargs):
+    """Update a profile with data appended to the dataset.
+
+    Only the new data is profiled, and the result is merged with the existing
+    profile using :func:`merge_profiles`.
+
+    :param metadata: The profile of the existing data, computed with
+        ``sketches=True``. It is not modified.
+    :param data: The new rows, in any format accepted by
+        :func:`~datamart_profiler.process_dataset`. Files need to have the
+        same header as the original data.
+    :param kwargs: Additional arguments passed to
+        :func:`~datamart_profiler.process_dataset`. By default, plots are
+        computed if the existing profile has them.
+    :return: The profile of the whole data, with its sketches
+    """
+    new_metadata = {
+        'columns': [{'name': col['name']} for col in metadata['columns']],
+    }
+    if 'manual_annotations' in metadata:
+        new_metadata['manual_annotations'] = metadata['manual_annotations']
+    kwargs.setdefault(
+        'plots',
+        any('plot' in col for col in metadata['columns']),
+    )
+    other = process_dataset(
+        data,
+        metadata=new_metadata,
+        sketches=True,
+        **kwargs,
+    )
+    return merge_profiles(metadata, other)
+
+
+def scan_data(metadata, data, load_max_size=None):
+    """Update a profile computed from a sample using all the rows of the file.
+
+    The CSV file is read again in chunks of about `load_max_size` bytes, from
+    which the sketches of the columns and the geohashes are computed, so
+    memory use doesn't depend on the size of the file. The counts, ratios,
+    number of distinct values, mean and standard deviation, ranges, and
+    numerical and temporal plots are then computed from them. Types, spatial
+    ranges, and categorical plots still come from the sample.
+
+    :param metadata: The profile of the sample, updated in place
+    :param data: The path to the CSV file, or a file object
+    """
+    if not load_max_size:
+        load_max_size = MAX_SIZE
+    columns = metadata['columns']
+    chunk_rows = max(
+        1,
+        int(load_max_size / metadata.get('average_row_size', 1)),
+    )
+
+    sketches = [ColumnSketch() for _ in columns]
+    builders = [
+        Geohasher(number=MAX_GEOHASHES)
+        for _ in metadata.get('spatial_coverage', [])
+    ]
+    nb_rows = 0
+
+    with contextlib.ExitStack() as stack:
+        if isinstance(data, (str, bytes)):
+            data = stack.enter_context(open(data, 'rb'))
+        # Skip the same non-data rows as when loading the sample
+        _skip_records(data, count_rows_to_skip(data))
+        chunks = pandas.read_csv(
+            data,
+            dtype=str, na_filter=False,
+            chunksize=chunk_rows,
+        )
+        for chunk in chunks:
+            logger.info(
+                "Scanning rows %d-%d...",
+                nb_rows, nb_rows + len(chunk),
+            )
+            if chunk.shape[1] != len(columns):
+                raise ValueError(
+                    "Column metadata doesn't match number of columns"
+                )
+            nb_rows += len(chunk)
+
+            with tracer.start_as_current_span('profile/scan_columns'):
+                for column_idx, column in enumerate(columns):
+                    view = ColumnView(chunk.iloc[:, column_idx])
+                    datetimes = None
+                    if types.DATE_TIME in column['semantic_types']:
+                        if column['name'].strip().lower() == 'year':
+                            datetimes = view.map(_parse_year)
+                        else:
+                            datetimes = parse_date_list(view.values)
+                    sketches[column_idx].merge(build_column_sketch(
+                        view,
+                        numerical=column['structural_type'] in (
+                            types.INTEGER, types.FLOAT,
+                        ),
+                        datetimes=datetimes,
+                    ))
+
+            with tracer.start_as_current_span('profile/scan_spatial'):
+                for builder, cov in zip(
+                    builders,
+                    metadata.get('spatial_coverage', []),
+                ):
+                    if cov['type'] == 'latlong':
+                        lat_idx, long_idx = cov['column_indexes']
+                        lat_values = pandas.to_numeric(
+                            chunk.iloc[:, lat_idx],
+                            errors='coerce',
+                        )
+                        long_values = pandas.to_numeric(
+                            chunk.iloc[:, long_idx],
+                            errors='coerce',
+                        )
+                        mask = (
+                            ~numpy.isnan(lat_values)
+                            & ~numpy.isnan(long_values)
+                            & (-90.0 < lat_values) & (lat_values < 90.0)
+                            & (-180.0 < long_values) & (long_values < 180.0)
+                        )
+                        points = numpy.array(
+                            [lat_values[mask], long_values[mask]],
+                        ).T
+                    elif cov['type'] in ('point', 'point_latlong'):
+                        points = parse_wkt_column(
+                            chunk.iloc[:, cov['column_indexes'][0]],
+                            latlong=cov['type'] == 'point_latlong',
+                        )
+                    else:
+                        # Addresses and administrative areas need to be
+                        # resolved, which is only done for the sample
+                        continue
+                    builder.add_points(points)
+
+    logger.info("Scanned %d rows", nb_rows)
+    metadata['nb_rows'] = nb_rows
+    metadata['nb_profiled_rows'] = nb_rows
+    metadata.pop('nb_rows_estimated', None)
+    if 'size' in metadata and nb_rows > 0:
+        metadata['average_row_size'] = metadata['size'] / nb_rows
+
+    for column, sketch in zip(columns, sketches):
+        _update_column(column, {}, sketch)
+    metadata['sketches'] = {
+        'version': SKETCHES_VERSION,
+        'columns': [sketch.to_json() for sketch in sketches],
+    }
+    set_dataset_types(metadata)
+
+    for builder, cov in zip(builders, metadata.get('spatial_coverage', [])):
+        if builder.total:
+            cov['geohashes4'] = builder.get_hashes_json()
+            cov['number'] = builder.total
+    _update_temporal_ranges(metadata, sketches)
@@ -1,8 +1,6 @@
 import logging
 import math
 import numpy
-from sklearn.cluster import KMeans
-from sklearn.exceptions import ConvergenceWarning
 
 from .warning_tools import ignore_warnings
 
@@ -13,33 +11,171 @@ logger = logging.getLogger(__name__)
 N_RANGES = 3
 MIN_RANGE_SIZE = 0.1  # 10%
 
+# Number of groups of values the exact clustering works on. If there are more
+# distinct values, they are grouped, and the result refined with iterations of
+# Lloyd's algorithm
+MAX_CLUSTERING_GROUPS = 1000
+MAX_CLUSTERING_ITERATIONS = 100
+
 
 def mean_stddev(array):
     """Compute the mean (average) and standard deviation of a numerical array.
+
+    Missing values (None or NaN) are ignored.
     """
-    total = 0
-    count = 0
-    for elem in array:
-        if elem is not None:
-            total += elem
-            count += 1
-    mean = total / count if count > 0 else 0
+    array = numpy.asarray(array, dtype=numpy.float64)
+    array = array[~numpy.isnan(array)]
+    if not len(array):
+        return 0, 0
+
+    mean = array.mean()
+    stddev = math.sqrt(numpy.square(array - mean).mean())
 
-    total = 0
-    for elem in array:
-        if elem is not None:
-            elem = elem - mean
-            total += elem * elem
-    stddev = math.sqrt(total / count) if count > 0 else 0
+    return float(mean), stddev
 
-    return mean, stddev
 
+def _cluster_kmeans(values, n_clusters, weights=None):
+    """Cluster using K-Means from scikit-learn.
+    """
+    from sklearn.cluster import KMeans
+    from sklearn.exceptions import ConvergenceWarning
 
-def get_numerical_ranges(values):
+    clustering = KMeans(n_clusters=n_clusters, random_state=0)
+    with ignore_warnings(ConvergenceWarning):
+        clustering.fit(values.reshape(-1, 1), sample_weight=weights)
+    logger.info("K-Means clusters: %r", list(clustering.cluster_centers_))
+    return clustering.labels_
+
+
+def _sse_matrix(weights, sums, squares):
+    # Sum of squared errors of each range of groups [j, i], as a matrix
+    weights = numpy.concatenate([[0], numpy.cumsum(weights)])
+    sums = numpy.concatenate([[0], numpy.cumsum(sums)])
+    squares = numpy.concatenate([[0], numpy.cumsum(squares)])
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sse = (
+            (squares[None, 1:] - squares[:-1, None])
+            - (sums[None, 1:] - sums[:-1, None]) ** 2
+            / (weights[None, 1:] - weights[:-1, None])
+        )
+    sse = numpy.maximum(sse, 0.0)  # Rounding errors
+    sse[numpy.tril_indices(len(weights) - 1, -1)] = numpy.inf
+    return sse
+
+
+def _cluster_optimal(values, n_clusters, weights=None):
+    """Cluster using an exact 1-dimensional K-Means.
+
+    This is the dynamic programming approach of Ckmeans.1d.dp, run on the
+    sorted distinct values. Clusters are labelled in increasing order.
+    """
+    if weights is None:
+        distinct, counts = numpy.unique(values, return_counts=True)
+    else:
+        distinct, inverse = numpy.unique(values, return_inverse=True)
+        counts = numpy.bincount(inverse, weights=weights)
+    if len(distinct) <= n_clusters:
+        return numpy.searchsorted(distinct, values)
+
+    # Center the values to limit rounding errors
+    distinct_c = distinct.astype(numpy.float64)
+    distinct_c -= numpy.average(distinct_c, weights=counts)
+
+    # Group consecutive distinct values, each group holding about the same
+    # number of values
+    if len(distinct) > MAX_CLUSTERING_GROUPS:
+        cumulative = numpy.cumsum(counts)
+        starts = numpy.searchsorted(
+            cumulative,
+            numpy.arange(MAX_CLUSTERING_GROUPS) * (
+                cumulative[-1] / MAX_CLUSTERING_GROUPS
+            ),
+            side='right',
+        )
+        starts = numpy.unique(starts)
+    else:
+        starts = numpy.arange(len(distinct))
+    sse = _sse_matrix(
+        numpy.add.reduceat(counts, starts),
+        numpy.add.reduceat(counts * distinct_c, starts),
+        numpy.add.reduceat(counts * distinct_c * distinct_c, starts),
+    )
+
+    # cost[i] is the best cost for groups 0 to i in the current number of
+    # clusters, best_start[k][i] is where the last cluster starts for it
+    nb_groups = len(starts)
+    cost = sse[0, :]
+    best_start = []
+    for _ in range(1, n_clusters):
+        total = cost[:-1, None] + sse[1:, :]
+        start = numpy.argmin(total, axis=0)
+        cost = total[start, numpy.arange(nb_groups)]
+        best_start.append(start + 1)
+
+    # Backtrack to find the clusters' boundaries, as indexes in distinct
+    bounds = [len(distinct)]
+    last = nb_groups - 1
+    for start in reversed(best_start):
+        group = start[last]
+        bounds.append(starts[group])
+        last = group - 1
+    bounds.append(0)
+    bounds = numpy.array(bounds[::-1])
+
+    if len(starts) < len(distinct):
+        # Refine with iterations of Lloyd's algorithm, which are cheap on sorted
+        # values
+        weights = numpy.concatenate([[0], numpy.cumsum(counts)])
+        sums = numpy.concatenate([[0], numpy.cumsum(counts * distinct_c)])
+        for _ in range(MAX_CLUSTERING_ITERATIONS):
+            centers = (
+                (sums[bounds[1:]] - sums[bounds[:-1]])
+                / (weights[bounds[1:]] - weights[bounds[:-1]])
+            )
+            new_bounds = bounds.copy()
+            new_bounds[1:-1] = numpy.searchsorted(
+                distinct_c,
+                (centers[:-1] + centers[1:]) / 2,
+                side='right',
+            )
+            if (
+                numpy.array_equal(new_bounds, bounds)
+                or numpy.any(new_bounds[1:] <= new_bounds[:-1])
+            ):
+                break
+            bounds = new_bounds
+
+    logger.info(
+        "Clusters: %r",
+        [(distinct[a], distinct[b - 1]) for a, b in zip(bounds, bounds[1:])],
+    )
+    return numpy.searchsorted(distinct[bounds[1:-1]], values, side='right')
+
+
+RANGE_CLUSTERING_BACKENDS = {
+    'optimal': _cluster_optimal,
+    'kmeans': _cluster_kmeans,
+}
+"""Functions used to cluster values into ranges.
+
+Each one takes the values as a numpy array, the number of clusters, and
+optionally the weight of each value, and returns the label of each value.
+"""
+
+RANGE_CLUSTERING = 'optimal'
+
+
+def get_numerical_ranges(values, clustering=None, weights=None):
     """
     Retrieve the numeral ranges given the input (timestamp, integer, or float).
 
-    This performs K-Means clustering, returning a maximum of 3 ranges.
+    This clusters the values, returning a maximum of 3 ranges.
+
+    :param values: The values, as a list or numpy array
+    :param weights: The number of times each value appears, for values coming
+        from a summary. Defaults to each value appearing once.
+    :param clustering: The clustering backend to use, a key of
+        `RANGE_CLUSTERING_BACKENDS`. Defaults to `RANGE_CLUSTERING`.
     """
 
     if not len(values):
@@ -47,35 +183,54 @@ def get_numerical_ranges(values):
 
     logger.info("Computing numerical ranges, %d values", len(values))
 
-    clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
-                        random_state=0)
-    values_array = numpy.array(values).reshape(-1, 1)
-    with ignore_warnings(ConvergenceWarning):
-        clustering.fit(values_array)
-    logger.info("K-Means clusters: %r", list(clustering.cluster_centers_))
+    if clustering is None:
+        clustering = RANGE_CLUSTERING
+    values = numpy.asarray(values)
+    labels = RANGE_CLUSTERING_BACKENDS[clustering](
+        values,
+        min(N_RANGES, len(values)),
+        weights=weights,
+    )
+    if weights is None:
+        total = len(values)
+    else:
+        weights = numpy.asarray(weights, dtype=numpy.float64)
+        total = weights.sum()
 
     # Compute confidence intervals for each range
     ranges = []
     sizes = []
     for rg in range(N_RANGES):
-        cluster = [values[i]
-                   for i in range(len(values))
-                   if clustering.labels_[i] == rg]
-        if not cluster:
+        cluster = values[labels == rg]
+        if not len(cluster):
             continue
 
+        if weights is None:
+            cluster = numpy.sort(cluster)
+            size = len(cluster)
+            min_idx = int(0.05 * size)
+            max_idx = int(0.95 * size)
+        else:
+            cluster_weights = weights[labels == rg]
+            order = numpy.argsort(cluster, kind='stable')
+            cluster = cluster[order]
+            cumulative = numpy.cumsum(cluster_weights[order])
+            size = cumulative[-1]
+            min_idx, max_idx = numpy.searchsorted(
+                cumulative,
+                [int(0.05 * size), int(0.95 * size)],
+                side='right',
+            ).clip(0, len(cluster) - 1)
+
         # Eliminate clusters of outliers
-        if len(cluster) < MIN_RANGE_SIZE * len(values):
+        if size < MIN_RANGE_SIZE * total:
             continue
 
-        cluster.sort()
-        min_idx = int(0.05 * len(cluster))
-        max_idx = int(0.95 * len(cluster))
         ranges.append([
             cluster[min_idx],
             cluster[max_idx],
         ])
-        sizes.append(len(cluster))
+        sizes.append(size)
     ranges.sort()
     logger.info("Ranges: %r", ranges)
     logger.info("Sizes: %r", sizes)
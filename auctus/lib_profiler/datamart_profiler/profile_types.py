@@ -1,13 +1,15 @@
 import collections
-from datetime import datetime
+from datetime import datetime, timedelta
 import dateutil.tz
+import numpy
 import opentelemetry.trace
+import pandas
 import re
 import regex
 
 from . import types
 from .spatial import LATITUDE, LONGITUDE, disambiguate_admin_areas
-from .temporal import parse_date
+from .temporal import parse_date_list
 
 
 tracer = opentelemetry.trace.get_tracer(__name__)
@@ -92,8 +94,306 @@ TEXT_WORDS_THRESHOLD = 0.5  # 50%
 MAX_CATEGORICAL_RATIO = 0.10  # 10%
 
 
+# Structural types in the order they are tried, first match wins
+_structural_regexes = [
+    ('int', _re_int),
+    ('float', _re_float),
+    ('url', _re_url),
+    ('file', _re_file),
+    ('point', _re_wkt_point),
+    ('geo_combined', _re_geo_combined),
+    ('other_point', _re_other_point),
+    ('latlong_point', _re_latlong_point),
+    ('polygon', _re_wkt_polygon),
+]
+# A single alternation with a named group per type: the first alternative to
+# match gives the type, so only a single match() call is needed per value.
+# _re_geo_combined needs the 'regex' module for Unicode properties, so it is
+# left out and checked separately (it is rare, and only needed if no type
+# before it matched)
+_re_structural = re.compile('|'.join(
+    '(?P<%s>%s)' % (name, pattern.pattern)
+    for name, pattern in _structural_regexes
+    if name != 'geo_combined'
+))
+_before_geo_combined = {'int', 'float', 'url', 'file', 'point'}
+
+_bool_values = ('0', '1', 'true', 'false', 'y', 'n', 'yes', 'no')
+
+
+def _count_whitespace_runs(elem):
+    # Same as len(_re_whitespace.findall(elem)), str.split() uses the same
+    # definition of whitespace as the re module
+    words = elem.split()
+    if not words:
+        return 1 if elem else 0
+    return len(words) - 1 + elem[0].isspace() + elem[-1].isspace()
+
+
+def _structural_type_key(elem):
+    m = _re_structural.match(elem)
+    key = m.lastgroup if m is not None else None
+    if (
+        key not in _before_geo_combined
+        and elem[-1:] == ')'
+        and _re_geo_combined.match(elem)
+    ):
+        key = 'geo_combined'
+    elif (
+        key is None
+        and _count_whitespace_runs(elem) >= TEXT_WORDS - 1
+    ):
+        key = 'text'
+    return key
+
+
+def native_values(array):
+    """Get the values of a column that has a native numerical or time type.
+
+    This is the case for columns loaded from typed formats like Parquet, the
+    values can be used directly instead of parsing strings.
+
+    :return: A numpy array of numbers or of UTC datetime64, or None if the
+        column has no such type (e.g. strings)
+    """
+    dtype = getattr(array, 'dtype', None)
+    if dtype is None or pandas.api.types.is_bool_dtype(dtype):
+        return None
+    elif pandas.api.types.is_datetime64_any_dtype(dtype):
+        array = pandas.DatetimeIndex(array)
+        if array.tz is not None:
+            array = array.tz_convert('UTC').tz_localize(None)
+        return numpy.asarray(array, dtype='datetime64[ns]')
+    elif pandas.api.types.is_numeric_dtype(dtype):
+        if pandas.api.types.is_extension_array_dtype(dtype):
+            # Nullable types, e.g. 'Int64'
+            return numpy.asarray(
+                array.to_numpy(dtype=numpy.float64, na_value=numpy.nan),
+            )
+        return numpy.asarray(array)
+    return None
+
+
+class DistinctValues(object):
+    """The distinct values of a column, with the number of times they appear.
+
+    Values are kept in the order in which they first appear in the column.
+    Anything that only depends on the value can be computed once per distinct
+    value, then weighted by ``counts``, or expanded back to every row of the
+    column with :meth:`expand`.
+    """
+    def __init__(self, array):
+        typed = native_values(array)
+        if typed is not None:
+            array = typed
+        else:
+            array = numpy.asarray(array, dtype=object)
+        self.codes, self.values = pandas.factorize(
+            array,
+            use_na_sentinel=False,
+        )
+        self.counts = numpy.bincount(self.codes, minlength=len(self.values))
+        self.total = len(self.codes)
+
+    def __len__(self):
+        return len(self.values)
+
+    def items(self):
+        """Iterate on ``(value, count)`` pairs.
+        """
+        return zip(self.values, self.counts.tolist())
+
+    def map(self, func):
+        """Apply a function to each distinct value, returns a list.
+        """
+        return [func(value) for value in self.values]
+
+    def expand(self, results):
+        """Turn a list of results for each distinct value into one per row.
+        """
+        return [results[code] for code in self.codes.tolist()]
+
+    def count_rows(self, results):
+        """Count the rows for which the result is not None.
+
+        :param results: A list with a result for each distinct value
+        """
+        valid = numpy.array([r is not None for r in results], dtype=bool)
+        return int(self.counts[valid].sum())
+
+
+_epoch = datetime(1970, 1, 1, tzinfo=dateutil.tz.UTC)
+_microsecond = timedelta(microseconds=1)
+
+# Values outside of this range overflow in Elasticsearch
+MAX_FLOAT = 3.4e38
+
+
+def _parse_floats(values):
+    try:
+        floats = numpy.asarray(values, dtype=object).astype(numpy.float64)
+    except (ValueError, TypeError):
+        # Some values don't parse, go over them one by one
+        floats = numpy.array(
+            [_parse_float(elem) for elem in values],
+            dtype=numpy.float64,
+        )
+    with numpy.errstate(invalid='ignore'):
+        floats[~((-MAX_FLOAT < floats) & (floats < MAX_FLOAT))] = numpy.nan
+    return floats
+
+
+class ColumnView(DistinctValues):
+    """Typed view of a column.
+
+    Each distinct value is parsed only once, and the results are turned into
+    numpy arrays with an entry per row, that are shared by the different steps
+    of profiling instead of parsing the column again.
+    """
+    def __init__(self, array):
+        super(ColumnView, self).__init__(array)
+        self._distinct_floats = None
+        self._type_counts = None
+
+    @property
+    def native(self):
+        """Whether the column has a native type, see :func:`native_values`.
+        """
+        return self.values.dtype != object
+
+    @property
+    def missing(self):
+        """Whether each distinct value is missing (NaN or NaT).
+
+        Only for columns with a native type.
+        """
+        if self.values.dtype.kind == 'M':
+            return numpy.isnat(self.values)
+        return numpy.isnan(self.values)
+
+    @property
+    def num_distinct(self):
+        """Number of distinct values that are not empty or missing.
+        """
+        if self.native:
+            return int(numpy.count_nonzero(~self.missing))
+        return int(numpy.count_nonzero(self.values.astype(bool)))
+
+    @property
+    def type_counts(self):
+        """Number of values matching the structure of each data type.
+
+        See :func:`regular_exp_count`. For columns with a native type, the
+        values are counted as 'empty', 'int', 'float' or 'bool' from their
+        type instead.
+        """
+        if self._type_counts is None:
+            if self.native:
+                self._type_counts = _native_type_counts(self)
+            else:
+                self._type_counts = regular_exp_count(self)
+        return self._type_counts
+
+    @property
+    def distinct_floats(self):
+        """Each distinct value as a float64, NaN if it is not a valid number.
+        """
+        if self._distinct_floats is None:
+            if self.native:
+                floats = self.values.astype(numpy.float64)
+                with numpy.errstate(invalid='ignore'):
+                    floats[~((-MAX_FLOAT < floats) & (floats < MAX_FLOAT))] = \
+                        numpy.nan
+                self._distinct_floats = floats
+            else:
+                self._distinct_floats = _parse_floats(self.values)
+        return self._distinct_floats
+
+    @property
+    def distinct_datetimes(self):
+        """Each distinct value as a UTC datetime, None if it is missing.
+
+        Only for columns with a datetime64 type.
+        """
+        return [
+            dt.replace(tzinfo=dateutil.tz.UTC) if dt is not None else None
+            for dt in self.values.astype('datetime64[us]').tolist()
+        ]
+
+    @property
+    def floats(self):
+        """The rows as float64, NaN where they are not a valid number.
+        """
+        return self.distinct_floats[self.codes]
+
+    def timestamps(self, datetimes):
+        """Get the timestamps of the rows, from datetimes parsed from them.
+
+        :param datetimes: A list with a datetime or None for each distinct
+            value
+        :return: A numpy int64 array of microseconds since the epoch, for each
+            row that has a datetime, in order
+        """
+        valid = numpy.array([dt is not None for dt in datetimes], dtype=bool)
+        distinct_timestamps = numpy.array(
+            [
+                (dt - _epoch) // _microsecond if dt is not None else 0
+                for dt in datetimes
+            ],
+            dtype=numpy.int64,
+        )
+        rows = self.codes[valid[self.codes]]
+        return distinct_timestamps[rows]
+
+
 def regular_exp_count(array):
     """Count instances matching the structure of each data type, using regexes.
+
+    Each distinct value is only matched once, using a single combined regex.
+    This is equivalent to :func:`regular_exp_count_reference`.
+
+    :param array: The list, series, or array to inspect, or a
+        :class:`DistinctValues` built from it
+    """
+    if not isinstance(array, DistinctValues):
+        array = DistinctValues(array)
+
+    re_count = collections.Counter()
+
+    for elem, count in array.items():
+        if not elem:
+            re_count['empty'] += count
+            continue
+        key = _structural_type_key(elem)
+        if key is not None:
+            re_count[key] += count
+        if elem.lower() in _bool_values:
+            re_count['bool'] += count
+
+    return re_count
+
+
+def _native_type_counts(view):
+    re_count = collections.Counter()
+    re_count['empty'] = int(view.counts[view.missing].sum())
+    if view.values.dtype.kind != 'M':
+        values = view.values.astype(numpy.float64)
+        with numpy.errstate(invalid='ignore'):
+            finite = numpy.isfinite(values)
+            integers = finite & (values == numpy.floor(values))
+        re_count['int'] = int(view.counts[integers].sum())
+        re_count['float'] = int(view.counts[finite & ~integers].sum())
+        if view.values.dtype.kind in 'iu':
+            bools = (view.values == 0) | (view.values == 1)
+            re_count['bool'] = int(view.counts[bools].sum())
+    return +re_count
+
+
+def regular_exp_count_reference(array):
+    """Count instances matching the structure of each data type, using regexes.
+
+    This goes over the values one by one, trying each regex in turn. It is
+    slow, but kept as the reference for :func:`regular_exp_count`.
     """
     re_count = collections.Counter()
 
@@ -120,7 +420,7 @@ def regular_exp_count(array):
             re_count['polygon'] += 1
         elif len(_re_whitespace.findall(elem)) >= TEXT_WORDS - 1:
             re_count['text'] += 1
-        if elem.lower() in ('0', '1', 'true', 'false', 'y', 'n', 'yes', 'no'):
+        if elem.lower() in _bool_values:
             re_count['bool'] += 1
 
     return re_count
@@ -152,16 +452,112 @@ def unclean_values_ratio(c_type, re_count, num_total):
 
 def parse_dates(array):
     """Parse the valid dates in an array of strings.
+
+    Each distinct value is only parsed once, see :func:`parse_date_list`.
+
+    :param array: The list, series, or array to parse, or a
+        :class:`DistinctValues` built from it
     """
-    parsed_dates = []
-    for elem in array:
-        elem = parse_date(elem)
-        if elem is not None:
-            parsed_dates.append(elem)
-    return parsed_dates
+    if not isinstance(array, DistinctValues):
+        array = DistinctValues(array)
+    parsed_dates = array.expand(parse_date_list(array.values))
+    return [elem for elem in parsed_dates if elem is not None]
+
+
+def _parse_year(year):
+    try:
+        return datetime(int(year), 1, 1, tzinfo=dateutil.tz.UTC)
+    except (ValueError, OverflowError):  # OverflowError for infinity
+        return None
+
+
+def _parse_float(elem):
+    try:
+        return float(elem)
+    except ValueError:
+        return None
+
+
+def _identify_native_types(view, name):
+    """Identify types of a column with a native type.
+
+    Same as :func:`identify_types`, but the structural type comes from the
+    values' type instead of regexes. Numbers are not parsed as dates (except
+    for the 'year' special-case).
+    """
+    num_total = view.total
+    column_meta = {}
+    semantic_types_dict = {}
+
+    missing = view.missing
+    num_empty = int(view.counts[missing].sum())
+    if num_empty == num_total:
+        return types.MISSING_DATA, semantic_types_dict, column_meta
+    elif num_empty > 0:
+        column_meta['missing_values_ratio'] = num_empty / num_total
+    num_distinct = view.num_distinct
+    threshold = max(1, (1.0 - MAX_UNCLEAN) * (num_total - num_empty))
+
+    if view.values.dtype.kind == 'M':
+        column_meta['num_distinct_values'] = num_distinct
+        semantic_types_dict[types.DATE_TIME] = view.distinct_datetimes
+        return types.TEXT, semantic_types_dict, column_meta
+
+    # Integers can be stored as floats, e.g. if there are missing values
+    values = view.values.astype(numpy.float64)
+    with numpy.errstate(invalid='ignore'):
+        integers = numpy.isfinite(values) & (values == numpy.floor(values))
+    num_int = int(view.counts[integers].sum())
+    if num_int >= threshold:
+        structural_type = types.INTEGER
+        num_valid = num_int
+    else:
+        structural_type = types.FLOAT
+        num_valid = int(view.counts[numpy.isfinite(values)].sum())
+    column_meta['unclean_values_ratio'] = \
+        (num_total - num_empty - num_valid) / num_total
+
+    # Identify booleans
+    if view.values.dtype.kind in 'iu':
+        bools = (view.values == 0) | (view.values == 1)
+        num_bool = int(view.counts[bools].sum())
+        if num_bool >= threshold:
+            semantic_types_dict[types.BOOLEAN] = None
+            column_meta['unclean_values_ratio'] = \
+                (num_total - num_empty - num_bool) / num_total
+
+    if structural_type == types.INTEGER:
+        # Identify ids
+        if (name.lower().startswith('id') or
+                name.lower().endswith('id') or
+                name.lower().startswith('identifier') or
+                name.lower().endswith('identifier') or
+                name.lower().startswith('index') or
+                name.lower().endswith('index')):
+            semantic_types_dict[types.ID] = None
+
+        column_meta['num_distinct_values'] = num_distinct
+
+        # Identify years
+        if name.strip().lower() == 'year':
+            dates = view.map(_parse_year)
+            if view.count_rows(dates) >= threshold:
+                structural_type = types.TEXT
+                semantic_types_dict[types.DATE_TIME] = dates
+    else:
+        # Identify lat/long
+        floats = view.distinct_floats
+        num_long = view.counts[(-180.0 <= floats) & (floats <= 180.0)].sum()
+        num_lat = view.counts[(-90.0 <= floats) & (floats <= 90.0)].sum()
+        if num_lat >= threshold and any(n in name.lower() for n in LATITUDE):
+            semantic_types_dict[types.LATITUDE] = None
+        if num_long >= threshold and any(n in name.lower() for n in LONGITUDE):
+            semantic_types_dict[types.LONGITUDE] = None
+
+    return structural_type, semantic_types_dict, column_meta
 
 
-def identify_types(array, name, geo_data, manual=None):
+def identify_types(array, name, geo_data, manual=None, view=None):
     """Identify the structural type and semantic types of an array.
 
     :param array: The list, series, or array to inspect
@@ -169,18 +565,26 @@ def identify_types(array, name, geo_data, manual=None):
         heuristics like latitude, longitude, year number.
     :param manual: Manual information provided by the user that will be
         reconciled with the observed data.
+    :param view: The :class:`ColumnView` of the array, if it has already been
+        built.
     :return: A tuple ``(structural_type, semantic_types_dict, column_meta)``
         where `structural_type` is the detected structural type (e.g. storage
         format), `semantic_types_dict` is a dict mapping semantic types (e.g.
         meaning) to parsed values for further processing, and `column_meta`
         contains additional information about the column (not related to type).
+        Datetimes are given for each distinct value of `view`, None if it
+        didn't parse.
     """
-    num_total = len(array)
+    if view is None:
+        view = ColumnView(array)
+    if view.native and not manual:
+        return _identify_native_types(view, name)
+    num_total = view.total
     column_meta = {}
 
     # This function let you check/count how many instances match a structure of particular data type
     with tracer.start_as_current_span('profile/regular_exp_count'):
-        re_count = regular_exp_count(array)
+        re_count = view.type_counts
 
     # Identify structural type and compute unclean values ratio
     threshold = max(1, (1.0 - MAX_UNCLEAN) * (num_total - re_count['empty']))
@@ -211,7 +615,8 @@ def identify_types(array, name, geo_data, manual=None):
     if structural_type != types.MISSING_DATA and re_count['empty'] > 0:
         column_meta['missing_values_ratio'] = re_count['empty'] / num_total
 
-    distinct_values = set(e for e in array if e)
+    # The distinct values are already in the view, only count them
+    num_distinct = view.num_distinct
 
     semantic_types_dict = {}
     if manual:
@@ -223,11 +628,13 @@ def identify_types(array, name, geo_data, manual=None):
                 column_meta['unclean_values_ratio'] = \
                     unclean_values_ratio(types.BOOLEAN, re_count, num_total)
             if el == types.DATE_TIME:
-                dates = parse_dates(array)
+                dates = parse_date_list(view.values)
                 semantic_types_dict[types.DATE_TIME] = dates
             if el == types.ADMIN:
-                if geo_data is not None and len(distinct_values) >= 3:
-                    admin_areas = geo_data.resolve_names_all(array)
+                if geo_data is not None and num_distinct >= 3:
+                    admin_areas = view.expand(
+                        geo_data.resolve_names_all(view.values),
+                    )
                     admin_areas = [r for r in admin_areas if r]
                     if admin_areas:
                         admin_areas = disambiguate_admin_areas(admin_areas)
@@ -235,9 +642,7 @@ def identify_types(array, name, geo_data, manual=None):
                             semantic_types_dict[types.ADMIN] = admin_areas
             if el == types.CATEGORICAL or el == types.INTEGER:
                 # Count distinct values
-                column_meta['num_distinct_values'] = len(distinct_values)
-                if el == types.CATEGORICAL:
-                    semantic_types_dict[types.CATEGORICAL] = distinct_values
+                column_meta['num_distinct_values'] = num_distinct
     else:
         num_bool = re_count['bool']
         num_text = re_count['text']
@@ -263,11 +668,13 @@ def identify_types(array, name, geo_data, manual=None):
                 semantic_types_dict[types.FILE_PATH] = None
 
             # Administrative areas
-            if geo_data is not None and len(distinct_values) >= 3:
+            if geo_data is not None and num_distinct >= 3:
                 with tracer.start_as_current_span('profile/admin_areas'):
-                    admin_areas = geo_data.resolve_names_all(distinct_values)
+                    admin_areas = geo_data.resolve_names_all(
+                        [value for value in view.values if value],
+                    )
                     admin_areas = [r for r in admin_areas if r]
-                    if len(admin_areas) > 0.7 * len(distinct_values):
+                    if len(admin_areas) > 0.7 * num_distinct:
 
                         admin_areas = disambiguate_admin_areas(admin_areas)
                         if admin_areas is not None:
@@ -284,14 +691,14 @@ def identify_types(array, name, geo_data, manual=None):
                 semantic_types_dict[types.TEXT] = None
             else:
                 # Count distinct values
-                column_meta['num_distinct_values'] = len(distinct_values)
-                max_categorical = MAX_CATEGORICAL_RATIO * (len(array) - num_empty)
+                column_meta['num_distinct_values'] = num_distinct
+                max_categorical = MAX_CATEGORICAL_RATIO * (num_total - num_empty)
                 if (
                     categorical or
-                    len(distinct_values) <= max_categorical or
+                    num_distinct <= max_categorical or
                     types.BOOLEAN in semantic_types_dict
                 ):
-                    semantic_types_dict[types.CATEGORICAL] = distinct_values
+                    semantic_types_dict[types.CATEGORICAL] = None
         elif structural_type == types.INTEGER:
             # Identify ids
             # TODO: is this enough?
@@ -305,38 +712,26 @@ def identify_types(array, name, geo_data, manual=None):
                 semantic_types_dict[types.ID] = None
 
             # Count distinct values
-            column_meta['num_distinct_values'] = len(distinct_values)
+            column_meta['num_distinct_values'] = num_distinct
 
             # Identify years
             if name.strip().lower() == 'year':
                 with tracer.start_as_current_span('profile/parse_years'):
-                    dates = []
-                    for year in array:
-                        try:
-                            dates.append(datetime(
-                                int(year), 1, 1,
-                                tzinfo=dateutil.tz.UTC,
-                            ))
-                        except ValueError:
-                            pass
-                    if len(dates) >= threshold:
+                    dates = view.map(_parse_year)
+                    if view.count_rows(dates) >= threshold:
                         structural_type = types.TEXT
                         semantic_types_dict[types.DATE_TIME] = dates
 
         # Identify lat/long
         if structural_type == types.FLOAT:
             with tracer.start_as_current_span('profile/parse_latlong'):
-                num_lat = num_long = 0
-                for elem in array:
-                    try:
-                        elem = float(elem)
-                    except ValueError:
-                        pass
-                    else:
-                        if -180.0 <= float(elem) <= 180.0:
-                            num_long += 1
-                            if -90.0 <= float(elem) <= 90.0:
-                                num_lat += 1
+                floats = view.distinct_floats
+                num_long = view.counts[
+                    (-180.0 <= floats) & (floats <= 180.0)
+                ].sum()
+                num_lat = view.counts[
+                    (-90.0 <= floats) & (floats <= 90.0)
+                ].sum()
 
                 if num_lat >= threshold and any(n in name.lower() for n in LATITUDE):
                     semantic_types_dict[types.LATITUDE] = None
@@ -345,9 +740,9 @@ def identify_types(array, name, geo_data, manual=None):
 
         # Identify dates
         with tracer.start_as_current_span('profile/parse_dates'):
-            parsed_dates = parse_dates(array)
+            parsed_dates = parse_date_list(view.values)
 
-        if len(parsed_dates) >= threshold:
+        if view.count_rows(parsed_dates) >= threshold:
             semantic_types_dict[types.DATE_TIME] = parsed_dates
             if structural_type == types.INTEGER:
                 # 'YYYYMMDD' format means values can be parsed as integers, but
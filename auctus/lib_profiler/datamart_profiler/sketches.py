@@ -0,0 +1,485 @@
+import base64
+import collections
+from datetime import datetime
+import dateutil.tz
+import math
+import numpy
+import pandas
+import zlib
+
+
+DISTINCT_ERROR = 0.02  # 2%
+"""Target relative error (standard error) on the number of distinct values.
+
+HyperLogLog uses ``2 ** p`` registers for a standard error of about
+``1.04 / sqrt(2 ** p)``, the smallest `p` that reaches this target is used.
+"""
+
+MAX_EXACT_DISTINCT = 1000
+"""Number of distinct values under which they are counted exactly.
+
+The hashes of the values are kept until there are more of them, which is
+enough for the categorical decision on small columns, that are the ones where
+a small error would change it.
+"""
+
+SUMMARY_SIZE = 200
+"""Maximum number of centroids kept to summarize the distribution of values.
+
+If there are fewer distinct values than this, the summary is exact.
+"""
+
+SKETCHES_VERSION = 1
+
+_epoch = datetime(1970, 1, 1, tzinfo=dateutil.tz.UTC)
+
+
+def hash_values(values):
+    """Hash values to 64-bit integers, the same way in every process.
+
+    :param values: A numpy array or list of values
+    :return: A numpy uint64 array
+    """
+    values = numpy.asarray(values)
+    if values.dtype.kind == 'M':
+        values = values.astype(numpy.int64)
+    elif values.dtype.kind not in 'biuf':
+        values = values.astype(object)
+    return pandas.util.hash_array(values, categorize=False)
+
+
+def _bit_length(values):
+    # Number of bits needed to represent each uint64, computed on 32-bit halves
+    # so the conversion to floats is exact
+    high = (values >> numpy.uint64(32)).astype(numpy.float64)
+    low = (values & numpy.uint64(0xFFFFFFFF)).astype(numpy.float64)
+    return numpy.where(
+        high > 0,
+        32 + numpy.frexp(high)[1],
+        numpy.frexp(low)[1],
+    )
+
+
+def precision_for_error(error):
+    """Get the HyperLogLog precision that reaches a given standard error.
+    """
+    precision = math.ceil(2 * math.log2(1.04 / error))
+    return min(max(precision, 4), 18)
+
+
+def _sigma(x):
+    if x == 1.0:
+        return math.inf
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        z_old = z
+        z += x * y
+        y += y
+        if z == z_old:
+            return z
+
+
+def _tau(x):
+    if x == 0.0 or x == 1.0:
+        return 0.0
+    y = 1.0
+    z = 1.0 - x
+    while True:
+        x = math.sqrt(x)
+        z_old = z
+        y *= 0.5
+        z -= (1.0 - x) ** 2 * y
+        if z == z_old:
+            return z / 3.0
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values in constant memory.
+
+    Two sketches built from different parts of the data can be merged, the
+    result is the same as if it had been built from all the data at once.
+    """
+    def __init__(self, precision=None, registers=None):
+        if precision is None:
+            precision = precision_for_error(DISTINCT_ERROR)
+        self.precision = precision
+        if registers is None:
+            registers = numpy.zeros(2 ** precision, dtype=numpy.uint8)
+        self.registers = registers
+
+    def add(self, values):
+        """Add values, as a numpy array or list.
+        """
+        self.add_hashes(hash_values(values))
+
+    def add_hashes(self, hashes):
+        """Add values from their 64-bit hashes, see :func:`hash_values`.
+        """
+        if not len(hashes):
+            return
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        value_bits = 64 - self.precision
+        index = (hashes >> numpy.uint64(value_bits)).astype(numpy.intp)
+        rest = hashes & numpy.uint64((1 << value_bits) - 1)
+        rank = (value_bits + 1 - _bit_length(rest)).astype(numpy.uint8)
+        numpy.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(
+                "Can't merge HyperLogLog sketches with different precisions",
+            )
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+    @property
+    def error(self):
+        """The relative standard error of :meth:`count`.
+        """
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def count(self):
+        """Estimate the number of distinct values.
+
+        This uses the estimator from Otmar Ertl's "New cardinality estimation
+        algorithms for HyperLogLog sketches", which doesn't need the empirical
+        bias correction of HyperLogLog++ for small cardinalities.
+        """
+        m = len(self.registers)
+        q = 64 - self.precision
+        histogram = numpy.bincount(self.registers, minlength=q + 2).tolist()
+        z = m * _tau(1.0 - histogram[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += m * _sigma(histogram[0] / m)
+        return int(round(m * m / (2.0 * math.log(2.0) * z)))
+
+    def to_json(self):
+        return {
+            'precision': self.precision,
+            'registers': base64.b64encode(
+                zlib.compress(self.registers.tobytes()),
+            ).decode('ascii'),
+        }
+
+    @classmethod
+    def from_json(cls, obj):
+        registers = numpy.frombuffer(
+            zlib.decompress(base64.b64decode(obj['registers'])),
+            dtype=numpy.uint8,
+        ).copy()
+        return cls(obj['precision'], registers)
+
+
+class DistinctCounter(object):
+    """Count distinct values, exactly for few values, else using HyperLogLog.
+
+    The hashes of the values are kept until there are more than
+    `MAX_EXACT_DISTINCT`, then only the :class:`HyperLogLog` is updated.
+    """
+    def __init__(self, hll=None, hashes=None):
+        if hll is None:
+            hll = HyperLogLog()
+        self.hll = hll
+        if hashes is None:
+            hashes = numpy.zeros(0, dtype=numpy.uint64)
+        self.hashes = hashes
+
+    @property
+    def exact(self):
+        return self.hashes is not None
+
+    def add(self, values):
+        """Add values, as a numpy array or list.
+        """
+        hashes = hash_values(values)
+        self.hll.add_hashes(hashes)
+        self._add_exact(hashes)
+
+    def _add_exact(self, hashes):
+        if self.hashes is None:
+            return
+        if len(self.hashes) + len(hashes) > 2 * MAX_EXACT_DISTINCT:
+            # Too many values, this can only increase, stop here
+            self.hashes = None
+            return
+        self.hashes = numpy.union1d(self.hashes, hashes)
+        if len(self.hashes) > MAX_EXACT_DISTINCT:
+            self.hashes = None
+
+    def merge(self, other):
+        self.hll.merge(other.hll)
+        if other.hashes is None:
+            self.hashes = None
+        else:
+            self._add_exact(other.hashes)
+
+    def count(self):
+        if self.hashes is not None:
+            return len(self.hashes)
+        return self.hll.count()
+
+    def to_json(self):
+        obj = self.hll.to_json()
+        if self.hashes is not None:
+            obj['hashes'] = base64.b64encode(
+                zlib.compress(self.hashes.astype('<u8').tobytes()),
+            ).decode('ascii')
+        return obj
+
+    @classmethod
+    def from_json(cls, obj):
+        hashes = None
+        if 'hashes' in obj:
+            hashes = numpy.frombuffer(
+                zlib.decompress(base64.b64decode(obj['hashes'])),
+                dtype='<u8',
+            ).astype(numpy.uint64)
+        return cls(HyperLogLog.from_json(obj), hashes)
+
+
+class NumericalSummary(object):
+    """Mergeable summary of the distribution of numbers.
+
+    This keeps the count, mean, and sum of squared differences from the mean
+    (Welford's algorithm, merged with Chan's formula), the minimum and maximum,
+    and a small number of weighted centroids that approximate the distribution.
+    """
+    def __init__(self, size=SUMMARY_SIZE):
+        self.size = size
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.values = numpy.zeros(0, dtype=numpy.float64)
+        self.weights = numpy.zeros(0, dtype=numpy.float64)
+
+    def add(self, values, weights=None):
+        """Add numbers, NaN are ignored.
+
+        :param values: The numbers, as a numpy array or list
+        :param weights: The number of times each number appears, defaults to
+            once
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if weights is None:
+            weights = numpy.ones(len(values), dtype=numpy.float64)
+        else:
+            weights = numpy.asarray(weights, dtype=numpy.float64)
+        valid = ~numpy.isnan(values) & (weights > 0)
+        values = values[valid]
+        weights = weights[valid]
+        if not len(values):
+            return
+
+        other = NumericalSummary(self.size)
+        other.count = int(weights.sum())
+        other.mean = float(numpy.average(values, weights=weights))
+        other.m2 = float(numpy.sum(
+            weights * numpy.square(values - other.mean),
+        ))
+        other.min = float(values.min())
+        other.max = float(values.max())
+        other.values = values
+        other.weights = weights
+        self.merge(other)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        if not self.count:
+            self.mean, self.m2 = other.mean, other.m2
+            self.min, self.max = other.min, other.max
+        else:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += (
+                other.m2
+                + delta * delta * self.count * other.count / count
+            )
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.count += other.count
+        self._compress(
+            numpy.concatenate([self.values, other.values]),
+            numpy.concatenate([self.weights, other.weights]),
+        )
+
+    def _compress(self, values, weights):
+        # Combine equal values
+        values, inverse = numpy.unique(values, return_inverse=True)
+        weights = numpy.bincount(inverse, weights=weights)
+
+        # Group consecutive values into centroids of about the same weight
+        if len(values) > self.size:
+            cumulative = numpy.cumsum(weights)
+            starts = numpy.searchsorted(
+                cumulative,
+                numpy.arange(self.size) * (cumulative[-1] / self.size),
+                side='right',
+            )
+            starts = numpy.unique(starts)
+            sums = numpy.add.reduceat(values * weights, starts)
+            weights = numpy.add.reduceat(weights, starts)
+            values = sums / weights
+
+        self.values = values
+        self.weights = weights
+
+    def scale(self, factor):
+        """Multiply the weight of every value, e.g. to account for sampling.
+        """
+        self.count = int(round(self.count * factor))
+        self.m2 *= factor
+        self.weights = self.weights * factor
+
+    @property
+    def stddev(self):
+        if not self.count:
+            return 0.0
+        return math.sqrt(self.m2 / self.count)
+
+    def histogram(self, bins=10):
+        """Approximate histogram of the values, between minimum and maximum.
+
+        :return: ``(counts, edges)`` like ``numpy.histogram()``
+        """
+        counts, edges = numpy.histogram(
+            self.values,
+            bins=bins,
+            range=(self.min, self.max),
+            weights=self.weights,
+        )
+        return numpy.round(counts).astype(numpy.int64), edges
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self.m2,
+            'min': self.min,
+            'max': self.max,
+            'values': self.values.tolist(),
+            'weights': self.weights.tolist(),
+        }
+
+    @classmethod
+    def from_json(cls, obj, size=SUMMARY_SIZE):
+        summary = cls(size)
+        summary.count = obj['count']
+        summary.mean = obj['mean']
+        summary.m2 = obj['m2']
+        summary.min = obj['min']
+        summary.max = obj['max']
+        summary.values = numpy.array(obj['values'], dtype=numpy.float64)
+        summary.weights = numpy.array(obj['weights'], dtype=numpy.float64)
+        return summary
+
+
+class ColumnSketch(object):
+    """Mergeable state of a column, from which its profile can be updated.
+
+    :ivar total: Number of rows
+    :ivar type_counts: Counter of values matching each data type, see
+        :func:`~datamart_profiler.profile_types.regular_exp_count`
+    :ivar distinct: :class:`DistinctCounter` of the non-empty values
+    :ivar numerical: :class:`NumericalSummary` of the numbers, or None
+    :ivar temporal: :class:`NumericalSummary` of the timestamps, in seconds,
+        or None
+    """
+    def __init__(self, total=0, type_counts=None, distinct=None,
+                 numerical=None, temporal=None):
+        self.total = total
+        self.type_counts = collections.Counter(type_counts or {})
+        if distinct is None:
+            distinct = DistinctCounter()
+        self.distinct = distinct
+        self.numerical = numerical
+        self.temporal = temporal
+
+    def merge(self, other):
+        self.total += other.total
+        self.type_counts.update(other.type_counts)
+        self.distinct.merge(other.distinct)
+        for attr in ('numerical', 'temporal'):
+            mine, theirs = getattr(self, attr), getattr(other, attr)
+            if mine is None:
+                setattr(self, attr, theirs)
+            elif theirs is not None:
+                mine.merge(theirs)
+
+    def scale(self, factor):
+        """Multiply the counts, e.g. to account for sampling.
+        """
+        self.total = int(round(self.total * factor))
+        for key, count in self.type_counts.items():
+            self.type_counts[key] = int(round(count * factor))
+        for summary in (self.numerical, self.temporal):
+            if summary is not None:
+                summary.scale(factor)
+
+    def to_json(self):
+        obj = {
+            'total': self.total,
+            'type_counts': dict(self.type_counts),
+            'distinct': self.distinct.to_json(),
+        }
+        if self.numerical is not None:
+            obj['numerical'] = self.numerical.to_json()
+        if self.temporal is not None:
+            obj['temporal'] = self.temporal.to_json()
+        return obj
+
+    @classmethod
+    def from_json(cls, obj):
+        return cls(
+            total=obj['total'],
+            type_counts=obj['type_counts'],
+            distinct=DistinctCounter.from_json(obj['distinct']),
+            numerical=(
+                NumericalSummary.from_json(obj['numerical'])
+                if 'numerical' in obj else None
+            ),
+            temporal=(
+                NumericalSummary.from_json(obj['temporal'])
+                if 'temporal' in obj else None
+            ),
+        )
+
+
+def build_column_sketch(view, numerical=False, datetimes=None):
+    """Build the sketch of a column.
+
+    :param view: The :class:`~datamart_profiler.profile_types.ColumnView` of
+        the column
+    :param numerical: Whether to summarize the values as numbers
+    :param datetimes: The parsed datetime of each distinct value (or None),
+        if the column holds dates
+    """
+    sketch = ColumnSketch(total=view.total, type_counts=view.type_counts)
+
+    if view.native:
+        sketch.distinct.add(view.values[~view.missing])
+    else:
+        sketch.distinct.add([value for value in view.values if value])
+
+    if numerical:
+        sketch.numerical = NumericalSummary()
+        sketch.numerical.add(view.distinct_floats, view.counts)
+
+    if datetimes is not None:
+        valid = numpy.array([dt is not None for dt in datetimes], dtype=bool)
+        sketch.temporal = NumericalSummary()
+        sketch.temporal.add(
+            [
+                (dt - _epoch).total_seconds()
+                for dt in datetimes
+                if dt is not None
+            ],
+            view.counts[valid],
+        )
+
+    return sketch
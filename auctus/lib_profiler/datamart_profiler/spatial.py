@@ -1,16 +1,19 @@
 import collections
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+import itertools
 import json
 import logging
 import math
 import numpy
 import numpy.random
+import os
 import prometheus_client
 import re
 import requests
-from sklearn.cluster import KMeans
-from sklearn.exceptions import ConvergenceWarning
-from sklearn.neighbors._kd_tree import KDTree
+import requests.adapters
+import sqlite3
+import threading
 import time
 import typing
 from urllib.parse import urlencode
@@ -24,6 +27,9 @@ logger = logging.getLogger(__name__)
 N_RANGES = 3
 MIN_RANGE_SIZE = 0.10  # 10%
 
+MAX_CLUSTERING_POINTS = 50000
+"""Spatial ranges are clustered from a random sample of that many points"""
+
 SPATIAL_RANGE_DELTA_LONG = 0.0001
 SPATIAL_RANGE_DELTA_LAT = 0.0001
 
@@ -32,11 +38,27 @@ MAX_NOMINATIM_REQUESTS = 200
 NOMINATIM_BATCH_SIZE = 20
 NOMINATIM_MIN_SPLIT_BATCH_SIZE = 2  # Batches >=this are divided on failure
 
+NOMINATIM_CONCURRENCY = 4
+"""Number of batch queries sent to Nominatim at the same time"""
+
+NOMINATIM_CACHE_TTL = 30 * 24 * 3600  # 30 days
+"""Time after which an address in the persistent cache is queried again"""
+
+NOMINATIM_CACHE_SIZE = 1000000
+"""Maximum number of addresses in the persistent cache, oldest are evicted"""
+
 LATITUDE = ('latitude', 'lat', 'ycoord', 'y_coord')
 LONGITUDE = ('longitude', 'long', 'lon', 'lng', 'xcoord', 'x_coord')
 
 MAX_WRONG_LEVEL_ADMIN = 0.10  # 10%
 
+MAX_ADMIN_POINTS = 10000
+"""Points are resolved to administrative areas from a random sample of that
+many points"""
+
+MAX_ADMIN_AREAS = 100
+"""Maximum number of administrative areas listed per level"""
+
 
 PROM_NOMINATIM_REQS = prometheus_client.Counter(
     'profile_nominatim_reqs', "Queries to Nominatim",
@@ -46,44 +68,63 @@ PROM_NOMINATIM_REQ_TIME = prometheus_client.Histogram(
 )
 
 
-def get_spatial_ranges(values):
+def get_spatial_ranges(values, max_points=None):
     """Build a small number (3) of bounding boxes from lat/long points.
 
     This performs K-Means clustering, returning a maximum of 3 clusters as
-    bounding boxes.
+    bounding boxes. If there are more than `max_points` points (default:
+    `MAX_CLUSTERING_POINTS`), the clusters are found from a random sample, and
+    every point is then assigned to the closest one.
     """
+    from sklearn.cluster import KMeans
+    from sklearn.exceptions import ConvergenceWarning
+
+    if max_points is None:
+        max_points = MAX_CLUSTERING_POINTS
 
+    values = numpy.asarray(values, dtype=numpy.float64)
     clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
                         random_state=0)
-    with ignore_warnings(ConvergenceWarning):
-        clustering.fit(values)
+    if len(values) > max_points:
+        rnd = numpy.random.RandomState(0)
+        sample = values[rnd.choice(len(values), max_points, replace=False)]
+        with ignore_warnings(ConvergenceWarning):
+            clustering.fit(sample)
+
+        # Assign all the points to the closest cluster
+        distances = numpy.stack(
+            [
+                numpy.square(values - center).sum(axis=1)
+                for center in clustering.cluster_centers_
+            ],
+            axis=1,
+        )
+        labels = distances.argmin(axis=1)
+    else:
+        with ignore_warnings(ConvergenceWarning):
+            clustering.fit(values)
+        labels = clustering.labels_
     logger.info("K-Means clusters: %r", list(clustering.cluster_centers_))
 
     # Compute confidence intervals for each range
     ranges = []
     sizes = []
     for rg in range(N_RANGES):
-        cluster = [values[i]
-                   for i in range(len(values))
-                   if clustering.labels_[i] == rg]
-        if not cluster:
+        cluster = values[labels == rg]
+        if not len(cluster):
             continue
 
         # Eliminate clusters of outliers
         if len(cluster) < MIN_RANGE_SIZE * len(values):
             continue
 
-        cluster.sort(key=lambda p: p[0])
         min_idx = int(0.05 * len(cluster))
         max_idx = int(0.95 * len(cluster))
-        min_lat = cluster[min_idx][0]
-        max_lat = cluster[max_idx][0]
-        cluster.sort(key=lambda p: p[1])
-        min_long = cluster[min_idx][1]
-        max_long = cluster[max_idx][1]
+        lat = numpy.partition(cluster[:, 0], [min_idx, max_idx])
+        long = numpy.partition(cluster[:, 1], [min_idx, max_idx])
         ranges.append([
-            [min_long, max_lat],
-            [max_long, min_lat],
+            [float(long[min_idx]), float(lat[max_idx])],
+            [float(long[max_idx]), float(lat[min_idx])],
         ])
         sizes.append(len(cluster))
     ranges.sort()
@@ -106,6 +147,51 @@ def get_spatial_ranges(values):
     return ranges
 
 
+def merge_spatial_ranges(ranges):
+    """Merge bounding boxes, until there are no more than 3 of them.
+
+    The two boxes whose union has the smallest area are merged first. This is
+    used to combine the ranges from different parts of the data, since the
+    points they were computed from are not available anymore.
+
+    :param ranges: The ranges in Elasticsearch syntax, like returned by
+        :func:`get_spatial_ranges`
+    """
+    boxes = []
+    for rg in ranges:
+        [min_long, max_lat], [max_long, min_lat] = rg['range']['coordinates']
+        boxes.append((min_long, max_long, min_lat, max_lat))
+
+    def union(a, b):
+        return (
+            min(a[0], b[0]), max(a[1], b[1]),
+            min(a[2], b[2]), max(a[3], b[3]),
+        )
+
+    while len(boxes) > N_RANGES:
+        best = None
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                box = union(boxes[i], boxes[j])
+                area = (box[1] - box[0]) * (box[3] - box[2])
+                if best is None or area < best[0]:
+                    best = area, i, j, box
+        _, i, j, box = best
+        boxes[i] = box
+        del boxes[j]
+
+    boxes.sort(key=lambda b: (b[0], b[3], b[1], b[2]))
+    return [
+        {
+            'range': {
+                'type': 'envelope',
+                'coordinates': [[box[0], box[3]], [box[1], box[2]]],
+            },
+        }
+        for box in boxes
+    ]
+
+
 def normalize_latlong_column_name(name, substrings):
     """Find the remainder of the column name after removing a substring.
 
@@ -209,6 +295,14 @@ def parse_wkt_column(values, latlong=False):
 
 
 _nominatim_session = requests.Session()
+_nominatim_session.mount(
+    'http://',
+    requests.adapters.HTTPAdapter(pool_maxsize=NOMINATIM_CONCURRENCY),
+)
+_nominatim_session.mount(
+    'https://',
+    requests.adapters.HTTPAdapter(pool_maxsize=NOMINATIM_CONCURRENCY),
+)
 
 
 def nominatim_query(url, *, q):
@@ -253,79 +347,252 @@ def nominatim_query(url, *, q):
         return res.json()
 
 
-def _nominatim_batch(url, batch, locations, cache):
+class NominatimCache(object):
+    """Persistent cache of the addresses resolved with Nominatim.
+
+    This is an SQLite database, that can be shared by profiler processes.
+    Addresses that were not found are remembered too. Entries expire after
+    `ttl` seconds, and the oldest are evicted when there are more than
+    `max_size`.
+    """
+    def __init__(self, path=None, *, ttl=NOMINATIM_CACHE_TTL,
+                 max_size=NOMINATIM_CACHE_SIZE):
+        if path is None:
+            path = self.get_local_cache_path()
+        self._path = os.path.abspath(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._thread_local = threading.local()
+
+    def __getstate__(self):
+        # Connections can't be sent to another process, only send the path
+        # and open the database again on the other side
+        return {'path': self._path, 'ttl': self.ttl, 'max_size': self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(
+            state['path'], ttl=state['ttl'], max_size=state['max_size'],
+        )
+
+    @staticmethod
+    def get_local_cache_path():
+        """Get the default path of the cache database.
+        """
+        if 'DATAMART_NOMINATIM_CACHE' in os.environ:
+            return os.path.expanduser(os.environ['DATAMART_NOMINATIM_CACHE'])
+        elif 'XDG_CACHE_HOME' in os.environ:
+            cache = os.environ['XDG_CACHE_HOME']
+        else:
+            cache = os.path.expanduser('~/.cache')
+        return os.path.join(cache, 'datamart-nominatim.sqlite3')
+
+    @property
+    def _database(self):
+        # SQLite3 doesn't allow concurrent access from different threads,
+        # so we create a separate connection per thread
+        tl = self._thread_local
+        try:
+            database = tl.database
+        except AttributeError:
+            dirname = os.path.dirname(self._path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            database = sqlite3.connect(self._path, timeout=30)
+            database.executescript(
+                '''
+                CREATE TABLE IF NOT EXISTS addresses(
+                    address TEXT PRIMARY KEY,
+                    latitude REAL,
+                    longitude REAL,
+                    time REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS addresses_time
+                    ON addresses(time);
+                '''
+            )
+            tl.database = database
+        return database
+
+    def get_many(self, addresses):
+        """Look up addresses.
+
+        :return: A dict with the addresses that are in the cache, mapped to a
+            ``(latitude, longitude)`` tuple or None if they were not found.
+        """
+        results = {}
+        addresses = list(addresses)
+        oldest = time.time() - self.ttl
+        for start in range(0, len(addresses), 500):
+            chunk = addresses[start:start + 500]
+            cur = self._database.execute(
+                '''
+                SELECT address, latitude, longitude FROM addresses
+                WHERE time >= ? AND address IN (%s);
+                ''' % ', '.join('?' * len(chunk)),
+                [oldest] + chunk,
+            )
+            for address, latitude, longitude in cur:
+                if latitude is None:
+                    results[address] = None
+                else:
+                    results[address] = latitude, longitude
+        return results
+
+    def set_many(self, locations):
+        """Store addresses, and evict old entries.
+
+        :param locations: A dict mapping addresses to a
+            ``(latitude, longitude)`` tuple, or None if they were not found.
+        """
+        now = time.time()
+        database = self._database
+        with database:
+            database.executemany(
+                '''
+                INSERT OR REPLACE INTO addresses(
+                    address, latitude, longitude, time
+                ) VALUES (?, ?, ?, ?);
+                ''',
+                [
+                    (address, loc[0], loc[1], now) if loc is not None
+                    else (address, None, None, now)
+                    for address, loc in locations.items()
+                ],
+            )
+            database.execute(
+                '''
+                DELETE FROM addresses WHERE time < ?;
+                ''',
+                (now - self.ttl,),
+            )
+            excess, = database.execute(
+                '''
+                SELECT count(*) - ? FROM addresses;
+                ''',
+                (self.max_size,),
+            ).fetchone()
+            if excess > 0:
+                database.execute(
+                    '''
+                    DELETE FROM addresses WHERE address IN (
+                        SELECT address FROM addresses ORDER BY time LIMIT ?
+                    );
+                    ''',
+                    (excess,),
+                )
+
+
+def _nominatim_batch(url, batch):
+    """Query a batch of addresses, splitting it if Nominatim errors out.
+
+    :return: A dict mapping each address to ``(latitude, longitude)`` or None
+    """
     try:
-        locs = nominatim_query(url, q=list(batch.keys()))
+        locs = nominatim_query(url, q=batch)
     except requests.HTTPError as e:
         if (
             e.response.status_code in (500, 414)
             and len(batch) >= max(2, NOMINATIM_MIN_SPLIT_BATCH_SIZE)
         ):
             # Try smaller batch size
-            batch_list = list(batch.items())
             mid = len(batch) // 2
-            return (
-                _nominatim_batch(url, dict(batch_list[:mid]), locations, cache)
-                +
-                _nominatim_batch(url, dict(batch_list[mid:]), locations, cache)
-            )
+            results = _nominatim_batch(url, batch[:mid])
+            results.update(_nominatim_batch(url, batch[mid:]))
+            return results
         raise e from None
 
-    not_found = 0
-    for location, (value, count) in zip(locs, batch.items()):
+    results = {}
+    for location, value in zip(locs, batch):
         if location:
-            loc = (
+            results[value] = (
                 float(location[0]['lat']),
                 float(location[0]['lon']),
             )
-            cache[value] = loc
-            locations.extend([loc] * count)
         else:
-            cache[value] = None
-            not_found += count
-    batch.clear()
-    return not_found
+            results[value] = None
+    return results
 
 
-def nominatim_resolve_all(url, array, max_requests=MAX_NOMINATIM_REQUESTS):
-    cache = {}
-    locations = []
-    not_found = 0  # Unique locations not found
-    non_empty = 0
+def nominatim_resolve_all(url, array, max_requests=MAX_NOMINATIM_REQUESTS,
+                          *, cache=None):
+    """Resolve addresses into coordinates using Nominatim.
+
+    Each distinct address is resolved once, and up to
+    `NOMINATIM_CONCURRENCY` batches are queried at the same time.
+
+    :param url: URL of the Nominatim server
+    :param array: The addresses
+    :param max_requests: Maximum number of distinct addresses to query. Once
+        that many are reached, the following values are ignored.
+    :param cache: A :class:`NominatimCache`, or None
+    :return: A tuple ``(locations, non_empty)`` with the coordinates of the
+        addresses that were found, and the number of values that were
+        considered (not empty)
+    """
     start = time.perf_counter()
-    processed = 0
-    batch = {}
 
-    for processed, value in enumerate(array):
+    # Count each distinct value, in the order they appear
+    counts = collections.Counter()
+    for value in array:
         value = value.strip()
-        if not value:
-            continue
-        non_empty += 1
+        if value:
+            counts[value] += 1
 
-        if len(value) > MAX_ADDRESS_LENGTH:
-            continue
-        elif value in cache:
-            if cache[value] is not None:
-                locations.append(cache[value])
-        elif value in batch:
-            batch[value] += 1
-        else:
-            batch[value] = 1
-            if len(batch) == NOMINATIM_BATCH_SIZE:
-                not_found += _nominatim_batch(url, batch, locations, cache)
-                if len(cache) >= max_requests:
-                    break
+    # Only keep values up to when we have enough to query
+    if cache is not None:
+        known = cache.get_many(
+            value for value in counts if len(value) <= MAX_ADDRESS_LENGTH
+        )
+    else:
+        known = {}
+    values = []
+    to_query = []
+    for value in counts:
+        if len(to_query) >= max_requests:
+            break
+        values.append(value)
+        if len(value) <= MAX_ADDRESS_LENGTH and value not in known:
+            to_query.append(value)
+
+    # Query batches concurrently
+    batches = [
+        to_query[i:i + NOMINATIM_BATCH_SIZE]
+        for i in range(0, len(to_query), NOMINATIM_BATCH_SIZE)
+    ]
+    queried = {}
+    if len(batches) == 1:
+        queried.update(_nominatim_batch(url, batches[0]))
+    elif batches:
+        with ThreadPoolExecutor(
+            min(NOMINATIM_CONCURRENCY, len(batches)),
+        ) as executor:
+            for results in executor.map(
+                lambda batch: _nominatim_batch(url, batch),
+                batches,
+            ):
+                queried.update(results)
+    if cache is not None and queried:
+        cache.set_many(queried)
+    known.update(queried)
 
-    if batch and len(cache) < max_requests:
-        not_found += _nominatim_batch(url, batch, locations, cache)
+    locations = []
+    non_empty = 0
+    for value in values:
+        count = counts[value]
+        non_empty += count
+        loc = known.get(value)
+        if loc is not None:
+            locations.extend([loc] * count)
 
     logger.info(
-        "Performed %d Nominatim queries in %fs (%d hits). Found %d/%d",
-        len(cache),
+        "Performed %d Nominatim queries in %fs (%d hits, %d cached). "
+        + "Found %d/%d",
+        len(queried),
         time.perf_counter() - start,
-        len(cache) - not_found,
+        sum(1 for loc in queried.values() if loc is not None),
+        len(known) - len(queried),
         len(locations),
-        processed,
+        non_empty,
     )
     return locations, non_empty
 
@@ -403,6 +670,67 @@ def disambiguate_admin_areas(admin_areas):
     return level, result
 
 
+def get_admin_coverage(geo_data, values, max_points=None):
+    """Find the administrative areas containing lat/long points.
+
+    If there are more than `max_points` points (default: `MAX_ADMIN_POINTS`),
+    the areas are found for a random sample.
+
+    :param geo_data: A ``datamart_geo.GeoData`` instance
+    :param values: List or array of (latitude, longitude) points
+    :return: A list of areas as dicts with ``id``, ``name``, ``level``, and
+        the ``number`` of points they contain, ordered by level then by
+        descending number, with at most `MAX_ADMIN_AREAS` per level
+    """
+    if max_points is None:
+        max_points = MAX_ADMIN_POINTS
+
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if len(values) > max_points:
+        rnd = numpy.random.RandomState(0)
+        values = values[rnd.choice(len(values), max_points, replace=False)]
+
+    counts = collections.Counter()
+    for areas in geo_data.resolve_points(values):
+        counts.update(area for area in areas if area is not None)
+
+    return _top_admin_areas(
+        {
+            'id': area.id,
+            'name': area.name,
+            'level': area.type.value,
+            'number': number,
+        }
+        for area, number in counts.items()
+    )
+
+
+def merge_admin_coverage(areas, other):
+    """Merge two lists of administrative areas with counts, as JSON.
+    """
+    merged = {}
+    for area in itertools.chain(areas, other):
+        if area['id'] in merged:
+            merged[area['id']] = dict(
+                merged[area['id']],
+                number=merged[area['id']]['number'] + area['number'],
+            )
+        else:
+            merged[area['id']] = area
+    return _top_admin_areas(merged.values())
+
+
+def _top_admin_areas(areas):
+    # Order by level then by descending number, keep MAX_ADMIN_AREAS per level
+    result = []
+    for level, level_areas in itertools.groupby(
+        sorted(areas, key=lambda a: (a['level'], -a['number'], a['id'])),
+        key=lambda a: a['level'],
+    ):
+        result.extend(itertools.islice(level_areas, MAX_ADMIN_AREAS))
+    return result
+
+
 GEOHASH_CHARS = '0123456789bcdefghjkmnpqrstuvwxyz'
 assert len(GEOHASH_CHARS) == 32
 GEOHASH_CHAR_VALUES = {c: i for i, c in enumerate(GEOHASH_CHARS)}
@@ -521,100 +849,306 @@ def bitrange(from_bits, to_bits):
     yield bits
 
 
+def _quantize(values, low, high, bits):
+    # Index of the cell containing each value, out of 2 ** bits cells. Like
+    # the bisection in location_to_bits(), cells contain their upper bound but
+    # not their lower bound, and values outside the range go to the end cells
+    nb_cells = 1 << bits
+    width = (high - low) / nb_cells  # Exact, since nb_cells is a power of 2
+    with numpy.errstate(invalid='ignore'):
+        idx = numpy.ceil((values - low) / width) - 1
+    idx = numpy.clip(numpy.nan_to_num(idx), 0, nb_cells - 1)
+    idx = idx.astype(numpy.int64)
+
+    # Fix rounding errors, the cell boundaries are exact
+    idx -= (idx > 0) & (values <= low + idx * width)
+    idx += (idx < nb_cells - 1) & (values > low + (idx + 1) * width)
+    return idx.astype(numpy.uint64)
+
+
+def _quantize_value(value, low, high, bits):
+    # Same as _quantize(), for a single value
+    nb_cells = 1 << bits
+    width = (high - low) / nb_cells
+    if not value > low:  # Also catches NaN
+        return 0
+    elif value > high:
+        return nb_cells - 1
+    idx = min(max(math.ceil((value - low) / width) - 1, 0), nb_cells - 1)
+
+    # Fix rounding errors, the cell boundaries are exact
+    if idx > 0 and value <= low + idx * width:
+        idx -= 1
+    elif idx < nb_cells - 1 and value > low + (idx + 1) * width:
+        idx += 1
+    return idx
+
+
+def _spread_bits(x):
+    # Insert a 0 bit before each bit of 32-bit integers
+    x = x & numpy.uint64(0x00000000FFFFFFFF)
+    x = (x | (x << numpy.uint64(16))) & numpy.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x << numpy.uint64(8))) & numpy.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x << numpy.uint64(4))) & numpy.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x << numpy.uint64(2))) & numpy.uint64(0x3333333333333333)
+    x = (x | (x << numpy.uint64(1))) & numpy.uint64(0x5555555555555555)
+    return x
+
+
+def _cell_range(low, high, bits):
+    # Cells from low to high, wrapping around like bitrange() does
+    size = 1 << bits
+    return [
+        (low + i) % size
+        for i in range(_cell_range_len(low, high, bits))
+    ]
+
+
+def _cell_range_len(low, high, bits):
+    return (high - low) % (1 << bits) + 1
+
+
+_spread_byte = [
+    sum(((b >> i) & 1) << (2 * i) for i in range(8))
+    for b in range(256)
+]
+
+
+def _spread_int(x):
+    # Insert a 0 bit before each bit of an integer
+    result = 0
+    shift = 0
+    while x:
+        result |= _spread_byte[x & 0xFF] << shift
+        x >>= 8
+        shift += 16
+    return result
+
+
+def _interleave_cells(longs, lats, n_long_bits, n_lat_bits):
+    # Hashes of all the cells in the grid (longitude-major), as integers
+    # The latitude is shifted to have the same number of bits, the extra bit
+    # is dropped after interleaving
+    extra = n_long_bits - n_lat_bits
+    spread_longs = [_spread_int(long_idx) << 1 for long_idx in longs]
+    spread_lats = [_spread_int(lat_idx << extra) for lat_idx in lats]
+    return [
+        (spread_long | spread_lat) >> extra
+        for spread_long in spread_longs
+        for spread_lat in spread_lats
+    ]
+
+
+def hash_locations(points, base=32, precision=16):
+    """Hash many coordinates at once, as integers.
+
+    This is the vectorized version of :func:`hash_location`, that returns the
+    bitstring of each hash as an integer. If the hashes don't fit in 64 bits,
+    this returns an array of Python integers.
+
+    :param points: An array of ``(latitude, longitude)`` pairs
+    """
+    base_bits = base.bit_length() - 1
+    if 2 ** base_bits != base:
+        raise ValueError("Base is not a power of 2")
+    precision_bits = base_bits * precision
+    axis_bits = (precision_bits + 1) // 2
+
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    if axis_bits > 32:
+        return numpy.array(
+            [
+                int(''.join(str(b) for b in bits[:precision_bits]), 2)
+                for bits in (
+                    location_to_bits(point, base, precision)
+                    for point in points.tolist()
+                )
+            ],
+            dtype=object,
+        )
+
+    # Quantize to integer grids, and interleave the bits
+    long_idx = _quantize(points[:, 1], -180.0, 180.0, axis_bits)
+    lat_idx = _quantize(points[:, 0], -90.0, 90.0, axis_bits)
+    codes = (_spread_bits(long_idx) << numpy.uint64(1)) | _spread_bits(lat_idx)
+    # Drop the extra latitude bit if the number of bits is odd
+    return codes >> numpy.uint64(2 * axis_bits - precision_bits)
+
+
 class Geohasher(object):
+    """Count points or boxes in cells, at the finest level that is small enough.
+
+    Cells at each level of precision are stored as a dict mapping the hash
+    (as an integer) to the count, in the order the cells were created. When a
+    level has more than `number` cells, it is dropped along with all the
+    finer levels, so each dict stays small.
+    """
     def __init__(self, *, number, base=4, precision=16):
         self.number = number
         self.base = base
+        self.base_bits = base.bit_length() - 1
+        if 2 ** self.base_bits != base:
+            raise ValueError("Base is not a power of 2")
         self.precision = precision
 
-        self.tree_root = [0, {}]
-        self.number_at_level = [0] * (precision)
+        # Cells at each level, level 0 is the single cell of empty hash
+        self.levels = [{0: 0}] + [{} for _ in range(precision)]
+
+    def _set_precision(self, precision):
+        self.precision = precision
+        del self.levels[precision + 1:]
 
     def add_points(self, points):
-        for point in points:
-            geohash = hash_location(point, self.base, self.precision)
-            # Add this hash to the tree
-            node = self.tree_root
-            for level, key in enumerate(geohash):
-                node[0] += 1
-                try:
-                    node = node[1][key]
-                except KeyError:
-                    new_node = [0, {}]
-                    node[1][key] = new_node
-                    node = new_node
-                    self.number_at_level[level] += 1
-
-                    # If this level has too many nodes, stop building it
-                    if self.number_at_level[level] > self.number:
-                        self.precision = level
-                        break
-            node[0] += 1
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        if not len(points):
+            return
 
-    def add_aab(self, box):
-        base_bits = self.base.bit_length() - 1
+        hashes = hash_locations(points, self.base, self.precision)
+        self.levels[0][0] += len(points)
 
-        min_long, max_long, min_lat, max_lat = box
-        min_bits = location_to_bits(
-            (min_lat, min_long), self.base, self.precision,
-        )
-        min_long_bits = min_bits[0::2]
-        min_lat_bits = min_bits[1::2]
-        max_bits = location_to_bits(
-            (max_lat, max_long), self.base, self.precision,
+        # Sort once, the prefixes of sorted hashes are sorted too
+        hashes, hashes_first, hashes_counts = numpy.unique(
+            hashes,
+            return_index=True, return_counts=True,
         )
-        max_long_bits = max_bits[0::2]
-        max_lat_bits = max_bits[1::2]
 
-        self.tree_root[0] += 1
+        for level in range(1, self.precision + 1):
+            prefixes = hashes >> (self.base_bits * (self.precision - level))
+            if hashes.dtype != object:
+                prefixes = prefixes.astype(numpy.uint64)
+            starts = numpy.flatnonzero(
+                numpy.concatenate([[True], prefixes[1:] != prefixes[:-1]]),
+            )
+            prefixes = prefixes[starts]
+            first = numpy.minimum.reduceat(hashes_first, starts)
+            counts = numpy.add.reduceat(hashes_counts, starts)
+            cells = self.levels[level]
+
+            # If this level has too many cells, stop building it
+            nb_new = sum(1 for p in prefixes.tolist() if p not in cells)
+            if nb_new and len(cells) + nb_new > self.number:
+                self._set_precision(level - 1)
+                break
+
+            # Add the cells in the order they first appear
+            order = numpy.argsort(first, kind='stable')
+            for prefix, count in zip(
+                prefixes[order].tolist(),
+                counts[order].tolist(),
+            ):
+                cells[prefix] = cells.get(prefix, 0) + count
+
+    def add_aab(self, box):
+        min_long, max_long, min_lat, max_lat = box
+
+        # Cells of the corners at full precision
+        axis_bits = (self.base_bits * self.precision + 1) // 2
+        min_long_idx = _quantize_value(min_long, -180.0, 180.0, axis_bits)
+        max_long_idx = _quantize_value(max_long, -180.0, 180.0, axis_bits)
+        min_lat_idx = _quantize_value(min_lat, -90.0, 90.0, axis_bits)
+        max_lat_idx = _quantize_value(max_lat, -90.0, 90.0, axis_bits)
+        # An inverted range wraps around, the parents of its cells might not
+        # be covered at the previous level. Those are added like they were
+        # before, as nodes of a tree
+        wraps = min_long_idx > max_long_idx or min_lat_idx > max_lat_idx
+
+        self.levels[0][0] += 1
         level = 1
         while level <= self.precision:
-            n_long_bits = math.ceil(level * base_bits / 2)
-            n_lat_bits = math.floor(level * base_bits / 2)
-            for long_bits in bitrange(
-                    min_long_bits[:n_long_bits],
-                    max_long_bits[:n_long_bits],
+            n_long_bits = math.ceil(level * self.base_bits / 2)
+            n_lat_bits = math.floor(level * self.base_bits / 2)
+            long_range = (
+                min_long_idx >> (axis_bits - n_long_bits),
+                max_long_idx >> (axis_bits - n_long_bits),
+                n_long_bits,
+            )
+            lat_range = (
+                min_lat_idx >> (axis_bits - n_lat_bits),
+                max_lat_idx >> (axis_bits - n_lat_bits),
+                n_lat_bits,
+            )
+
+            if wraps:
+                self._add_wrapped_cells(
+                    level, long_range, lat_range,
+                    n_long_bits, n_lat_bits,
+                )
+                level += 1
+                continue
+
+            # If this level has too many cells, stop building it
+            if (
+                _cell_range_len(*long_range) * _cell_range_len(*lat_range)
+                > self.number
+            ):
+                self._set_precision(level - 1)
+                return
+            longs = _cell_range(*long_range)
+            lats = _cell_range(*lat_range)
+
+            cells = self.levels[level]
+            for cell in _interleave_cells(
+                longs, lats,
+                n_long_bits, n_lat_bits,
             ):
-                for lat_bits in bitrange(
-                        min_lat_bits[:n_lat_bits],
-                        max_lat_bits[:n_lat_bits],
-                ):
-                    bits = [0] * (n_long_bits + n_lat_bits)
-                    bits[0::2] = long_bits
-                    bits[1::2] = lat_bits
-                    geohash = bits_to_chars(bits, base_bits)
-
-                    # Add this hash to the tree
-                    node = self.tree_root
-                    for lvl, key in enumerate(geohash):
-                        try:
-                            node = node[1][key]
-                        except KeyError:
-                            new_node = [0, {}]
-                            node[1][key] = new_node
-                            node = new_node
-                            self.number_at_level[lvl] += 1
-                    node[0] += 1
-
-                    if self.number_at_level[level - 1] > self.number:
-                        self.precision = level - 1
-                        break
+                cells[cell] = cells.get(cell, 0) + 1
+            if len(cells) > self.number:
+                self._set_precision(level - 1)
+                return
 
             level += 1
 
+    def _add_wrapped_cells(
+        self, level, long_range, lat_range,
+        n_long_bits, n_lat_bits,
+    ):
+        # Add the cells of an inverted box at a level, creating their parents
+        # with a count of 0. The size of the level is checked after each
+        # cell, and only stops the current longitude
+        cells = self.levels[level]
+        lats = _cell_range(*lat_range)
+        for long_idx in _cell_range(*long_range):
+            for cell in _interleave_cells(
+                [long_idx], lats,
+                n_long_bits, n_lat_bits,
+            ):
+                for parent_level in range(1, level):
+                    parent = cell >> (self.base_bits * (level - parent_level))
+                    self.levels[parent_level].setdefault(parent, 0)
+                cells[cell] = cells.get(cell, 0) + 1
+                if len(cells) > self.number:
+                    if self.precision >= level:
+                        self._set_precision(level - 1)
+                    break
+
     def get_hashes(self):
         # Reconstruct the hashes at this level
-        hashes = []
-
-        def add_node(prefix, node, level):
-            if level == self.precision:
-                hashes.append((prefix, node[0]))
-                return
-            for k, n in node[1].items():
-                add_node(prefix + k, n, level + 1)
+        precision = self.precision
+        positions = [
+            {cell: i for i, cell in enumerate(cells)}
+            for cells in self.levels
+        ]
 
-        add_node('', self.tree_root, 0)
-        return hashes
+        # Order like a depth-first traversal of the tree, where the children
+        # of a cell are in the order they were created
+        hashes = []
+        for cell, count in self.levels[precision].items():
+            key = tuple(
+                positions[level][
+                    cell >> (self.base_bits * (precision - level))
+                ]
+                for level in range(1, precision + 1)
+            )
+            chars = ''.join(
+                GEOHASH_CHARS[
+                    (cell >> (self.base_bits * (precision - 1 - i)))
+                    & (self.base - 1)
+                ]
+                for i in range(precision)
+            )
+            hashes.append((key, chars, count))
+        hashes.sort(key=lambda h: h[0])
+        return [(chars, count) for _, chars, count in hashes]
 
     def get_hashes_json(self):
         hashes = self.get_hashes()
@@ -628,7 +1162,37 @@ class Geohasher(object):
 
     @property
     def total(self):
-        return self.tree_root[0]
+        return self.levels[0][0]
+
+
+def merge_geohashes(hashes, other, *, number):
+    """Merge two lists of geohashes with counts, as JSON.
+
+    Both lists are brought to the same precision by truncating the longer
+    hashes, and precision is further reduced until there are no more than
+    `number` hashes, the same way :class:`Geohasher` does.
+    """
+    if not hashes or not other:
+        return list(hashes or other)
+    precision = min(
+        min(len(h['hash']) for h in hashes),
+        min(len(h['hash']) for h in other),
+    )
+    while True:
+        cells = {}
+        for h in itertools.chain(hashes, other):
+            prefix = h['hash'][:precision]
+            cells[prefix] = cells.get(prefix, 0) + h['number']
+        if len(cells) <= number or precision <= 1:
+            break
+        precision -= 1
+    return [
+        {
+            'hash': h,
+            'number': n,
+        }
+        for h, n in sorted(cells.items())
+    ]
 
 
 def median_smallest_distance(points, tree=None):
@@ -636,6 +1200,8 @@ def median_smallest_distance(points, tree=None):
 
     This gives an idea of the "grid size" of a point dataset.
     """
+    from sklearn.neighbors._kd_tree import KDTree
+
     points = numpy.array(points)
     if tree is None:
         # points = numpy.unique(points, axis=0)  # Too slow
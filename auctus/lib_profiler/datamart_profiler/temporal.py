@@ -1,9 +1,11 @@
-import collections
 from datetime import datetime
 import dateutil.parser
 import dateutil.tz
+import itertools
 import logging
+import numpy
 import pandas
+import re
 
 from .warning_tools import raise_warnings
 
@@ -33,37 +35,83 @@ temporal_aggregation_keys = {
 }
 
 
+_datetime64_units = {
+    'year': 'Y',
+    'month': 'M',
+    'day': 'D',
+    'hour': 'h',
+    'minute': 'm',
+    'second': 's',
+}
+
+
+def truncate_datetime64(array, resolution):
+    """Truncate a datetime64 array to the start of the period containing each.
+
+    This gives the same bins as `temporal_aggregation_keys`, but is computed
+    on the whole array at once.
+
+    :param array: A numpy array of dtype ``datetime64``
+    :param resolution: One of the keys of `temporal_aggregation_keys`
+    """
+    if resolution in _datetime64_units:
+        return array.astype('datetime64[%s]' % _datetime64_units[resolution])
+
+    nat = numpy.isnat(array)
+    if resolution == 'quarter':
+        # Months since 1970-01, which is the start of a quarter
+        months = array.astype('datetime64[M]').astype('int64')
+        result = (months - months % 3).astype('datetime64[M]')
+    elif resolution == 'week':
+        # Days since 1970-01-01, which was a Thursday
+        days = array.astype('datetime64[D]').astype('int64')
+        result = (days - (days + 3) % 7).astype('datetime64[D]')
+    else:
+        raise ValueError("Unknown temporal resolution %r" % (resolution,))
+    if nat.any():
+        result[nat] = numpy.datetime64('NaT')
+    return result
+
+
+def _to_datetime64(values):
+    if isinstance(values, (pandas.DatetimeIndex, pandas.Series)):
+        values = pandas.DatetimeIndex(values)
+        # Use the local time, like strftime() does
+        if values.tz is not None:
+            values = values.tz_localize(None)
+        return numpy.unique(values.values)
+    else:
+        if not isinstance(values, set):
+            values = set(values)
+        # Use the local time, like strftime() does
+        return numpy.array(
+            [value.replace(tzinfo=None) for value in values],
+            dtype='datetime64[us]',
+        )
+
+
 def get_temporal_resolution(values):
     """Returns the resolution of the temporal attribute.
-    """
 
-    if not isinstance(values, set):
-        values = set(values)
+    :param values: Datetime objects, or a pandas DatetimeIndex or Series
+    """
+    array = _to_datetime64(values)
 
-    if len(values) == 1:
-        value, = values
-        if value.second:
+    if len(array) == 1:
+        value = array[0]
+        if value.astype('datetime64[s]') != value.astype('datetime64[m]'):
             return 'second'
-        elif value.minute:
+        elif value.astype('datetime64[m]') != value.astype('datetime64[h]'):
             return 'minute'
-        elif value.hour:
+        elif value.astype('datetime64[h]') != value.astype('datetime64[D]'):
             return 'hour'
         else:
             return 'day'
 
     # Python 3.7+ iterates on dict in insertion order
-    for resolution, key in temporal_aggregation_keys.items():
-        counts = collections.defaultdict(collections.Counter)
-        if isinstance(key, str):
-            for value in values:
-                bin = value.strftime(key)
-                counts[bin][value] += 1
-        else:
-            for value in values:
-                bin = key(value)
-                counts[bin][value] += 1
-
-        avg_per_bin = sum(len(v) for v in counts.values()) / len(counts)
+    for resolution in temporal_aggregation_keys:
+        bins = numpy.unique(truncate_datetime64(array, resolution))
+        avg_per_bin = len(array) / len(bins)
         if avg_per_bin < 1.05:
             # 5 % error tolerated
             return resolution
@@ -100,3 +148,156 @@ def parse_date(string):
     if dt1.tzinfo is None:
         dt1 = dt1.replace(tzinfo=dateutil.tz.UTC)
     return dt1
+
+
+# Common unambiguous formats, that can be parsed much faster than with
+# dateutil. The regex has to match the whole value for the format to be used,
+# and the result is the same as with parse_date()
+DATE_FORMATS = [
+    (
+        re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}$'),
+        '%Y-%m-%d',
+    ),
+    (
+        re.compile(
+            r'^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}$'
+        ),
+        '%Y-%m-%dT%H:%M:%S',
+    ),
+    (
+        re.compile(
+            r'^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z$'
+        ),
+        '%Y-%m-%dT%H:%M:%SZ',
+    ),
+    (
+        re.compile(
+            r'^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}'
+            r'\.[0-9]{1,6}$'
+        ),
+        '%Y-%m-%dT%H:%M:%S.%f',
+    ),
+    (
+        re.compile(
+            r'^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}$'
+        ),
+        '%Y-%m-%d %H:%M:%S',
+    ),
+    (
+        re.compile(
+            r'^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}'
+            r'\.[0-9]{1,6}$'
+        ),
+        '%Y-%m-%d %H:%M:%S.%f',
+    ),
+    (
+        re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}$'),
+        '%Y-%m-%d %H:%M',
+    ),
+    (
+        re.compile(r'^[0-9]{4}/[0-9]{2}/[0-9]{2}$'),
+        '%Y/%m/%d',
+    ),
+    (
+        re.compile(r'^[0-9]{2}/[0-9]{2}/[0-9]{4}$'),
+        '%m/%d/%Y',
+    ),
+    (
+        re.compile(
+            r'^[0-9]{2}/[0-9]{2}/[0-9]{4} [0-9]{2}:[0-9]{2}:[0-9]{2}$'
+        ),
+        '%m/%d/%Y %H:%M:%S',
+    ),
+    (
+        re.compile(r'^[0-9]{2}/[0-9]{2}/[0-9]{4} [0-9]{2}:[0-9]{2}$'),
+        '%m/%d/%Y %H:%M',
+    ),
+]
+
+FORMAT_SAMPLE_SIZE = 20
+
+
+def _parse_with_format(values, date_format):
+    regex, fmt = date_format
+    parsed = pandas.to_datetime(
+        pandas.Series(values, dtype=object),
+        format=fmt,
+        errors='coerce',
+    )
+    return [
+        None if pandas.isnull(dt) else dt.replace(tzinfo=dateutil.tz.UTC)
+        for dt in parsed.dt.to_pydatetime()
+    ]
+
+
+def infer_date_format(values):
+    """Find a format that can be used to quickly parse dates.
+
+    This looks at a sample of the values, and checks that parsing them with
+    the format gives the same result as :func:`parse_date`.
+
+    :return: An entry from `DATE_FORMATS`, or None
+    """
+    sample = list(itertools.islice(
+        (value for value in values if value),
+        FORMAT_SAMPLE_SIZE,
+    ))
+    if not sample:
+        return None
+
+    for date_format in DATE_FORMATS:
+        regex, fmt = date_format
+        matching = [value for value in sample if regex.match(value)]
+        if len(matching) * 2 <= len(sample):
+            continue
+
+        # Check that we get the same thing as the slow path
+        parsed = [
+            (value, dt)
+            for value, dt in zip(
+                matching,
+                _parse_with_format(matching, date_format),
+            )
+            if dt is not None
+        ]
+        if len(parsed) * 2 > len(sample) and all(
+            dt == parse_date(value)
+            for value, dt in parsed
+        ):
+            logger.info("Inferred date format %r", fmt)
+            return date_format
+
+    return None
+
+
+def parse_date_list(values):
+    """Parse a list of strings into dates, same as :func:`parse_date` on each.
+
+    If a format can be inferred, the values matching it are parsed in bulk
+    with pandas, and only the others go through dateutil.
+
+    :return: A list of the same length as `values`, containing a datetime or
+        None for each value
+    """
+    values = list(values)
+    results = [None] * len(values)
+
+    date_format = infer_date_format(values)
+    if date_format is not None:
+        regex = date_format[0]
+        fast_idx = [i for i, value in enumerate(values) if regex.match(value)]
+        parsed = _parse_with_format(
+            [values[i] for i in fast_idx],
+            date_format,
+        )
+        for i, dt in zip(fast_idx, parsed):
+            results[i] = dt
+
+    # Go through dateutil for the rest (including values that matched the
+    # format but didn't parse, for example because they are out of the range
+    # supported by pandas)
+    for i, value in enumerate(values):
+        if results[i] is None and value:
+            results[i] = parse_date(value)
+
+    return results
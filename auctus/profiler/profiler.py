@@ -145,6 +145,7 @@ def materialize_and_process_dataset(
                         metadata=metadata,
                         lazo_client=lazo_client,
                         nominatim=nominatim,
+                        nominatim_cache=True,
                         geo_data=geo_data,
                         include_sample=True,
                         coverage=True,
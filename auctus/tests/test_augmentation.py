@@ -1,8 +1,10 @@
 import contextlib
+import numpy
 import os
+import pandas
 import tempfile
 
-from datamart_augmentation import join, union
+from datamart_augmentation import augmentation, join, union
 from datamart_materialize import make_writer
 from datamart_profiler import process_dataset
 
@@ -208,6 +210,101 @@ class TestJoin(DataTestCase):
             },
         )
 
+    def test_agg_join_chunked(self):
+        """Join with aggregation, reading the data in several chunks"""
+        old_chunk_size = augmentation.CHUNK_SIZE_ROWS
+        augmentation.CHUNK_SIZE_ROWS = 5
+        try:
+            with setup_augmentation('agg_aug.csv', 'agg.csv') as (
+                orig_data, aug_data, orig_meta, aug_meta, result, writer,
+            ):
+                join(
+                    orig_data,
+                    aug_data,
+                    orig_meta,
+                    aug_meta,
+                    writer,
+                    [[0]],
+                    [[0]],
+                )
+
+                with open(result) as table:
+                    self.assertCsvEqualNoOrder(
+                        table.read(),
+                        'id,location,work,mean salary,sum salary,'
+                        'max salary,min salary',
+                        [
+                            '30,south korea,True,150.0,300.0,200.0,100.0',
+                            '40,brazil,False,,,,',
+                            '70,usa,True,600.0,600.0,600.0,600.0',
+                            '80,canada,True,200.0,200.0,200.0,200.0',
+                            '100,france,False,250.0,500.0,300.0,200.0',
+                        ],
+                    )
+        finally:
+            augmentation.CHUNK_SIZE_ROWS = old_chunk_size
+
+    def test_streaming_aggregation(self):
+        """Aggregate chunks one at a time, compare with concatenating them"""
+        rand = numpy.random.RandomState(1)
+        original = pandas.DataFrame({'id': ['r%d' % i for i in range(50)]})
+        chunks = []
+        for _ in range(8):
+            keys = rand.randint(0, 40, 30)
+            chunks.append(pandas.DataFrame({
+                augmentation.UNIQUE_INDEX_KEY: keys,
+                'id': original['id'].values[keys],
+                'value': rand.random_sample(30) * 1000,
+                'number': rand.randint(0, 100, 30),
+            }))
+        aggregation = augmentation.StreamingAggregation(original)
+        for chunk in chunks:
+            aggregation.add(chunk)
+        expected = augmentation.perform_aggregations(
+            pandas.concat(chunks, ignore_index=True),
+            list(original.columns),
+        )
+        # Float sums are added up in a different order
+        pandas.testing.assert_frame_equal(
+            aggregation.result(), expected,
+            check_exact=False, rtol=1e-12,
+        )
+
+    def test_agg_join_columns(self):
+        """Join with aggregation, only adding some of the columns"""
+        with setup_augmentation('agg_aug.csv', 'agg.csv') as (
+            orig_data, aug_data, orig_meta, aug_meta, result, writer,
+        ):
+            output_metadata = join(
+                orig_data,
+                aug_data,
+                orig_meta,
+                aug_meta,
+                writer,
+                [[0]],
+                [[0]],
+                columns=[2],
+            )
+
+            with open(result) as table:
+                self.assertCsvEqualNoOrder(
+                    table.read(),
+                    'id,location,mean salary,sum salary,max salary,'
+                    'min salary',
+                    [
+                        '30,south korea,150.0,300.0,200.0,100.0',
+                        '40,brazil,,,,',
+                        '70,usa,600.0,600.0,600.0,600.0',
+                        '80,canada,200.0,200.0,200.0,200.0',
+                        '100,france,250.0,500.0,300.0,200.0',
+                    ],
+                )
+
+        self.assertEqual(
+            output_metadata['qualities'][0]['qualValue']['new_columns'],
+            ['mean salary', 'sum salary', 'max salary', 'min salary'],
+        )
+
     def test_agg_join_specific_functions(self):
         """Join between integer keys, with specified aggregation functions"""
         with setup_augmentation('agg_aug.csv', 'agg.csv') as (
@@ -347,7 +444,8 @@ class TestJoin(DataTestCase):
             self.assertJson(
                 output_metadata,
                 {
-                    'size': 1014,
+                    # The size depends on how floats are printed
+                    'size': os.path.getsize(result),
                     'columns': [
                         {
                             'name': 'lat',
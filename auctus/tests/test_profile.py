@@ -3,22 +3,30 @@ import csv
 from datetime import datetime
 from dateutil.tz import UTC
 import io
+import numpy
 import os
 import pandas
+import pickle
 import random
 import requests
+import string
 import tempfile
 import textwrap
 import unittest
 
 import datamart_geo
-from datamart_profiler import process_dataset
+from datamart_profiler import merge_profiles, process_dataset, \
+    profile_increment
 from datamart_profiler.core import expand_attribute_name, load_data
+from datamart_profiler import core
+from datamart_profiler import numerical
 from datamart_profiler import profile_types
+from datamart_profiler import sketches
 from datamart_profiler import spatial
 from datamart_profiler.spatial import LATITUDE, LONGITUDE, LatLongColumn, \
     disambiguate_admin_areas
-from datamart_profiler.temporal import get_temporal_resolution, parse_date
+from datamart_profiler.temporal import get_temporal_resolution, \
+    parse_date, temporal_aggregation_keys, truncate_datetime64
 
 from .utils import DataTestCase, data
 
@@ -108,12 +116,16 @@ class TestSample(unittest.TestCase):
         with self.random_data(1000) as (tmp, filesize):
             self.assertEqual(filesize, 11901)
             data, metadata, column_names = load_data(tmp.name, 5000)
-            self.assertEqual(data.shape, (421, 2))
+            self.assertEqual(data.shape, (419, 2))
+            self.assertEqual(metadata['nb_rows'], 1000)
+            self.assertTrue(metadata['nb_rows_estimated'])
 
         with self.random_data(600) as (tmp, filesize):
             self.assertEqual(filesize, 7101)
             data, metadata, column_names = load_data(tmp.name, 5000)
-            self.assertEqual(data.shape, (423, 2))
+            self.assertEqual(data.shape, (418, 2))
+            self.assertEqual(metadata['nb_rows'], 599)
+            self.assertTrue(metadata['nb_rows_estimated'])
 
         with self.random_data(425) as (tmp, filesize):
             self.assertEqual(filesize, 5001)
@@ -122,6 +134,140 @@ class TestSample(unittest.TestCase):
 
             data, metadata, column_names = load_data(tmp.name, 6000)
             self.assertEqual(data.shape, (425, 2))
+            self.assertEqual(metadata['nb_rows'], 425)
+            self.assertNotIn('nb_rows_estimated', metadata)
+
+    def test_sample_multiline(self):
+        """Test sampling a table with line breaks in quoted values"""
+        with tempfile.NamedTemporaryFile('w+') as tmp:
+            writer = csv.writer(tmp)
+            writer.writerow(['id', 'text'])
+            rand = random.Random(4)
+            rows = {}
+            for i in range(2000):
+                rows[str(i)] = ' '.join(
+                    rand.choice(['a', 'b\nc', '"d"', 'e,f', '\n","\n'])
+                    for _ in range(rand.randint(1, 6))
+                )
+                writer.writerow([i, rows[str(i)]])
+            tmp.flush()
+
+            data, metadata, column_names = load_data(tmp.name, 10000)
+        self.assertGreater(data.shape[0], 300)
+        self.assertLess(data.shape[0], 1000)
+        self.assertTrue(data['id'].is_unique)
+        for id, text in zip(data['id'], data['text']):
+            self.assertEqual(text, rows[id])
+        self.assertTrue(1800 <= metadata['nb_rows'] <= 2200)
+
+    def test_sample_ragged(self):
+        """Test sampling a table where rows have fewer values than columns"""
+        with tempfile.NamedTemporaryFile('w+') as tmp:
+            tmp.write('id,a,b\n')
+            rand = random.Random(4)
+            for i in range(2000):
+                # The first rows are complete, or they would be taken for
+                # non-data rows by count_rows_to_skip()
+                nb_values = 2 if i < 5 else rand.randint(0, 2)
+                values = [str(i)] + ['x'] * nb_values
+                tmp.write(','.join(values) + '\n')
+            tmp.flush()
+
+            data, metadata, column_names = load_data(tmp.name, 5000)
+            self.assertGreater(data.shape[0], 300)
+            self.assertLess(data.shape[0], 1000)
+            self.assertEqual(data.shape[1], 3)
+            self.assertTrue(data['id'].is_unique)
+            self.assertTrue(1800 <= metadata['nb_rows'] <= 2200)
+            self.assertTrue(metadata['nb_rows_estimated'])
+
+            # If records can't be found at random offsets, the file is read
+            # from start to end, and a sample is kept
+            old_resync_lines = core.MAX_RESYNC_LINES
+            core.MAX_RESYNC_LINES = 0
+            try:
+                data, metadata, column_names = load_data(tmp.name, 5000)
+            finally:
+                core.MAX_RESYNC_LINES = old_resync_lines
+            self.assertGreater(data.shape[0], 300)
+            self.assertLess(data.shape[0], 1000)
+            ids = [int(i) for i in data['id']]
+            self.assertEqual(ids, sorted(set(ids)))
+            self.assertEqual(metadata['nb_rows'], 2000)
+            self.assertTrue(metadata['nb_rows_estimated'])
+
+    def test_skip_rows(self):
+        """Test that non-data rows are skipped when sampling"""
+        with tempfile.NamedTemporaryFile('w+') as tmp:
+            tmp.write('Some title\n\nid,number\n')
+            for i in range(2000):
+                tmp.write('%d,%d\n' % (i, i % 10))
+            tmp.flush()
+
+            data, metadata, column_names = load_data(tmp.name)
+            self.assertEqual(list(column_names), ['id', 'number'])
+            self.assertEqual(data.shape, (2000, 2))
+
+            data, metadata, column_names = load_data(tmp.name, 5000)
+            self.assertEqual(list(column_names), ['id', 'number'])
+            self.assertEqual(list(data.columns), ['id', 'number'])
+            self.assertTrue(data['id'].is_unique)
+            self.assertTrue(1800 <= metadata['nb_rows'] <= 2200)
+
+            old_resync_lines = core.MAX_RESYNC_LINES
+            core.MAX_RESYNC_LINES = 0
+            try:
+                data, metadata, column_names = load_data(tmp.name, 5000)
+            finally:
+                core.MAX_RESYNC_LINES = old_resync_lines
+            self.assertEqual(list(data.columns), ['id', 'number'])
+            self.assertEqual(metadata['nb_rows'], 2000)
+
+            metadata = process_dataset(
+                tmp.name,
+                load_max_size=5000, full_scan=True,
+            )
+        self.assertEqual(metadata['nb_rows'], 2000)
+        self.assertEqual(
+            [column['name'] for column in metadata['columns']],
+            ['id', 'number'],
+        )
+        self.assertAlmostEqual(metadata['columns'][1]['mean'], 4.5)
+
+    def test_full_scan(self):
+        """Test reading all the data after profiling a sample"""
+        with self.random_data(5000) as (tmp, filesize):
+            numbers = pandas.read_csv(tmp.name)['number']
+            sampled = process_dataset(tmp.name, load_max_size=20000)
+            metadata = process_dataset(
+                tmp.name,
+                load_max_size=20000, full_scan=True, plots=True,
+            )
+        self.assertTrue(sampled['nb_rows_estimated'])
+        self.assertLess(sampled['nb_profiled_rows'], 5000)
+        self.assertEqual(metadata['nb_rows'], 5000)
+        self.assertEqual(metadata['nb_profiled_rows'], 5000)
+        self.assertNotIn('nb_rows_estimated', metadata)
+        self.assertNotIn('sketches', metadata)
+        self.assertEqual(
+            [col['structural_type'] for col in metadata['columns']],
+            [col['structural_type'] for col in sampled['columns']],
+        )
+
+        id_column, number_column = metadata['columns']
+        # Estimated, there are too many to count exactly
+        self.assertAlmostEqual(
+            id_column['num_distinct_values'], 5000,
+            delta=5000 * 0.05,
+        )
+        self.assertAlmostEqual(id_column['mean'], 2499.5)
+        self.assertAlmostEqual(number_column['mean'], numbers.mean())
+        self.assertAlmostEqual(number_column['stddev'], numbers.std(ddof=0))
+        self.assertTrue(check_ranges(100000, 999999)(number_column['coverage']))
+        plot = number_column['plot']['data']
+        self.assertEqual(sum(b['count'] for b in plot), 5000)
+        self.assertEqual(plot[0]['bin_start'], numbers.min())
+        self.assertEqual(plot[-1]['bin_end'], numbers.max())
 
 
 class TestNames(unittest.TestCase):
@@ -204,6 +350,335 @@ class TestIndex(unittest.TestCase):
         )
 
 
+class TestParquet(unittest.TestCase):
+    def test_native_types(self):
+        """Test profiling a Parquet file, using the types of the columns"""
+        path = os.path.join(os.path.dirname(__file__), 'data', 'parquet.parquet')
+        dataframe, _, _ = load_data(path)
+        self.assertEqual(
+            [str(dtype) for dtype in dataframe.dtypes],
+            ['object', 'int64', 'datetime64[ns]'],
+        )
+
+        metadata = process_dataset(path, plots=True, include_sample=True)
+        csv_data = pandas.read_parquet(path).to_csv(index=False)
+        expected = process_dataset(
+            io.StringIO(csv_data),
+            plots=True, include_sample=True,
+        )
+        del expected['size']
+        del expected['average_row_size']
+        self.assertEqual(metadata, expected)
+        self.assertEqual(
+            [col['structural_type'] for col in metadata['columns']],
+            [
+                'http://schema.org/Text',
+                'http://schema.org/Integer',
+                'http://schema.org/Text',
+            ],
+        )
+        self.assertEqual(
+            metadata['columns'][2]['semantic_types'],
+            ['http://schema.org/DateTime'],
+        )
+
+    def test_native_year_infinity(self):
+        """Test profiling a float 'year' column holding an infinite value"""
+        dataframe = pandas.DataFrame({
+            'year': [float(y) for y in range(1960, 2020)] + [float('inf')],
+        })
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'year.parquet')
+            dataframe.to_parquet(path)
+            metadata = process_dataset(path)
+        self.assertEqual(
+            metadata['columns'][0]['semantic_types'],
+            ['http://schema.org/DateTime'],
+        )
+
+
+class TestWorkers(unittest.TestCase):
+    def test_workers(self):
+        """Test profiling columns in parallel"""
+        with data('spatiotemporal.csv', 'r') as data_fp:
+            expected = process_dataset(data_fp, plots=True)
+        with data('spatiotemporal.csv', 'r') as data_fp:
+            metadata = process_dataset(data_fp, plots=True, workers=2)
+        self.assertEqual(metadata, expected)
+
+
+class TestLazo(unittest.TestCase):
+    """Test sending columns to Lazo, mocking the client"""
+    def test_index(self):
+        from lazo_index_service.errors import LazoError
+
+        class FakeClient(object):
+            def __init__(self):
+                self.indexed = {}
+                self.failed = False
+
+            def index_data(self, values, dataset_id, column_name):
+                if not self.failed:  # Fail just once
+                    self.failed = True
+                    raise LazoError("Fake error")
+                self.indexed[column_name] = dataset_id, values
+
+            def get_lazo_sketch_from_data(self, values, dataset_id,
+                                          column_name):
+                return 1, [0], len(values)
+
+        dataframe = pandas.DataFrame({
+            'name%d' % i: ['value %d' % (j % (i + 2)) for j in range(20)]
+            for i in range(6)
+        })
+        client = FakeClient()
+        old_backoff = core.LAZO_BACKOFF
+        core.LAZO_BACKOFF = 0
+        try:
+            process_dataset(dataframe, 'fake_id', lazo_client=client)
+        finally:
+            core.LAZO_BACKOFF = old_backoff
+        self.assertEqual(
+            client.indexed,
+            {
+                'name%d' % i: (
+                    'fake_id',
+                    ['value %d' % j for j in range(i + 2)],
+                )
+                for i in range(6)
+            },
+        )
+
+        # Sketches come back in the order of the columns
+        metadata = process_dataset(dataframe, search=True, lazo_client=client)
+        self.assertEqual(
+            [column['lazo']['cardinality'] for column in metadata['columns']],
+            [2, 3, 4, 5, 6, 7],
+        )
+
+
+class TestIncremental(unittest.TestCase):
+    def test_profile_increment(self):
+        """Test updating a profile with appended data"""
+        with data('spatiotemporal.csv', 'r') as data_fp:
+            dataframe = pandas.read_csv(
+                data_fp,
+                dtype=str, na_filter=False,
+            )
+        expected = process_dataset(dataframe, plots=True, sketches=True)
+        metadata = process_dataset(
+            dataframe.iloc[:120],
+            plots=True, sketches=True,
+        )
+        metadata = profile_increment(
+            metadata,
+            dataframe.iloc[120:].reset_index(drop=True),
+        )
+
+        self.assertEqual(metadata['nb_rows'], 200)
+        self.assertEqual(metadata['nb_profiled_rows'], 200)
+        self.assertEqual(metadata['types'], expected['types'])
+        for column, expected_column in zip(
+            metadata['columns'],
+            expected['columns'],
+        ):
+            self.assertEqual(
+                column['semantic_types'],
+                expected_column['semantic_types'],
+            )
+            self.assertEqual(
+                column.get('num_distinct_values'),
+                expected_column.get('num_distinct_values'),
+            )
+            if 'mean' in expected_column:
+                self.assertAlmostEqual(column['mean'], expected_column['mean'])
+                self.assertAlmostEqual(
+                    column['stddev'],
+                    expected_column['stddev'],
+                )
+                self.assertEqual(
+                    column['coverage'],
+                    expected_column['coverage'],
+                )
+                self.assertEqual(
+                    sum(b['count'] for b in column['plot']['data']),
+                    200,
+                )
+        self.assertEqual(
+            metadata['columns'][3]['plot'],
+            expected['columns'][3]['plot'],
+        )
+
+        [coverage] = metadata['spatial_coverage']
+        [expected_coverage] = expected['spatial_coverage']
+        self.assertEqual(coverage['number'], 200)
+        self.assertEqual(
+            sorted(coverage['geohashes4'], key=lambda h: h['hash']),
+            sorted(expected_coverage['geohashes4'], key=lambda h: h['hash']),
+        )
+        self.assertEqual(len(coverage['ranges']), 3)
+
+        [coverage] = metadata['temporal_coverage']
+        [expected_coverage] = expected['temporal_coverage']
+        self.assertEqual(
+            coverage['temporal_resolution'],
+            expected_coverage['temporal_resolution'],
+        )
+        self.assertEqual(len(coverage['ranges']), 3)
+        self.assertEqual(coverage['ranges'][0]['range']['gte'], 1150761600.0)
+        self.assertEqual(coverage['ranges'][2]['range']['lte'], 1150795800.0)
+
+    def test_increment_sampled(self):
+        """Test updating a profile of sampled data several times"""
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as tmp:
+            tmp.write('id,x\n')
+            for i in range(20000):
+                tmp.write('%d,10\n' % i)
+            tmp.flush()
+            metadata = process_dataset(
+                tmp.name,
+                load_max_size=20000, sketches=True,
+            )
+        self.assertLess(metadata['nb_profiled_rows'], metadata['nb_rows'])
+        nb_rows = metadata['nb_rows']
+
+        new_data = pandas.DataFrame({
+            'id': [str(i) for i in range(100)],
+            'x': ['1000'] * 100,
+        })
+        for i in range(1, 4):
+            metadata = profile_increment(metadata, new_data)
+            total = nb_rows + 100 * i
+            self.assertEqual(metadata['nb_rows'], total)
+            self.assertEqual(
+                [c['total'] for c in metadata['sketches']['columns']],
+                [total, total],
+            )
+            self.assertAlmostEqual(
+                metadata['columns'][1]['mean'],
+                (nb_rows * 10 + 100 * i * 1000) / total,
+            )
+
+    def test_merge_errors(self):
+        """Test merging profiles that don't go together"""
+        ints = pandas.DataFrame({'a': [str(i) for i in range(20)]})
+        texts = pandas.DataFrame({'a': ['x%d' % i for i in range(20)]})
+        metadata = process_dataset(ints, sketches=True)
+        with self.assertRaises(ValueError):
+            merge_profiles(metadata, process_dataset(texts, sketches=True))
+        with self.assertRaises(ValueError):
+            merge_profiles(metadata, process_dataset(ints))
+
+        # Missing data takes the types of the other part
+        empty = pandas.DataFrame({'a': [''] * 20})
+        merged = merge_profiles(
+            process_dataset(empty, sketches=True),
+            metadata,
+        )
+        self.assertEqual(
+            merged['columns'][0]['structural_type'],
+            'http://schema.org/Integer',
+        )
+        self.assertEqual(merged['columns'][0]['missing_values_ratio'], 0.5)
+        self.assertEqual(merged['columns'][0]['num_distinct_values'], 20)
+
+    def test_merge_admin_areas(self):
+        """Test merging the administrative areas of spatial coverage"""
+        old_max = spatial.MAX_ADMIN_AREAS
+        spatial.MAX_ADMIN_AREAS = 2
+        try:
+            self.assertEqual(
+                spatial.merge_admin_coverage(
+                    [
+                        {'id': 1, 'name': 'A', 'level': 0, 'number': 3},
+                        {'id': 3, 'name': 'C', 'level': 1, 'number': 2},
+                        {'id': 4, 'name': 'D', 'level': 1, 'number': 1},
+                    ],
+                    [
+                        {'id': 2, 'name': 'B', 'level': 0, 'number': 4},
+                        {'id': 1, 'name': 'A', 'level': 0, 'number': 2},
+                        {'id': 5, 'name': 'E', 'level': 1, 'number': 2},
+                    ],
+                ),
+                [
+                    {'id': 1, 'name': 'A', 'level': 0, 'number': 5},
+                    {'id': 2, 'name': 'B', 'level': 0, 'number': 4},
+                    {'id': 3, 'name': 'C', 'level': 1, 'number': 2},
+                    {'id': 5, 'name': 'E', 'level': 1, 'number': 2},
+                ],
+            )
+        finally:
+            spatial.MAX_ADMIN_AREAS = old_max
+
+
+class TestSketches(unittest.TestCase):
+    def test_hyperloglog(self):
+        """Test estimating the number of distinct values"""
+        first = sketches.HyperLogLog()
+        first.add(['value %d' % i for i in range(20000)])
+        second = sketches.HyperLogLog()
+        second.add(['value %d' % i for i in range(10000, 30000)])
+        self.assertEqual(
+            sketches.HyperLogLog.from_json(first.to_json()).count(),
+            first.count(),
+        )
+        self.assertAlmostEqual(first.count(), 20000, delta=20000 * 0.05)
+        first.merge(second)
+        self.assertAlmostEqual(first.count(), 30000, delta=30000 * 0.05)
+
+        small = sketches.HyperLogLog()
+        small.add(['a', 'b', 'c', 'a'])
+        self.assertEqual(small.count(), 3)
+
+        self.assertEqual(sketches.precision_for_error(0.02), 12)
+        self.assertEqual(sketches.HyperLogLog().precision, 12)
+        self.assertEqual(sketches.precision_for_error(0.005), 16)
+
+    def test_distinct_counter(self):
+        """Test counting distinct values exactly until there are too many"""
+        counter = sketches.DistinctCounter()
+        counter.add(['value %d' % i for i in range(600)])
+        other = sketches.DistinctCounter()
+        other.add(['value %d' % i for i in range(300, 900)])
+        counter.merge(other)
+        counter = sketches.DistinctCounter.from_json(counter.to_json())
+        self.assertTrue(counter.exact)
+        self.assertEqual(counter.count(), 900)
+
+        other = sketches.DistinctCounter()
+        other.add(['value %d' % i for i in range(900, 1200)])
+        counter.merge(other)
+        self.assertFalse(counter.exact)
+        self.assertNotIn('hashes', counter.to_json())
+        self.assertAlmostEqual(counter.count(), 1200, delta=1200 * 0.05)
+
+    def test_numerical_summary(self):
+        """Test merging summaries of numbers"""
+        values = numpy.random.RandomState(0).normal(10.0, 2.0, 10000)
+        summary = sketches.NumericalSummary()
+        summary.add(values[:3000])
+        other = sketches.NumericalSummary()
+        other.add(values[3000:])
+        summary.merge(other)
+        self.assertEqual(summary.count, 10000)
+        self.assertAlmostEqual(summary.mean, values.mean())
+        self.assertAlmostEqual(summary.stddev, values.std())
+        self.assertEqual(summary.min, values.min())
+        self.assertEqual(summary.max, values.max())
+        self.assertLessEqual(len(summary.values), sketches.SUMMARY_SIZE)
+        self.assertEqual(summary.weights.sum(), 10000)
+        counts, edges = summary.histogram()
+        expected_counts, expected_edges = numpy.histogram(values, bins=10)
+        numpy.testing.assert_allclose(edges, expected_edges)
+        numpy.testing.assert_allclose(counts, expected_counts, atol=150)
+
+        # Few values are kept exactly
+        summary = sketches.NumericalSummary()
+        summary.add([1, 2, 2, 3, float('nan')])
+        self.assertEqual(summary.values.tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(summary.weights.tolist(), [1.0, 2.0, 1.0])
+
+
 class TestLatlongSelection(DataTestCase):
     def test_normalize_name(self):
         """Test normalizing column names"""
@@ -352,6 +827,44 @@ class TestDates(DataTestCase):
             None,
         )
 
+    def test_parse_list(self):
+        """Test parsing dates with an inferred format"""
+        from datamart_profiler.temporal import infer_date_format, \
+            parse_date_list
+
+        values = [
+            '2019-07-%02dT%02d:13:19' % (day, hour)
+            for day in range(1, 29)
+            for hour in range(24)
+        ]
+        values.extend([
+            '',
+            '2019-02-30T00:00:00',  # Not a date
+            '0099-07-02T21:13:19',  # Not supported by pandas, uses dateutil
+            '2019-07-02 21:13:19-04:00',  # Different format, uses dateutil
+            '21:13',  # Time only, not a date
+        ])
+        self.assertEqual(
+            infer_date_format(values)[1],
+            '%Y-%m-%dT%H:%M:%S',
+        )
+        self.assertEqual(
+            parse_date_list(values),
+            [parse_date(value) if value else None for value in values],
+        )
+        self.assertEqual(
+            parse_date_list(values)[-5:],
+            [
+                None,
+                None,
+                datetime(99, 7, 2, 21, 13, 19, tzinfo=UTC),
+                datetime(2019, 7, 3, 1, 13, 19, tzinfo=UTC),
+                None,
+            ],
+        )
+
+        self.assertIsNone(infer_date_format(['a', 'b', '2019-07-02']))
+
     def test_year(self):
         """Test the 'year' special-case"""
         dataframe = pandas.DataFrame({
@@ -415,6 +928,64 @@ class TestDates(DataTestCase):
         )
 
 
+class TestNumericalRanges(unittest.TestCase):
+    @staticmethod
+    def sse(values, labels):
+        return sum(
+            ((values[labels == lbl] - values[labels == lbl].mean()) ** 2).sum()
+            for lbl in set(labels.tolist())
+        )
+
+    def test_optimal(self):
+        """Test that the clustering is optimal, against brute force"""
+        rand = numpy.random.RandomState(2)
+        for _ in range(50):
+            values = numpy.round(rand.standard_normal(rand.randint(4, 30)), 1)
+            distinct = numpy.unique(values)
+            labels = numerical._cluster_optimal(values, 3)
+            self.assertTrue(numpy.all(numpy.diff(labels[values.argsort()]) >= 0))
+
+            best = min(
+                self.sse(
+                    values,
+                    numpy.searchsorted(distinct[[a, b]], values, side='right'),
+                )
+                for a in range(1, len(distinct))
+                for b in range(a + 1, len(distinct))
+            )
+            self.assertAlmostEqual(self.sse(values, labels), best)
+
+    def test_ranges(self):
+        """Test the numerical ranges with each backend"""
+        rand = numpy.random.RandomState(3)
+        values = numpy.concatenate([
+            rand.standard_normal(3000),
+            rand.standard_normal(2000) + 50,
+            rand.standard_normal(5000) * 3 + 100,
+            [1000.0],  # outlier
+        ])
+        rand.shuffle(values)
+        ranges = numerical.get_numerical_ranges(values)
+        self.assertEqual(
+            ranges,
+            numerical.get_numerical_ranges(values, clustering='kmeans'),
+        )
+        self.assertEqual(
+            [[round(rg['range']['gte']), round(rg['range']['lte'])]
+             for rg in ranges],
+            [[-2, 2], [48, 52], [95, 105]],
+        )
+
+        self.assertEqual(numerical.get_numerical_ranges([]), [])
+        self.assertEqual(
+            numerical.get_numerical_ranges([4.0, 4.0, 2.0]),
+            [
+                {'range': {'gte': 2.0, 'lte': 2.0}},
+                {'range': {'gte': 4.0, 'lte': 4.0}},
+            ],
+        )
+
+
 class TestTemporalResolutions(unittest.TestCase):
     def test_pandas(self):
         """Test guessing temporal resolution of Pandas values"""
@@ -567,6 +1138,33 @@ class TestTemporalResolutions(unittest.TestCase):
             'day',
         )
 
+    def test_truncate(self):
+        """Test truncating datetimes, against the strftime() keys"""
+        rand = random.Random(3)
+        values = [
+            datetime(1969, 12, 29, 23, 59, 59),
+            datetime(1970, 1, 1),
+            datetime(2020, 3, 31, 12, 30, 15),
+        ] + [
+            datetime.fromtimestamp(rand.randint(-3000000000, 3000000000), UTC)
+            .replace(tzinfo=None)
+            for _ in range(200)
+        ]
+        array = numpy.array(values + [None], dtype='datetime64[us]')
+        for resolution, key in temporal_aggregation_keys.items():
+            truncated = truncate_datetime64(array, resolution)
+            truncated = truncated.astype('datetime64[us]')
+            self.assertTrue(numpy.isnat(truncated[-1]))
+            for value, trunc in zip(values, truncated[:-1].tolist()):
+                self.assertLessEqual(trunc, value)
+                if isinstance(key, str):
+                    self.assertEqual(
+                        trunc.strftime(key),
+                        value.strftime(key),
+                    )
+                else:
+                    self.assertEqual(key(trunc), key(value))
+
 
 class TestTypes(unittest.TestCase):
     def do_test(self, match, positive, negative):
@@ -693,6 +1291,139 @@ class TestTypes(unittest.TestCase):
             positive, negative,
         )
 
+    def test_regular_exp_count(self):
+        """Test that the batch type counting matches the per-value one"""
+        values = [
+            '', '12', '4.0', '-1.5e3', '.5', '1.', 'yes', 'No', 'TRUE', 'n',
+            'http://en.wikipedia.org/wiki/Data_mart', 'www.vida-nyu.org',
+            '/usr/bin/python3', 'C:\\Python3.7\\python.exe', 'file:///tmp',
+            'POINT (-73.997174 40.729753)', 'POINT (-73.997174, 40.729753)',
+            'POINT(1.0, 2.0)', '(40.729753, -73.997174)',
+            'POLYGON ((1 2, 3 4, 5 6))', 'POLYGON ((1 2 3 4), (5 6 7 8))',
+            'R\u00C9MI\'S HOUSE, BROOKLYN, NY (40.729753, -73.997174)',
+            'http://auctus.vida-nyu.org/ a b c',
+            'one two three four', ' one two ', 'one\ttwo\nthree  four',
+            'one\u00A0two three four', 'one two three', '12 34 56 78',
+            'auctus', 'New York', ' ', '  \t  ',
+        ]
+        rand = random.Random(6)
+        chars = string.ascii_letters + string.digits + ' \t.,:/()+-\u00C9'
+        for _ in range(2000):
+            values.append(''.join(
+                rand.choice(chars) for _ in range(rand.randint(0, 12))
+            ))
+        self.assertEqual(
+            profile_types.regular_exp_count(values),
+            profile_types.regular_exp_count_reference(values),
+        )
+        for value in values:
+            self.assertEqual(
+                profile_types.regular_exp_count([value]),
+                profile_types.regular_exp_count_reference([value]),
+                "Mismatch for %r" % value,
+            )
+
+    def test_distinct_values(self):
+        """Test computing things once per distinct value"""
+        distinct = profile_types.DistinctValues(
+            ['b', 'a', '', 'b', 'c', 'a', 'b'],
+        )
+        self.assertEqual(len(distinct), 4)
+        self.assertEqual(distinct.total, 7)
+        self.assertEqual(
+            list(distinct.items()),
+            [('b', 3), ('a', 2), ('', 1), ('c', 1)],
+        )
+        self.assertEqual(
+            distinct.expand(distinct.map(str.upper)),
+            ['B', 'A', '', 'B', 'C', 'A', 'B'],
+        )
+        self.assertEqual(
+            distinct.count_rows(['B', None, '', 'C']),
+            5,
+        )
+
+    def test_column_view(self):
+        """Test the typed view of a column"""
+        view = profile_types.ColumnView(
+            ['12', '', '1.5', 'abc', '12', '1e39', '-inf', ' 3 '],
+        )
+        self.assertEqual(len(view), 7)
+        floats = view.floats
+        self.assertEqual(floats.dtype, numpy.float64)
+        self.assertEqual(
+            [None if numpy.isnan(f) else f for f in floats.tolist()],
+            [12.0, None, 1.5, None, 12.0, None, None, 3.0],
+        )
+
+        view = profile_types.ColumnView(
+            ['2020-01-01', 'abc', '1970-01-01T00:00:01.5', '2020-01-01'],
+        )
+        datetimes = [parse_date(v) for v in view.values]
+        timestamps = view.timestamps(datetimes)
+        self.assertEqual(timestamps.dtype, numpy.int64)
+        self.assertEqual(
+            timestamps.tolist(),
+            [1577836800000000, 1500000, 1577836800000000],
+        )
+
+    def test_native_types(self):
+        """Test identifying types of columns that are already typed"""
+        def identify(values, name='value'):
+            return profile_types.identify_types(
+                pandas.Series(values), name, None,
+            )
+
+        self.assertEqual(
+            identify([1.0, 2.0, float('nan'), 2.0], 'id'),
+            (
+                'http://schema.org/Integer',
+                {'http://schema.org/identifier': None},
+                {
+                    'missing_values_ratio': 0.25,
+                    'unclean_values_ratio': 0.0,
+                    'num_distinct_values': 2,
+                },
+            ),
+        )
+        self.assertEqual(
+            identify([0, 1, 1, 0]),
+            (
+                'http://schema.org/Integer',
+                {'http://schema.org/Boolean': None},
+                {'unclean_values_ratio': 0.0, 'num_distinct_values': 2},
+            ),
+        )
+        self.assertEqual(
+            identify([40.7, -73.9, 41.2], 'latitude'),
+            (
+                'http://schema.org/Float',
+                {'http://schema.org/latitude': None},
+                {'unclean_values_ratio': 0.0},
+            ),
+        )
+        self.assertEqual(
+            identify([float('nan')] * 3),
+            ('https://metadata.datadrivendiscovery.org/types/MissingData', {}, {}),
+        )
+
+        structural_type, semantic_types, column_meta = identify(
+            pandas.to_datetime(['2020-01-01T05:00', None, '2020-01-01T05:00'])
+            .tz_localize('US/Eastern'),
+        )
+        self.assertEqual(structural_type, 'http://schema.org/Text')
+        self.assertEqual(
+            semantic_types,
+            {
+                'http://schema.org/DateTime': [
+                    datetime(2020, 1, 1, 10, 0, tzinfo=UTC),
+                    None,
+                ],
+            },
+        )
+        self.assertEqual(round(column_meta['missing_values_ratio'], 2), 0.33)
+        self.assertEqual(column_meta['num_distinct_values'], 1)
+
 
 class TestTruncate(unittest.TestCase):
     def test_simple(self):
@@ -854,6 +1585,70 @@ class TestNominatim(DataTestCase):
         finally:
             spatial.nominatim_query = old_query
 
+    def test_cache(self):
+        """Test the persistent cache of addresses, mocking the queries"""
+        queries = []
+
+        def replacement(url, *, q):
+            queries.append(list(q))
+            return [
+                [{'lat': int(qe[1:]), 'lon': 1.0}] if qe != 'x0' else []
+                for qe in q
+            ]
+
+        old_query = spatial.nominatim_query
+        old_batch_size = spatial.NOMINATIM_BATCH_SIZE
+        spatial.nominatim_query = replacement
+        spatial.NOMINATIM_BATCH_SIZE = 3
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                cache = spatial.NominatimCache(
+                    os.path.join(tmp, 'cache.sqlite3'),
+                    max_size=8,
+                )
+                array = ['x%d' % (i % 10) for i in range(25)]
+                res, non_empty = spatial.nominatim_resolve_all(
+                    'http://240.123.45.67:21', array, cache=cache,
+                )
+                self.assertEqual(non_empty, 25)
+                self.assertEqual(
+                    sorted(res),
+                    sorted((float(v[1:]), 1.0) for v in array if v != 'x0'),
+                )
+                # Each distinct value is queried once, in batches
+                self.assertEqual(
+                    sorted(qe for batch in queries for qe in batch),
+                    ['x%d' % i for i in range(10)],
+                )
+                self.assertEqual(len(queries), 4)
+
+                # The cache is kept under its maximum size
+                cache = pickle.loads(pickle.dumps(cache))
+                self.assertEqual(
+                    len(cache.get_many('x%d' % i for i in range(10))),
+                    8,
+                )
+
+                # Only addresses not in cache are queried again
+                queries[:] = []
+                res2, non_empty = spatial.nominatim_resolve_all(
+                    'http://240.123.45.67:21', array, cache=cache,
+                )
+                self.assertEqual(sorted(res2), sorted(res))
+                self.assertEqual(len(queries), 1)
+                self.assertEqual(len(queries[0]), 2)
+
+                # Expired entries are queried again
+                queries[:] = []
+                cache.ttl = -1
+                spatial.nominatim_resolve_all(
+                    'http://240.123.45.67:21', array, cache=cache,
+                )
+                self.assertEqual(len(queries), 4)
+        finally:
+            spatial.nominatim_query = old_query
+            spatial.NOMINATIM_BATCH_SIZE = old_batch_size
+
 
 class TestGeo(DataTestCase):
     @classmethod
@@ -1180,6 +1975,23 @@ class TestGeo(DataTestCase):
             },
         )
 
+    def test_admin_workers(self):
+        """Test profiling administrative areas in parallel"""
+        with data('admins.csv', 'r') as data_fp:
+            expected = process_dataset(
+                data_fp,
+                geo_data=self.geo_data,
+                coverage=True,
+            )
+        with data('admins.csv', 'r') as data_fp:
+            metadata = process_dataset(
+                data_fp,
+                geo_data=self.geo_data,
+                coverage=True,
+                workers=2,
+            )
+        self.assertEqual(metadata, expected)
+
     def test_point_latlong(self):
         """Test profiling latitudes & longitudes"""
         with data('geo_latlong.csv', 'r') as data_fp:
@@ -1238,6 +2050,30 @@ class TestGeo(DataTestCase):
             },
         )
 
+    def test_point_latlong_admin(self):
+        """Test finding the administrative areas of latitudes & longitudes"""
+        with data('geo_latlong.csv', 'r') as data_fp:
+            metadata = process_dataset(
+                data_fp,
+                geo_data=self.geo_data,
+                coverage=True,
+                admin_coverage=True,
+            )
+
+        admin_areas = metadata['spatial_coverage'][0]['admin_areas']
+        self.assertEqual(
+            [
+                (area['level'], area['name'], area['number'])
+                for area in admin_areas
+                if area['level'] <= 1
+            ],
+            [(0, 'United States', 100), (1, 'New York', 100)],
+        )
+        self.assertEqual(
+            [area['level'] for area in admin_areas],
+            sorted(area['level'] for area in admin_areas),
+        )
+
 
 class TestGeoHash(unittest.TestCase):
     def test_bit_encoding(self):
@@ -1298,6 +2134,36 @@ class TestGeoHash(unittest.TestCase):
             'u09tg',
         )
 
+    def test_geohash_vectorized(self):
+        rand = random.Random(5)
+        points = [
+            (rand.uniform(-90.0, 90.0), rand.uniform(-180.0, 180.0))
+            for _ in range(200)
+        ] + [
+            # Points on cell boundaries
+            (0.0, 0.0), (45.0, -90.0), (-90.0, 180.0), (90.0, -180.0),
+            (11.25, 5.625), (40.6962574, -73.9849621),
+        ]
+        for base, precision in [(4, 16), (32, 5), (32, 16), (8, 3)]:
+            base_bits = base.bit_length() - 1
+            hashes = spatial.hash_locations(points, base, precision)
+            self.assertEqual(
+                [
+                    spatial.bits_to_chars(
+                        [
+                            (h >> i) & 1
+                            for i in reversed(range(base_bits * precision))
+                        ],
+                        base_bits,
+                    )
+                    for h in hashes.tolist()
+                ],
+                [
+                    spatial.hash_location(point, base, precision)
+                    for point in points
+                ],
+            )
+
     def test_geohash32_reverse(self):
         self.assertEqual(
             spatial.decode_hash('dr5rs2tbckjz3h8c'),
@@ -1438,6 +2304,63 @@ class TestGeoHash(unittest.TestCase):
             ],
         )
 
+    def test_sketch_aab_large(self):
+        """Test that large boxes stop at the level within budget"""
+        builder = spatial.Geohasher(number=40)
+        builder.add_aab((-180.0, 180.0, -90.0, 90.0))
+        self.assertEqual(
+            builder.get_hashes(),
+            [(a + b, 1) for a in '0123' for b in '0123'],
+        )
+
+        builder = spatial.Geohasher(number=8)
+        builder.add_aab((-10.0, 30.0, 35.0, 70.0))
+        builder.add_aab((2.0, 3.0, 48.0, 49.0))
+        self.assertEqual(
+            builder.get_hashes(),
+            [
+                ('123', 1),
+                ('132', 1),
+                ('133', 1),
+                ('301', 1),
+                ('310', 2),
+                ('311', 1),
+            ],
+        )
+        self.assertEqual(builder.total, 2)
+
+    def test_sketch_aab_inverted(self):
+        """Test boxes with min > max, which wrap around"""
+        builder = spatial.Geohasher(base=4, precision=4, number=8)
+        builder.add_aab((170.0, -170.0, -10.0, 10.0))
+        self.assertEqual(
+            builder.get_hashes(),
+            [('2333', 1), ('3222', 1), ('0111', 1), ('1000', 1)],
+        )
+
+        builder = spatial.Geohasher(base=4, precision=4, number=8)
+        builder.add_aab((10.0, 20.0, 60.0, -60.0))
+        self.assertEqual(
+            builder.get_hashes(),
+            [
+                ('3101', 1),
+                ('3110', 1),
+                ('3111', 1),
+                ('2000', 1),
+                ('2001', 1),
+                ('2010', 1),
+            ],
+        )
+
+        # Parents of the wrapped cells are created even if the level is then
+        # dropped
+        builder = spatial.Geohasher(base=4, precision=4, number=3)
+        builder.add_aab((100.0, 80.0, 10.0, 20.0))
+        self.assertEqual(
+            builder.get_hashes(),
+            [('3', 1), ('1', 0)],
+        )
+
 
 class TestMedianDist(unittest.TestCase):
     def test_median_dist(self):
@@ -1460,3 +2383,38 @@ class TestMedianDist(unittest.TestCase):
             0.9,
             delta=0.05
         )
+
+
+class TestSpatialRanges(unittest.TestCase):
+    def test_geo(self):
+        """Test computing spatial ranges from all the points, or a sample"""
+        with data('geo.csv', 'r') as fp:
+            points = pandas.read_csv(fp)[['lat', 'long']].values
+
+        expected = [
+            [[-74.005837, 40.731375], [-73.998869, 40.726557]],
+            [[-73.999816, 40.735108], [-73.991205, 40.726507]],
+            [[-73.990503, 40.694718], [-73.983925, 40.690503]],
+        ]
+        self.assertEqual(
+            spatial.get_spatial_ranges(points),
+            [
+                {'range': {'type': 'envelope', 'coordinates': coords}}
+                for coords in expected
+            ],
+        )
+        self.assertEqual(
+            spatial.get_spatial_ranges([tuple(p) for p in points.tolist()]),
+            spatial.get_spatial_ranges(points),
+        )
+
+        # Clustering from a sample gives similar ranges
+        ranges = spatial.get_spatial_ranges(points, max_points=60)
+        self.assertEqual(len(ranges), 3)
+        for rg, coords in zip(ranges, expected):
+            [long1, lat1], [long2, lat2] = rg['range']['coordinates']
+            [elong1, elat1], [elong2, elat2] = coords
+            self.assertAlmostEqual(long1, elong1, delta=0.005)
+            self.assertAlmostEqual(lat1, elat1, delta=0.005)
+            self.assertAlmostEqual(long2, elong2, delta=0.005)
+            self.assertAlmostEqual(lat2, elat2, delta=0.005)